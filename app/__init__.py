@@ -30,11 +30,36 @@ def create_app(config_name):
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
 
-    from .models import db
+    from .models import db, UserCache
     db.init_app(app)
 
+    # Before anything uses the database, the replicas are binds of their own.
+    from .replicas import replicas
+    replicas.init_app(app)
+    UserCache.init_app(app)
+
     bootstrap.init_app(app)
     mail.init_app(app)
+
+    from .email import dispatcher
+    dispatcher.init_app(app)
+
+    from .last_seen import recorder
+    recorder.init_app(app)
+
+    from .response_cache import response_cache
+    response_cache.init_app(app)
+
+    from .fragments import fragment_cache
+    fragment_cache.init_app(app)
+
+    from .avatars import avatars
+    avatars.init_app(app)
+
+    # Before the blueprints, so that their request hooks are profiled too.
+    from .profiling import profiler
+    profiler.init_app(app)
+
     login_manager.init_app(app)
     moment.init_app(app)
     pagedown.init_app(app)
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 api = Blueprint('api', __name__)
 
-from . import authentication, comments, posts, users, errors
\ No newline at end of file
+from . import authentication, comments, posts, users, errors, export, search
\ No newline at end of file
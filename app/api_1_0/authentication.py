@@ -1,15 +1,109 @@
+import hashlib
+import hmac
+import os
+import time
+
 from flask_httpauth import HTTPBasicAuth
-from flask import g, jsonify
+from flask import g, jsonify, current_app
 
-from ..models import User, AnonymousUser
+from ..cache import LRUCache
+from ..engine import primary
+from ..models import db, User, Role, AnonymousUser, UserCache
 from . import api
 from .errors import unauthorized, forbidden
 
-# RESTful API are stateless, it doesn't use Cookie and Session, 
-# So Flask-Login is not able to handle user credentials, instead 
+# RESTful API are stateless, it doesn't use Cookie and Session,
+# So Flask-Login is not able to handle user credentials, instead
 # Flask-HttpAuth is used.
 auth = HTTPBasicAuth()
 
+# API clients authenticate on every single request, which costs a signature check
+# (tokens) or a full PBKDF2 hash (email and password) plus a user lookup each time.
+# Successful checks are remembered for a short while instead:
+#
+#   `token_cache` maps an already verified token to the user id it encodes.
+#   `credential_cache` maps a salted digest of an email/password pair that was
+#   accepted to the user id it belongs to. The salt is random per process and the
+#   plain password is never kept.
+#
+# Entries remember the `version` of their user and the permissions of their role,
+# and are only honoured while the database still has those: `RowVersion` bumps the
+# version on every change to the user, its email, password, role and confirmation
+# status included. Checking costs one primary key lookup, far less than the hash,
+# and it sees the changes made by every process. The version is the one of the row
+# the password was checked against, so a change committed meanwhile is never missed.
+token_cache = LRUCache()
+credential_cache = LRUCache()
+_credential_salt = os.urandom(16)
+
+@api.record_once
+def configure_caches(state):
+    token_cache.maxsize = state.app.config['FLASKY_AUTH_TOKEN_CACHE_SIZE']
+    credential_cache.maxsize = state.app.config['FLASKY_AUTH_CREDENTIAL_CACHE_SIZE']
+
+def credential_digest(email, password):
+    message = (email + '\0' + password).encode('utf-8')
+    return hmac.new(_credential_salt, message, hashlib.sha256).hexdigest()
+
+def auth_state(user_id):
+    '''The committed version of a user and the permissions of their role, None if
+    the user doesn't exist.'''
+    with primary():
+        row = db.session.query(User.version, Role.permissions) \
+            .outerjoin(Role, Role.name==User.role_name) \
+            .filter(User.id==user_id).first()
+    return tuple(row) if row is not None else None
+
+def user_state(user):
+    return user.version, user.role.permissions if user.role is not None else None
+
+def cached_user_id(cache, key):
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    user_id, state = entry
+    if auth_state(user_id) != state:
+        cache.delete(key)
+        return None
+    return user_id
+
+def verify_token(token):
+    '''Returns the id of the user a valid token belongs to.'''
+    user_id = cached_user_id(token_cache, token)
+    if user_id is not None:
+        return user_id
+    parsed = User.parse_auth_token(token)
+    if parsed is None:
+        return None
+    user_id, expires = parsed
+    # Never keep a token for longer than it is valid.
+    ttl = min(current_app.config['FLASKY_AUTH_TOKEN_CACHE_TTL'], expires - time.time())
+    if ttl > 0:
+        state = auth_state(user_id)
+        if state is not None:
+            token_cache.set(token, (user_id, state), ttl=ttl)
+    return user_id
+
+def verify_credentials(email, password):
+    '''Returns the user an email and password belong to, and whether the password
+    is correct. Only correct passwords are cached.'''
+    digest = credential_digest(email, password)
+    user_id = cached_user_id(credential_cache, digest)
+    if user_id is not None:
+        user = UserCache.load(user_id)
+        if user is not None:
+            return user, True
+    # Not a replica, which may still have the old password.
+    with primary():
+        user = User.query.filter_by(email=email).first()
+    if user is None:
+        return None, False
+    if not user.verify_password(password):
+        return user, False
+    credential_cache.set(digest, (user.id, user_state(user)),
+                         ttl=current_app.config['FLASKY_AUTH_CREDENTIAL_CACHE_TTL'])
+    return user, True
+
 @api.before_request
 @auth.login_required
 def before_request():
@@ -25,20 +119,21 @@ def verify_password(email_or_token, password):
         g.current_user = AnonymousUser()
         return True
 
-    # if password is not supllied, the only way to check the user 
+    # if password is not supllied, the only way to check the user
     # is through token.
     if password == '':
-        g.current_user = User.verify_auth_token(email_or_token)
+        user_id = verify_token(email_or_token)
+        g.current_user = UserCache.load(user_id) if user_id is not None else None
         g.token_used = True
-        return g.curren_user is not None
+        return g.current_user is not None
 
     # if password is supllied, then check user's email and password.
-    user = User.query.filter_by(email=email_or_token).first()
+    user, verified = verify_credentials(email_or_token, password)
     if not user:
         return False
     g.current_user = user
     g.token_used = False
-    return user.verify_password(password)
+    return verified
 
 @auth.error_handler
 def auth_error():
@@ -46,7 +141,7 @@ def auth_error():
 
 @api.route('/token')
 def get_token():
-    if g.current_user.is_anonymous() or g.token_used:
+    if g.current_user.is_anonymous or g.token_used:
         return unauthorized('Invalid credentials')
     return jsonify({'token': g.current_user.generate_auth_token(
         expiration=3600), 'expiration': 3600})
@@ -0,0 +1,44 @@
+from flask import current_app, jsonify
+
+from ..exceptions import ValidationError
+from ..models import db
+from .conditional import is_conditional, make_etag, not_modified, with_validators
+
+def parse_ids(value):
+    '''Parse a comma separated list of ids, keeping their order but not repeats.'''
+    ids = []
+    for id in value.split(','):
+        try:
+            id = int(id)
+        except ValueError:
+            raise ValidationError('invalid id %r' % id)
+        if id not in ids:
+            ids.append(id)
+    if not ids:
+        raise ValidationError('no ids given')
+    limit = current_app.config['FLASKY_API_BATCH_LIMIT']
+    if len(ids) > limit:
+        raise ValidationError('at most %d ids can be requested at once' % limit)
+    return ids
+
+def batch_response(model, name, ids):
+    '''The JSON representations of the rows of `model` with the given ids, loaded
+    with one query, in the order the ids were asked for. Ids that don't exist are
+    listed under `missing`.'''
+    ids = parse_ids(ids)
+    if is_conditional():
+        versions = db.session.query(model.id, model.version) \
+            .filter(model.id.in_(ids)).all()
+        order = dict((id, i) for i, id in enumerate(ids))
+        versions.sort(key=lambda row: order[row.id])
+        response = not_modified(make_etag(versions))
+        if response is not None:
+            return response
+    rows = dict((row.id, row) for row in model.query.filter(model.id.in_(ids)))
+    found = [rows[id] for id in ids if id in rows]
+    return with_validators(
+        jsonify({
+            name: [row.to_json() for row in found],
+            'missing': [id for id in ids if id not in rows]
+        }),
+        make_etag([(row.id, row.version) for row in found]))
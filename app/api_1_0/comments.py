@@ -1,54 +1,59 @@
 from flask import jsonify, request, g, url_for, current_app
 from ..models import Post, Permission, Comment, db
+from ..pagination import keyset_paginate
+from ..response_cache import response_cache
 from . import api
 from .decorators import permission_required
+from .errors import forbidden
+from .conditional import check_resource, resource_response, check_page, page_response
 
 @api.route('/comments/')
+@response_cache.cached('comments')
 def get_comments():
-    page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-        error_out=False)
+    columns = (Comment.timestamp, Comment.id)
+    cursor = request.args.get('cursor')
+    per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE']
+    response = check_page(Comment.query, columns, Comment, cursor, per_page=per_page)
+    if response is not None:
+        return response
+    pagination = keyset_paginate(Comment.query, columns, cursor, per_page=per_page)
     comments = pagination.items
-    prev = None
-    if pagination.has_prev:
-        perv = url_for('api.get_comments', page=page-1, _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for('api.get_comments', page=page+1, _external=True)
-    return jsonify({
+    return page_response(pagination, {
         'comments': [comment.to_json() for comment in comments],
-        'prev': prev,
-        'next': next,
-        'count': pagination.total    
+        'prev': pagination.prev_url('api.get_comments'),
+        'next': pagination.next_url('api.get_comments'),
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor
     })
 
 @api.route('/comments/<int:id>')
 def get_comment(id):
+    response = check_resource(Comment, id)
+    if response is not None:
+        return response
     comment = Comment.query.get_or_404(id)
-    return jsonify(comment.to_json())
+    return resource_response(comment)
 
 @api.route('/posts/<int:id>/comments/')
+@response_cache.cached('post:{id}:comments')
 def get_post_comments(id):
     post = Post.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=curren_app.config['FLASKY_COMMENTS_PER_PAGE'],
-        error_out=False)
+    columns = (Comment.timestamp, Comment.id)
+    cursor = request.args.get('cursor')
+    per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE']
+    response = check_page(post.comments, columns, Comment, cursor,
+                          per_page=per_page, descending=False)
+    if response is not None:
+        return response
+    pagination = keyset_paginate(post.comments, columns, cursor,
+                                 per_page=per_page, descending=False)
     comments = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_post_comments', id=id, page=page-1,
-                       _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for('api.get_post_comments', id=id, page=page+1,
-                       _external=True)
-    return jsonify({
+    return page_response(pagination, {
         'comments': [comment.to_json() for comment in comments],
-        'prev': prev,
-        'next': next,
-        'count': pagination.total  
+        'prev': pagination.prev_url('api.get_post_comments', id=id),
+        'next': pagination.next_url('api.get_post_comments', id=id),
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor
     })
 
 @api.route('/posts/<int:id>/comments/', methods=['POST'])
@@ -0,0 +1,86 @@
+'''Conditional GET support for the API.
+
+Every response of a resource or a page of resources carries a strong `ETag`
+derived from the `id` and `version` of the rows it is built from, and resources
+also carry a `Last-Modified` header taken from their `updated` column.
+
+When a request comes with `If-None-Match` or `If-Modified-Since`, the validators are
+first computed from a query that only reads those columns, and a `304 Not Modified`
+is returned without loading or serializing anything else.
+'''
+import hashlib
+
+from flask import request, jsonify, abort, make_response
+
+from ..models import db
+from ..pagination import keyset_paginate
+
+def is_conditional():
+    return bool(request.if_none_match) or request.if_modified_since is not None
+
+def make_etag(rows, *extra):
+    '''A strong ETag for the representation of `rows`, a sequence of (id, version)
+    pairs, at the current URL.'''
+    digest = hashlib.sha1(request.url.encode('utf-8'))
+    for value in extra:
+        digest.update(('|%r' % (value,)).encode('utf-8'))
+    for id, version in rows:
+        digest.update(('|%d:%d' % (id, version)).encode('utf-8'))
+    return digest.hexdigest()
+
+def page_etag(pagination):
+    return make_etag([(item.id, item.version) for item in pagination.items],
+                     pagination.has_prev, pagination.has_next)
+
+def not_modified(etag, last_modified=None):
+    '''Returns a `304 Not Modified` response if the validators of the request match,
+    otherwise None.'''
+    if request.if_none_match:
+        # When both are sent, `If-None-Match` wins (RFC 7232, section 6). It is
+        # compared weakly, so that ETags weakened by a compressing proxy still match.
+        modified = not request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since is not None and last_modified is not None:
+        # HTTP dates have a resolution of one second.
+        modified = last_modified.replace(microsecond=0) > request.if_modified_since
+    else:
+        return None
+    if modified:
+        return None
+    return with_validators(make_response('', 304), etag, last_modified)
+
+def with_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+def check_resource(model, id):
+    '''Answer a conditional request for the row `id` of `model` from its `version`
+    and `updated` columns alone. Returns a 304 response or None; aborts with 404 if
+    there is no such row.'''
+    if not is_conditional():
+        return None
+    row = db.session.query(model.version, model.updated).filter(model.id==id).first()
+    if row is None:
+        abort(404)
+    return not_modified(make_etag([(id, row.version)]), row.updated)
+
+def resource_response(resource):
+    '''The JSON representation of `resource` with its validators.'''
+    return with_validators(jsonify(resource.to_json()),
+                           make_etag([(resource.id, resource.version)]),
+                           resource.updated)
+
+def check_page(query, columns, entity, cursor=None, **kwargs):
+    '''Answer a conditional request for a page of `query` by paginating over the
+    `id` and `version` columns of `entity` only. The arguments are the ones of
+    `keyset_paginate()`. Returns a 304 response or None.'''
+    if not request.if_none_match:
+        return None
+    light = query.with_entities(entity.id, entity.version,
+                                *[column for column in columns if column is not entity.id])
+    return not_modified(page_etag(keyset_paginate(light, columns, cursor, **kwargs)))
+
+def page_response(pagination, payload):
+    '''`payload` as JSON, with the ETag of `pagination`.'''
+    return with_validators(jsonify(payload), page_etag(pagination))
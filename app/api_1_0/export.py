@@ -0,0 +1,23 @@
+from flask import Response, request, stream_with_context
+
+from ..export import KINDS, export_records, ndjson, parse_kinds, parse_timestamp
+from ..models import Permission
+from . import api
+from .decorators import permission_required
+
+@api.route('/export')
+@permission_required(Permission.ADMINISTER)
+def export():
+    '''Stream posts, comments and follows as newline-delimited JSON.
+
+    Query arguments: `types`, a comma separated subset of posts, comments and
+    follows; `author`, a user id; `since`, an ISO 8601 UTC timestamp.
+    '''
+    kinds = parse_kinds(request.args.get('types', ','.join(KINDS)))
+    author = request.args.get('author', type=int)
+    since = request.args.get('since')
+    if since is not None:
+        since = parse_timestamp(since)
+    records = export_records(kinds, author=author, since=since)
+    return Response(stream_with_context(ndjson(records)),
+                    mimetype='application/x-ndjson')
@@ -1,9 +1,13 @@
 from flask import jsonify, g, request, abort, url_for, current_app
 
 from ..models import db, Post, Permission
+from ..pagination import keyset_paginate
+from ..response_cache import response_cache
 from . import api
 from .decorators import permission_required
 from .errors import forbidden
+from .conditional import check_resource, resource_response, check_page, page_response
+from .batch import batch_response
 
 @api.route('/posts/', methods=['POST'])
 @permission_required(Permission.WRITE_ARTICLES)
@@ -16,29 +20,34 @@ def new_post():
             {'Location': url_for('api.get_post', id=post.id, _external=True)})
 
 @api.route('/posts/')
+@response_cache.cached('posts')
 def get_posts():
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.paginate(
-        page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
+    ids = request.args.get('ids')
+    if ids is not None:
+        return batch_response(Post, 'posts', ids)
+    columns = (Post.timestamp, Post.id)
+    cursor = request.args.get('cursor')
+    per_page = current_app.config['FLASKY_POSTS_PER_PAGE']
+    response = check_page(Post.query, columns, Post, cursor, per_page=per_page)
+    if response is not None:
+        return response
+    pagination = keyset_paginate(Post.query, columns, cursor, per_page=per_page)
     posts = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_posts', page=page-1, _external=True)
-    next = None
-    if pagination.has_next:
-        prev = url_for('api.get_posts', page=page+1, _external=True)
-    return jsonify({
+    return page_response(pagination, {
         'posts': [post.to_json() for post in posts],
-        'prev': prev,
-        'next': next,
-        'count': pagination.total
+        'prev': pagination.prev_url('api.get_posts'),
+        'next': pagination.next_url('api.get_posts'),
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor
     })
 
 @api.route('/posts/<int:id>')
 def get_post(id):
+    response = check_resource(Post, id)
+    if response is not None:
+        return response
     post = Post.query.get_or_404(id)
-    return jsonify(post.to_json())
+    return resource_response(post)
 
 @api.route('/posts/<int:id>', methods=['PUT'])
 @permission_required(Permission.WRITE_ARTICLES)
@@ -0,0 +1,25 @@
+from flask import jsonify, request, current_app
+
+from ..models import Post
+from ..response_cache import response_cache
+from ..search import search as search_index
+from . import api
+
+@api.route('/search')
+@response_cache.cached('posts', 'comments')
+def search():
+    query = request.args.get('q')
+    pagination = search_index(
+        query, request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_SEARCH_RESULTS_PER_PAGE'])
+    results = []
+    for result in pagination.items:
+        kind = 'post' if isinstance(result, Post) else 'comment'
+        results.append({'type': kind, kind: result.to_json()})
+    return jsonify({
+        'results': results,
+        'prev': pagination.prev_url('api.search', q=query),
+        'next': pagination.next_url('api.search', q=query),
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor
+    })
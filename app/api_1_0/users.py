@@ -1,50 +1,68 @@
 from flask import jsonify, request, current_app, url_for
 from . import api
-from ..models import User, Post
+from ..exceptions import ValidationError
+from ..models import User, Post, Timeline
+from ..pagination import keyset_paginate
+from ..response_cache import response_cache
+from .conditional import check_resource, resource_response, check_page, page_response
+from .batch import batch_response
+
+@api.route('/users/')
+def get_users():
+    '''Several users at once, `?ids=1,2,3`.'''
+    ids = request.args.get('ids')
+    if ids is None:
+        raise ValidationError('ids are required')
+    return batch_response(User, 'users', ids)
 
 @api.route('/users/<int:id>')
 def get_user(id):
+    response = check_resource(User, id)
+    if response is not None:
+        return response
     user = User.query.get_or_404(id)
-    return jsonify(user.to_json())
+    return resource_response(user)
 
 @api.route('/users/<int:id>/posts/')
+@response_cache.cached('user:{id}:posts')
 def get_user_posts(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
+    columns = (Post.timestamp, Post.id)
+    cursor = request.args.get('cursor')
+    per_page = current_app.config['FLASKY_POSTS_PER_PAGE']
+    response = check_page(user.posts, columns, Post, cursor, per_page=per_page)
+    if response is not None:
+        return response
+    pagination = keyset_paginate(user.posts, columns, cursor, per_page=per_page)
     posts = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_user_posts', page=page-1, _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for('api.get_user_posts', page=page+1, _external=True)
-    return jsonify({
+    return page_response(pagination, {
         'posts': [post.to_json() for post in posts],
-        'prev': prev,
-        'next': next,
-        'count': pagination.total
+        'prev': pagination.prev_url('api.get_user_posts', id=id),
+        'next': pagination.next_url('api.get_user_posts', id=id),
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor
     })
 
 @api.route('/users/<int:id>/timeline/')
 def get_user_followed_posts(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followed_posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
+
+    # Sort on the timeline's own columns so the (user_id, timestamp) index is used.
+    columns = (Timeline.timestamp, Timeline.post_id)
+    cursor = request.args.get('cursor')
+    per_page = current_app.config['FLASKY_POSTS_PER_PAGE']
+    key = lambda post: (post.timestamp, post.id)
+    response = check_page(user.followed_posts, columns, Post, cursor,
+                          per_page=per_page, key=key)
+    if response is not None:
+        return response
+    pagination = keyset_paginate(user.followed_posts, columns, cursor,
+                                 per_page=per_page, key=key)
     posts = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_user_followed_posts', page=page-1, _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for('api.get_user_followed_posts', page=page+1, _external=True)
-    return jsonify({
+    return page_response(pagination, {
         'posts': [post.to_json() for post in posts],
-        'prev': prev,
-        'next': next,
-        'count': pagination.total
+        'prev': pagination.prev_url('api.get_user_followed_posts', id=id),
+        'next': pagination.next_url('api.get_user_followed_posts', id=id),
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor
     })
\ No newline at end of file
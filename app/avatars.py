@@ -0,0 +1,136 @@
+'''Avatars.
+
+Users are shown with identicons rendered by the application from their
+`avatar_hash`, instead of images from gravatar.com, unless `FLASKY_AVATARS` is
+`'gravatar'`. An identicon is a 5x5 grid, mirrored around its middle column, whose
+cells and colour are taken from the hash, so the same user always gets the same
+picture.
+
+Identicons are drawn in the sizes of `FLASKY_AVATAR_SIZES` only, other sizes are
+rounded up to the next one, and only for the `avatar_hash` of an existing user, so
+that clients can't fill the disk with made up hashes. Each is written once as a PNG to
+`FLASKY_AVATAR_DIR/<size>/<hash>.png` and served at `/avatars/<size>/<hash>.png`
+with a Cache-Control header telling browsers to keep it for a year, as it never
+changes. The directory is laid out like the URLs, so that nginx serves the files
+that exist and only forwards the others to the application, see
+nginx_gunicorn.conf.
+
+`avatar_url()` memoizes the URLs it builds per hash and size.
+'''
+import binascii
+import colorsys
+import hashlib
+import os
+import re
+import struct
+import tempfile
+import zlib
+
+from flask import current_app, request, url_for
+
+from .cache import LRUCache
+
+HASH = re.compile(r'^[0-9a-f]{32}$')
+
+BACKGROUND = bytearray([240, 240, 240])
+
+def png(width, height, rows):
+    '''An 8-bit RGB PNG image made of `rows`, `height` strings of `width` * 3
+    bytes.'''
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    raw = b''.join(b'\x00' + bytes(row) for row in rows)
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw, 9)) + \
+        chunk(b'IEND', b'')
+
+def identicon(digest, size):
+    '''The PNG identicon of `digest`, an MD5 hex digest, `size` pixels wide.'''
+    data = bytearray(binascii.unhexlify(digest))
+    red, green, blue = colorsys.hls_to_rgb(data[0] / 255.0, 0.5, 0.6)
+    colour = bytearray([int(red * 255), int(green * 255), int(blue * 255)])
+    cell = max(1, size * 8 // 50)
+    margin = (size - 5 * cell) // 2
+
+    blank = BACKGROUND * size
+    rows = [blank] * margin
+    for y in range(5):
+        row = BACKGROUND * margin
+        for x in range(5):
+            # Bytes 1 to 15 fill the left half and the middle column.
+            filled = data[1 + y * 3 + min(x, 4 - x)] % 2 == 0
+            row += (colour if filled else BACKGROUND) * cell
+        row += BACKGROUND * (size - len(row) // 3)
+        rows.extend([row] * cell)
+    rows.extend([blank] * (size - len(rows)))
+    return png(size, size, rows)
+
+def avatar_size(size):
+    '''The size in `FLASKY_AVATAR_SIZES` drawn for a request of `size` pixels.'''
+    sizes = sorted(current_app.config['FLASKY_AVATAR_SIZES'])
+    for available in sizes:
+        if available >= size:
+            return available
+    return sizes[-1]
+
+def avatar_file(digest, size):
+    '''The path of the identicon of `digest` at `size`, rendering it if needed.
+    Raises ValueError for a malformed digest, a size that isn't drawn or a digest
+    that isn't the avatar hash of any user.'''
+    from .models import db, User
+
+    if not HASH.match(digest) or size not in current_app.config['FLASKY_AVATAR_SIZES']:
+        raise ValueError('no such avatar')
+    directory = os.path.join(current_app.config['FLASKY_AVATAR_DIR'], str(size))
+    path = os.path.join(directory, digest + '.png')
+    if os.path.exists(path):
+        return path
+    if db.session.query(User.id).filter_by(avatar_hash=digest).first() is None:
+        raise ValueError('no such avatar')
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    # Written aside and renamed, so that nginx never serves half a file.
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(identicon(digest, size))
+        os.rename(temporary, path)
+    except Exception:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return path
+
+def avatar_url(user, size):
+    '''The URL of the avatar of `user`, `size` pixels wide.'''
+    kind = current_app.config['FLASKY_AVATARS']
+    key = (kind, request.script_root, request.is_secure,
+           user.avatar_hash or user.email, size)
+    urls = current_app.extensions['avatar_urls']
+    url = urls.get(key)
+    if url is None:
+        if kind == 'gravatar':
+            url = user.gravatar(size=size)
+        else:
+            digest = user.avatar_hash or \
+                hashlib.md5(user.email.encode('utf-8')).hexdigest()
+            url = url_for('main.avatar', size=avatar_size(size), digest=digest)
+        urls.set(key, url)
+    return url
+
+class Avatars(object):
+    '''Flask extension holding the memoized avatar URLs of an application.'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['avatar_urls'] = LRUCache(app.config['FLASKY_AVATAR_URL_CACHE_SIZE'])
+
+avatars = Avatars()
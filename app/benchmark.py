@@ -0,0 +1,297 @@
+'''Throughput and latency benchmarks of the web pages and the API.
+
+A run seeds a database with `app.seed.seed()` and then sends a fixed number of
+requests to every scenario in `SCENARIOS`. Requests go either through the Flask
+test client, in this process, or over HTTP to gunicorn workers started for the run.
+Every scenario reports:
+
+* `rps`, the requests per second it sustained;
+* `p50`, `p95` and `p99`, latency percentiles in milliseconds;
+* `queries`, the mean number of SQL statements per request, read from the
+  `Server-Timing` header, which `BenchmarkConfig` sends to every client;
+* `errors`, the number of responses with an unexpected status.
+
+The results can be saved as JSON and later runs compared against them, see
+`compare()`. Runs are only comparable on the same machine, database and dataset.
+
+The database is the one of `BenchmarkConfig`, SQLite unless `BENCH_DATABASE_URL`
+points somewhere else, e.g. at a local PostgreSQL.
+'''
+import json
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from base64 import b64encode
+from timeit import default_timer
+
+from .models import db, User, Role, Post
+from .seed import seed, rebuild_derived
+
+QUERIES = re.compile(r'desc="(\d+) queries')
+
+def _index(rng, dataset):
+    return 'GET', '/', None
+
+def _post(rng, dataset):
+    return 'GET', '/post/%d' % rng.choice(dataset.posts), None
+
+def _followers(rng, dataset):
+    return 'GET', '/followers/%s' % rng.choice(dataset.users).username, None
+
+def _api_timeline(rng, dataset):
+    return 'GET', '/api/v1.0/users/%d/timeline/' % rng.choice(dataset.users).id, None
+
+def _api_comments(rng, dataset):
+    return 'GET', '/api/v1.0/posts/%d/comments/' % rng.choice(dataset.posts), None
+
+def _api_new_comment(rng, dataset):
+    return 'POST', '/api/v1.0/posts/%d/comments/' % rng.choice(dataset.posts), \
+        {'body': 'Benchmark comment %d' % rng.randrange(1000000)}
+
+# Name, how the viewer is authenticated ('session' logs in through the login form,
+# 'api' sends HTTP basic auth, None is anonymous), request builder and the expected
+# status of the responses.
+SCENARIOS = [
+    ('index', 'session', _index, 200),
+    ('post', None, _post, 200),
+    ('followers', None, _followers, 200),
+    ('api_timeline', 'api', _api_timeline, 200),
+    ('api_comments', 'api', _api_comments, 200),
+    ('api_new_comment', 'api', _api_new_comment, 201),
+]
+
+class Dataset(object):
+    '''A sample of the users and posts of the database, the requests of the
+    scenarios pick their targets from it. Authenticated requests are made as the
+    first user of the sample, whose password must be `password`.'''
+
+    def __init__(self, users, posts, password):
+        self.users = users
+        self.posts = posts
+        self.viewer = users[0]
+        self.password = password
+
+    @staticmethod
+    def load(password='cat', size=1000):
+        users = db.session.query(User.id, User.username, User.email) \
+            .order_by(db.func.random()).limit(size).all()
+        posts = [id for id, in db.session.query(Post.id)
+                 .order_by(db.func.random()).limit(size)]
+        if not users or not posts:
+            raise ValueError('the database has no users or posts to benchmark')
+        return Dataset(users, posts, password)
+
+    def login(self, session, auth):
+        '''Authenticate `session` as the viewer, returns the headers to send with
+        every request.'''
+        if auth == 'session':
+            session.request('POST', '/auth/login', form={
+                'email': self.viewer.email, 'password': self.password})
+        elif auth == 'api':
+            credentials = '%s:%s' % (self.viewer.email, self.password)
+            return {'Authorization': 'Basic ' + b64encode(
+                credentials.encode('utf-8')).decode('ascii')}
+        return {}
+
+def prepare(users=100, posts=1000, comments=5000, follows=20, seed_value=0,
+            password='cat'):
+    '''Replace the database with a freshly seeded dataset.'''
+    from .fragments import fragment_cache
+    from .last_seen import recorder
+    from .response_cache import response_cache
+
+    recorder.flush()
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    Role.insert_roles()
+    seed(users, posts, comments, follows, seed_value, password=password)
+    rebuild_derived()
+    response_cache.clear()
+    fragment_cache.clear()
+
+class ClientSession(object):
+    '''Sends the requests of one simulated viewer through the Flask test client.'''
+
+    def __init__(self, app):
+        self.client = app.test_client(use_cookies=True)
+
+    def request(self, method, path, headers=None, data=None, form=None):
+        kwargs = {'headers': headers or {}}
+        if form is not None:
+            kwargs['data'] = form
+        elif data is not None:
+            kwargs['data'] = json.dumps(data)
+            kwargs['content_type'] = 'application/json'
+        response = self.client.open(path, method=method, **kwargs)
+        response.close()
+        return response.status_code, response.headers.get('Server-Timing', '')
+
+class HTTPSession(object):
+    '''Sends the requests of one simulated viewer over HTTP, keeping the connection
+    alive between requests.'''
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, headers=None, data=None, form=None):
+        kwargs = {'headers': headers or {}, 'allow_redirects': False}
+        if form is not None:
+            kwargs['data'] = form
+        elif data is not None:
+            kwargs['json'] = data
+        response = self.session.request(method, self.base_url + path, **kwargs)
+        return response.status_code, response.headers.get('Server-Timing', '')
+
+def percentile(values, fraction):
+    '''The nearest-rank percentile of sorted `values`.'''
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+def summarize(latencies, queries, errors, elapsed):
+    '''The statistics of a scenario, from the latencies in seconds and query counts
+    of its requests and the wall time it took.'''
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed if elapsed else None,
+        'p50': percentile(latencies, 0.50) * 1000 if latencies else None,
+        'p95': percentile(latencies, 0.95) * 1000 if latencies else None,
+        'p99': percentile(latencies, 0.99) * 1000 if latencies else None,
+        'queries': float(sum(queries)) / len(queries) if queries else None,
+    }
+
+def run_scenario(make_session, dataset, scenario, requests=200, concurrency=1,
+                 warmup=10, seed_value=0):
+    '''Send `requests` requests of `scenario` from `concurrency` simulated viewers,
+    each with a session made by `make_session()`, after `warmup` requests whose
+    timings are thrown away.'''
+    name, auth, build, expected = scenario
+    latencies, queries, errors = [], [], [0]
+    lock = threading.Lock()
+
+    def worker(session, headers, rng, count):
+        for i in range(count):
+            method, path, data = build(rng, dataset)
+            start = default_timer()
+            status, timing = session.request(method, path, headers, data)
+            latency = default_timer() - start
+            match = QUERIES.search(timing)
+            with lock:
+                latencies.append(latency)
+                if match:
+                    queries.append(int(match.group(1)))
+                if status != expected:
+                    errors[0] += 1
+
+    # Sessions are logged in and warmed up before the clock starts.
+    threads = []
+    for index in range(concurrency):
+        rng = random.Random('%s:%d:%d' % (name, seed_value, index))
+        session = make_session()
+        headers = dataset.login(session, auth)
+        for i in range(warmup if index == 0 else 0):
+            method, path, data = build(rng, dataset)
+            session.request(method, path, headers, data)
+        count = requests // concurrency + (1 if index < requests % concurrency else 0)
+        threads.append(threading.Thread(target=worker,
+                                        args=(session, headers, rng, count)))
+    start = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, queries, errors[0], default_timer() - start)
+
+def run(make_session, dataset, scenarios=None, **options):
+    '''Run every scenario, or those named in `scenarios`. Returns the statistics
+    per scenario name.'''
+    results = {}
+    for scenario in SCENARIOS:
+        if scenarios and scenario[0] not in scenarios:
+            continue
+        results[scenario[0]] = run_scenario(make_session, dataset, scenario, **options)
+    return results
+
+class GunicornServer(object):
+    '''gunicorn serving `manage:app` with the benchmark configuration, for the
+    duration of a `with` block.'''
+
+    def __init__(self, workers=2, port=0, env=None):
+        self.workers = workers
+        self.port = port or self._free_port()
+        self.env = env or {}
+        self.process = None
+
+    @staticmethod
+    def _free_port():
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.port
+
+    def __enter__(self):
+        env = dict(os.environ, FLASK_CONFIG='benchmark', **self.env)
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--workers', str(self.workers),
+             '--bind', '127.0.0.1:%d' % self.port, '--log-level', 'warning',
+             'manage:app'],
+            env=env, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return self
+            except socket.error:
+                if self.process.poll() is not None or time.time() > deadline:
+                    self.__exit__(None, None, None)
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.1)
+
+    def __exit__(self, *exc_info):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+
+# Metrics compared against a baseline, and whether a higher value is better.
+METRICS = (('rps', True), ('p50', False), ('p95', False), ('p99', False),
+           ('queries', False))
+
+def compare(results, baseline, tolerance=0.1):
+    '''Compare `results` with the `baseline` results of an earlier run. Returns a
+    list of (scenario, metric, baseline, current, change, regressed) tuples, where
+    `change` is the relative change and `regressed` tells whether it is worse by
+    more than `tolerance`. Any increase of the queries per request is a
+    regression.'''
+    rows = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in METRICS:
+            old, new = baseline[name].get(metric), results[name].get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            if metric == 'queries':
+                regressed = new > old
+            elif higher_is_better:
+                regressed = change < -tolerance
+            else:
+                regressed = change > tolerance
+            rows.append((name, metric, old, new, change, regressed))
+    return rows
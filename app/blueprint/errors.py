@@ -1,5 +1,6 @@
 from flask import render_template, request, jsonify
 from . import blueprint
+from ..exceptions import ValidationError
 
 '''The handling of status codes 404 and 500 presents a small complication,
 in that these errors are generated by Flask on its own and will ususally
@@ -8,6 +9,17 @@ return an HTML response, which is likely to confuse an API client.
 requested by the client.
 '''
 
+@blueprint.app_errorhandler(ValidationError)
+def bad_request(e):
+    '''Raised for malformed input such as a tampered pagination cursor. The API
+    blueprint registers its own handler, which takes precedence for its routes.'''
+    if (request.accept_mimetypes.accept_json and 
+            not request.accept_mimetypes.accept_html):
+        response = jsonify({'error': 'bad request', 'message': e.args[0]})
+        response.status_code = 400
+        return response
+    return render_template('blueprint/400.html', message=e.args[0]), 400
+
 @blueprint.app_errorhandler(404)
 def page_not_found(e):
     if (request.accept_mimetypes.accept_json and 
@@ -0,0 +1,117 @@
+'''Per-request database metrics.
+
+Built on the queries Flask-SQLAlchemy records for every request when
+`SQLALCHEMY_RECORD_QUERIES` is on. Every statement is reduced to a fingerprint,
+its text with literals and `IN` lists collapsed, so the same query run with
+different parameters is counted as one statement. A fingerprint executed over
+and over in one request is the signature of an N+1 access pattern.
+'''
+import re
+import threading
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACES = re.compile(r'\s+')
+_PARAMSTYLES = re.compile(r'%\(\w+\)s|%s|:\w+')
+
+def fingerprint(statement):
+    '''Normalize a statement so that executions differing only in their
+    parameters share the same text.'''
+    statement = _PARAMSTYLES.sub('?', statement)
+    statement = _LITERALS.sub('?', statement)
+    statement = _PLACEHOLDER_LISTS.sub('(?)', statement)
+    return _SPACES.sub(' ', statement).strip()
+
+def request_metrics(queries, top=5, duplicate_threshold=3):
+    '''Summarize the recorded queries of one request.
+
+    Returns the number of queries, the total time spent in them, the fingerprints
+    executed at least `duplicate_threshold` times and the `top` fingerprints by
+    cumulative time.
+    '''
+    statements = {}
+    duration = 0.0
+    for query in queries:
+        duration += query.duration
+        stats = statements.setdefault(fingerprint(query.statement), [0, 0.0])
+        stats[0] += 1
+        stats[1] += query.duration
+    ranked = sorted(statements.items(), key=lambda item: item[1][1], reverse=True)
+    return {
+        'count': len(queries),
+        'duration': duration,
+        'duplicates': [{'statement': statement, 'count': count, 'duration': time}
+                       for statement, (count, time) in ranked
+                       if count >= duplicate_threshold],
+        'top': [{'statement': statement, 'count': count, 'duration': time}
+                for statement, (count, time) in ranked[:top]]
+    }
+
+def server_timing(metrics):
+    '''Render request metrics as a `Server-Timing` header value.'''
+    description = '%d queries' % metrics['count']
+    if metrics['duplicates']:
+        description += ', %d repeated' % len(metrics['duplicates'])
+    return 'db;dur=%.2f;desc="%s"' % (metrics['duration'] * 1000, description)
+
+class EndpointStats(object):
+    '''Aggregates request metrics per endpoint, across the requests served by
+    this process.'''
+
+    # Statements kept per endpoint, the ones with the least cumulative time go first.
+    max_statements = 100
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, metrics):
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                'requests': 0,
+                'queries': 0,
+                'max_queries': 0,
+                'duration': 0.0,
+                'requests_with_duplicates': 0,
+                'statements': {}
+            })
+            stats['requests'] += 1
+            stats['queries'] += metrics['count']
+            stats['max_queries'] = max(stats['max_queries'], metrics['count'])
+            stats['duration'] += metrics['duration']
+            if metrics['duplicates']:
+                stats['requests_with_duplicates'] += 1
+            statements = stats['statements']
+            for entry in metrics['top']:
+                totals = statements.setdefault(entry['statement'], [0, 0.0])
+                totals[0] += entry['count']
+                totals[1] += entry['duration']
+            if len(statements) > self.max_statements:
+                ranked = sorted(statements.items(), key=lambda item: item[1][1])
+                for statement, totals in ranked[:len(statements) - self.max_statements]:
+                    del statements[statement]
+
+    def snapshot(self, top=5):
+        with self._lock:
+            snapshot = {}
+            for endpoint, stats in self._endpoints.items():
+                ranked = sorted(stats['statements'].items(),
+                                key=lambda item: item[1][1], reverse=True)
+                snapshot[endpoint] = {
+                    'requests': stats['requests'],
+                    'queries': stats['queries'],
+                    'max_queries': stats['max_queries'],
+                    'mean_queries': float(stats['queries']) / stats['requests'],
+                    'duration': stats['duration'],
+                    'mean_duration': stats['duration'] / stats['requests'],
+                    'requests_with_duplicates': stats['requests_with_duplicates'],
+                    'top': [{'statement': statement, 'count': count, 'duration': time}
+                            for statement, (count, time) in ranked[:top]]
+                }
+            return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+endpoint_stats = EndpointStats()
@@ -1,20 +1,337 @@
-from threading import Thread
+'''Outbound email.
 
-from flask import render_template, current_app
+Messages are neither rendered nor sent by the request that produces them.
+`send_email` and `send_bulk_email` put an `EmailJob` on a bounded queue: the
+template name and its context, with model instances replaced by their ids. A single
+background worker per process loads those instances back, renders the templates,
+whose compiled form it keeps, and delivers the queue over one SMTP connection that
+it keeps open between messages, instead of one thread and one TLS handshake per
+message.
+
+Links in the templates are built with `url_for(..., _external=True)` against the
+URL of the request that queued the job, or `FLASKY_MAIL_BASE_URL` outside requests.
+
+When the queue is full `send_email` blocks for up to `FLASKY_MAIL_QUEUE_TIMEOUT`
+seconds, so a burst of registrations slows down rather than piling up threads.
+'''
+from collections import deque
+import atexit
+import logging
+import os
+import smtplib
+import socket
+import threading
+import time
+import weakref
+
+from queue import Queue, Empty, Full
+
+from flask import current_app, has_request_context, request
 from flask_mail import Message
+from sqlalchemy import inspect
 
 from . import mail
+from .engine import WROTE_KEY
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+class MailQueueFull(RuntimeError):
+    '''Raised when a message could not be queued within the configured timeout.'''
+
+class _Reference(object):
+    '''A model instance in the context of a job, to be loaded again by the worker.'''
+
+    def __init__(self, model, id):
+        self.model = model
+        self.id = id
+
+def _dehydrate(context):
+    '''`context` with its persistent model instances replaced by references.'''
+    result = {}
+    for name, value in context.items():
+        if isinstance(value, db.Model) and inspect(value).persistent:
+            value = _Reference(type(value), inspect(value).identity[0])
+        result[name] = value
+    return result
+
+class EmailJob(object):
+    '''Messages to render from `template` and send to `recipients`, a list of
+    (address, context) pairs. The context of every message is `context` updated
+    with the one of its recipient.'''
+
+    def __init__(self, recipients, subject, template, context, base_url):
+        self.recipients = [(to, _dehydrate(own)) for to, own in recipients]
+        self.subject = subject
+        self.template = template
+        self.context = _dehydrate(context)
+        self.base_url = base_url
+
+    def load(self):
+        '''Load the referenced instances, one query per model, and return the
+        context of every recipient. Raises LookupError if some no longer exist.'''
+        contexts = [self.context] + [own for to, own in self.recipients]
+        ids = {}
+        for context in contexts:
+            for value in context.values():
+                if isinstance(value, _Reference):
+                    ids.setdefault(value.model, set()).add(value.id)
+        loaded = {}
+        for model, model_ids in ids.items():
+            for instance in model.query.filter(model.id.in_(model_ids)):
+                loaded[model, instance.id] = instance
+            missing = model_ids - set(id for kind, id in loaded if kind is model)
+            if missing:
+                raise LookupError('%s %s no longer exist' % (
+                    model.__name__, ', '.join(str(id) for id in sorted(missing))))
+        def resolve(context):
+            return dict((name, loaded[value.model, value.id]
+                         if isinstance(value, _Reference) else value)
+                        for name, value in context.items())
+        shared = resolve(self.context)
+        merged = []
+        for to, own in self.recipients:
+            context = dict(shared)
+            context.update(resolve(own))
+            merged.append((to, context))
+        return merged
+
+class _Worker(object):
+    '''The queue and the delivery thread of one application in one process.'''
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = Queue(maxsize=app.config['FLASKY_MAIL_QUEUE_SIZE'])
+        self.pid = os.getpid()
+        self.thread = None
+        self.connection = None
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rendered = 0
+        self.latencies = deque(maxlen=1000)
+        # Compiled templates by name, without the up-to-date checks of Jinja.
+        self.templates = {}
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='flasky-mail')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        config = self.app.config
+        with self.app.app_context():
+            while True:
+                try:
+                    item = self.queue.get(timeout=config['FLASKY_MAIL_IDLE_TIMEOUT'])
+                except Empty:
+                    # Nothing to send for a while, don't keep the server waiting.
+                    self.disconnect()
+                    continue
+                batch = [item]
+                while len(batch) < config['FLASKY_MAIL_BATCH_SIZE']:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Empty:
+                        break
+                stop = False
+                for item in batch:
+                    try:
+                        if item is None:
+                            stop = True
+                        elif isinstance(item[0], EmailJob):
+                            self.send_job(*item)
+                        else:
+                            self.deliver(*item)
+                    except Exception:
+                        self.failed += 1
+                        logger.exception('Unexpected error while sending mail')
+                    finally:
+                        self.queue.task_done()
+                # Don't keep the instances loaded by the jobs, nor a connection.
+                db.session.remove()
+                if stop:
+                    self.disconnect()
+                    return
+
+    def connect(self):
+        if self.connection is None:
+            connection = mail.connect()
+            connection.__enter__()
+            self.connection = connection
+        return self.connection
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+    def disconnect(self):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, socket.error):
+                pass
+
+    def template(self, name):
+        if name not in self.templates:
+            self.templates[name] = self.app.jinja_env.get_template(name)
+        return self.templates[name]
+
+    def render(self, job):
+        '''The messages of `job`.'''
+        config = self.app.config
+        text, html = self.template(job.template + '.txt'), \
+            self.template(job.template + '.html')
+        # Outside of the request context, which is a GET that `RoutingSession`
+        # would send to a replica that may not have the rows yet.
+        contexts = job.load()
+        messages = []
+        with self.app.test_request_context(base_url=job.base_url,
+                                           environ_overrides={WROTE_KEY: True}):
+            for to, context in contexts:
+                self.app.update_template_context(context)
+                msg = Message(config['FLASKY_MAIL_SUBJECT_PREFIX'] + ' ' + job.subject,
+                              sender=config['ADMIN'], recipients=[to])
+                msg.body = text.render(context)
+                msg.html = html.render(context)
+                messages.append(msg)
+        self.rendered += len(messages)
+        return messages
+
+    def send_job(self, job, enqueued):
+        try:
+            messages = self.render(job)
+        except Exception:
+            self.failed += len(job.recipients)
+            logger.exception('Could not render %s for %d recipients',
+                             job.template, len(job.recipients))
+            return
+        for msg in messages:
+            self.deliver(msg, enqueued)
+
+    def deliver(self, msg, enqueued):
+        config = self.app.config
+        attempt = 0
+        while True:
+            try:
+                self.connect().send(msg)
+            except (smtplib.SMTPException, socket.error) as e:
+                # The connection may be unusable now, start over with a fresh one.
+                self.disconnect()
+                if attempt >= config['FLASKY_MAIL_MAX_RETRIES']:
+                    self.failed += 1
+                    logger.error('Giving up on mail to %s after %d attempts: %s',
+                                 ', '.join(msg.recipients), attempt + 1, e)
+                    return
+                self.retried += 1
+                time.sleep(config['FLASKY_MAIL_RETRY_BACKOFF'] * 2 ** attempt)
+                attempt += 1
+            else:
+                self.sent += 1
+                self.latencies.append(time.time() - enqueued)
+                return
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_size': self.queue.maxsize,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'rendered': self.rendered,
+            'latency_p50': percentile(0.5),
+            'latency_p95': percentile(0.95),
+            'latency_max': latencies[-1] if latencies else None
+        }
+
+class MailDispatcher(object):
+    '''Flask extension owning the background mail queue of every application.'''
+
+    def __init__(self, app=None):
+        # One exit handler for the applications still alive, not one per application.
+        self.apps = weakref.WeakSet()
+        atexit.register(self.shutdown_all)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['mail_dispatcher'] = _Worker(app)
+        self.apps.add(app)
+
+    def _worker(self, app=None):
+        app = app or current_app._get_current_object()
+        worker = app.extensions['mail_dispatcher']
+        if worker.pid != os.getpid():
+            # Forked, e.g. by a gunicorn master that preloaded the app: threads
+            # don't survive a fork, start over with a queue of our own.
+            worker = app.extensions['mail_dispatcher'] = _Worker(app)
+        return worker
+
+    def send(self, msg):
+        '''Queue `msg`, a `Message` or an `EmailJob`, for delivery, blocking while
+        the queue is full.'''
+        worker = self._worker()
+        worker.start()
+        try:
+            worker.queue.put((msg, time.time()),
+                             timeout=current_app.config['FLASKY_MAIL_QUEUE_TIMEOUT'])
+        except Full:
+            raise MailQueueFull('mail queue is full')
+
+    def flush(self, app=None):
+        '''Wait until every queued message has been handled.'''
+        self._worker(app).queue.join()
+
+    def shutdown(self, app=None, timeout=10):
+        '''Deliver what is still queued and stop the worker.'''
+        worker = self._worker(app)
+        if worker.thread is None or not worker.thread.is_alive():
+            return
+        try:
+            worker.queue.put(None, timeout=timeout)
+        except Full:
+            return
+        worker.thread.join(timeout)
+
+    def shutdown_all(self, timeout=10):
+        '''Shut down the worker of every application.'''
+        for app in list(self.apps):
+            self.shutdown(app, timeout)
+
+    def metrics(self, app=None):
+        return self._worker(app).metrics()
+
+dispatcher = MailDispatcher()
+
+def _base_url():
+    if has_request_context():
+        return request.url_root
+    return current_app.config['FLASKY_MAIL_BASE_URL']
 
 def send_email(to, subject, template, **kwargs):
-    app = current_app._get_current_object()
-    msg = Message(app.config['FLASKY_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
-                  sender=app.config['ADMIN'], recipients=[to])
-    msg.body = render_template(template + '.txt', **kwargs)
-    msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
\ No newline at end of file
+    '''Queue the message rendered from `template` + '.txt' and '.html' with the
+    context `kwargs`.'''
+    job = EmailJob([(to, {})], subject, template, kwargs, _base_url())
+    dispatcher.send(job)
+    return job
+
+def send_bulk_email(recipients, subject, template, **kwargs):
+    '''Queue one message per recipient as a single job. `recipients` are users, who
+    get their own `user` in the context, or (address, context) pairs; the context
+    of every message is `kwargs` updated with the one of its recipient.'''
+    pairs = []
+    for recipient in recipients:
+        if isinstance(recipient, tuple):
+            pairs.append(recipient)
+        else:
+            pairs.append((recipient.email, {'user': recipient}))
+    if not pairs:
+        return None
+    job = EmailJob(pairs, subject, template, kwargs, _base_url())
+    dispatcher.send(job)
+    return job
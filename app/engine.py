@@ -0,0 +1,223 @@
+'''Database engine profiles.
+
+`FLASKY_DB_PROFILE` picks how the engine of the application is tuned. The default,
+`'auto'`, chooses from the database URL:
+
+* `'sqlite'` keeps a small pool of connections open, with every connection in WAL
+  mode, so that readers no longer wait for the writer of another gunicorn worker,
+  `synchronous=NORMAL`, which is safe with WAL, a `busy_timeout` so that writers
+  queue up instead of failing with "database is locked", and memory-mapped reads;
+* `'postgres'` splits `FLASKY_DB_MAX_CONNECTIONS` between the
+  `FLASKY_DB_WORKERS` processes of the host, tests every connection before handing
+  it out, so that connections dropped by the server or a proxy are replaced, and
+  sets a `statement_timeout` on every session.
+
+`None` leaves the engine as Flask-SQLAlchemy makes it. In-memory SQLite databases
+are never tuned. Explicit `SQLALCHEMY_POOL_*` settings always win.
+
+Both profiles use `MeteredQueuePool`, which measures how long checkouts wait for a
+connection; `pool_metrics()` reports it, along with the state of the pool.
+'''
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+
+import flask_sqlalchemy
+from flask import has_request_context, request
+from sqlalchemy import event, exc, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import Select
+
+# Where the WSGI environment of a request keeps the replica it reads from, whether
+# it wrote anything, and how many `primary()` blocks it is in.
+REPLICA_KEY = 'flasky.replica'
+WROTE_KEY = 'flasky.wrote'
+PRIMARY_KEY = 'flasky.primary'
+
+class PoolMetrics(object):
+    '''Checkout waits of one pool, in this process.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait, timeout=False):
+        with self.lock:
+            self.checkouts += 1
+            self.timeouts += timeout
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_total': self.wait_total,
+                'wait_mean': self.wait_total / self.checkouts if self.checkouts else 0.0,
+                'wait_max': self.wait_max
+            }
+
+class MeteredQueuePool(QueuePool):
+    '''A `QueuePool` that records how long it takes to get a connection out of it,
+    runs `session_statements` on every new connection and, with `pre_ping`, tests
+    connections on checkout.
+
+    Use `configured()` to get a subclass with those set.'''
+
+    session_statements = ()
+    pre_ping = False
+
+    @classmethod
+    def configured(cls, session_statements=(), pre_ping=False):
+        return type(cls.__name__, (cls,), {'session_statements': tuple(session_statements),
+                                           'pre_ping': pre_ping})
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self.metrics = PoolMetrics()
+        if self.session_statements:
+            event.listen(self, 'connect', self.on_connect)
+        if self.pre_ping:
+            event.listen(self, 'checkout', self.on_checkout)
+
+    def _do_get(self):
+        start = default_timer()
+        try:
+            connection = QueuePool._do_get(self)
+        except exc.TimeoutError:
+            self.metrics.record(default_timer() - start, timeout=True)
+            raise
+        self.metrics.record(default_timer() - start)
+        return connection
+
+    def on_connect(self, dbapi_connection, connection_record):
+        # psycopg2 opens a transaction for any statement, and the rollback that ends
+        # every checkout would undo the settings; run them in autocommit mode.
+        autocommit = getattr(dbapi_connection, 'autocommit', None)
+        if autocommit is False:
+            dbapi_connection.autocommit = True
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in self.session_statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+            if autocommit is False:
+                dbapi_connection.autocommit = False
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        # SQLAlchemy 1.1 has no `pool_pre_ping`; raising DisconnectionError makes the
+        # pool throw this connection away and retry with a fresh one.
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+        except Exception:
+            raise exc.DisconnectionError()
+
+def backend_profile(app, info):
+    '''The profile to apply to the database at `info`, a SQLAlchemy URL.'''
+    profile = app.config['FLASKY_DB_PROFILE']
+    if profile != 'auto':
+        return profile
+    backend = info.drivername.split('+')[0]
+    if backend == 'sqlite':
+        return 'sqlite'
+    if backend in ('postgres', 'postgresql'):
+        return 'postgres'
+    return None
+
+def sqlite_options(app, options):
+    config = app.config
+    options.setdefault('pool_size', config['FLASKY_SQLITE_POOL_SIZE'])
+    options.setdefault('max_overflow', config['FLASKY_SQLITE_MAX_OVERFLOW'])
+    options.setdefault('pool_timeout', config['FLASKY_DB_POOL_TIMEOUT'])
+    # Pooled connections are handed from thread to thread, one at a time.
+    options.setdefault('connect_args', {})['check_same_thread'] = False
+    options['poolclass'] = MeteredQueuePool.configured([
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA busy_timeout=%d' % config['FLASKY_SQLITE_BUSY_TIMEOUT'],
+        'PRAGMA mmap_size=%d' % config['FLASKY_SQLITE_MMAP_SIZE']])
+
+def postgres_options(app, options):
+    config = app.config
+    pool_size = config['FLASKY_DB_POOL_SIZE'] or \
+        max(1, config['FLASKY_DB_MAX_CONNECTIONS'] // config['FLASKY_DB_WORKERS'])
+    options.setdefault('pool_size', pool_size)
+    # No overflow, so that all the workers together stay within the budget.
+    options.setdefault('max_overflow', 0)
+    options.setdefault('pool_timeout', config['FLASKY_DB_POOL_TIMEOUT'])
+    options.setdefault('pool_recycle', config['FLASKY_DB_POOL_RECYCLE'])
+    options['poolclass'] = MeteredQueuePool.configured(
+        ['SET statement_timeout = %d' % config['FLASKY_DB_STATEMENT_TIMEOUT']],
+        pre_ping=True)
+
+class RoutingSession(flask_sqlalchemy.SignallingSession):
+    '''Sends the SELECT statements of a request to the replica picked for it by
+    `app.replicas`, unless the request has written something.'''
+
+    def get_bind(self, mapper=None, clause=None):
+        replica_set = self.app.extensions.get('replicas')
+        table = getattr(mapper, 'mapped_table', None)
+        if replica_set is not None and isinstance(clause, Select) and \
+                not self._flushing and has_request_context() and \
+                getattr(table, 'info', {}).get('bind_key') is None:
+            environ = request.environ
+            if not environ.get(WROTE_KEY) and not environ.get(PRIMARY_KEY):
+                if REPLICA_KEY not in environ:
+                    environ[REPLICA_KEY] = replica_set.pick()
+                if environ[REPLICA_KEY] is not None:
+                    return environ[REPLICA_KEY]
+        return flask_sqlalchemy.SignallingSession.get_bind(self, mapper, clause)
+
+def read_replica():
+    '''Whether the current request reads from a replica. What it reads may lag
+    behind the primary and must not be cached.'''
+    return has_request_context() and request.environ.get(REPLICA_KEY) is not None
+
+@contextmanager
+def primary():
+    '''Send the reads of the block to the primary, for data that gets cached.'''
+    if not has_request_context():
+        yield
+        return
+    environ = request.environ
+    environ[PRIMARY_KEY] = environ.get(PRIMARY_KEY, 0) + 1
+    try:
+        yield
+    finally:
+        environ[PRIMARY_KEY] -= 1
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    '''Flask-SQLAlchemy, with the engine tuned by the profile of the application
+    and `RoutingSession` for sessions.'''
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        flask_sqlalchemy.SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        profile = backend_profile(app, info)
+        if profile == 'sqlite':
+            if info.database not in (None, '', ':memory:'):
+                sqlite_options(app, options)
+        elif profile == 'postgres':
+            postgres_options(app, options)
+        elif profile is not None:
+            raise ValueError('unknown database profile %r' % profile)
+
+def pool_metrics(engine):
+    '''The checkout waits and the state of the pool of `engine`, None if the pool
+    isn't metered.'''
+    pool = engine.pool
+    if not isinstance(pool, MeteredQueuePool):
+        return None
+    metrics = pool.metrics.snapshot()
+    metrics.update(size=pool.size(), checked_out=pool.checkedout(),
+                   overflow=pool.overflow())
+    return metrics
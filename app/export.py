@@ -0,0 +1,85 @@
+'''Bulk export of posts, comments and follows as newline-delimited JSON.
+
+Every line is one JSON object with a `type` of 'post', 'comment' or 'follow' and
+the columns of the row. Rows are read in primary key order through `yield_per()`,
+which asks the driver for a server-side cursor where it has one, and serialized one
+at a time, so exporting a table of any size takes the same amount of memory.
+'''
+import json
+from datetime import datetime
+
+from .exceptions import ValidationError
+from .models import db, Post, Comment, Follow
+
+KINDS = ('posts', 'comments', 'follows')
+
+TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+def parse_timestamp(value):
+    '''Parse an ISO 8601 date, or UTC date and time, as written by the export.'''
+    for format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValidationError('invalid timestamp %r' % value)
+
+def parse_kinds(value):
+    kinds = [kind.strip() for kind in value.split(',') if kind.strip()]
+    for kind in kinds:
+        if kind not in KINDS:
+            raise ValidationError('unknown export type %r' % kind)
+    return kinds
+
+def _rows(query, batch_size):
+    for row in query.yield_per(batch_size):
+        yield row._asdict()
+
+def export_records(kinds=KINDS, author=None, since=None, batch_size=1000):
+    '''Yield the rows of `kinds` as dictionaries.
+
+    `author` restricts posts and comments to those written by that user id, and
+    follows to those made by that user. `since` restricts every kind to the rows
+    created at or after that time.
+    '''
+    if 'posts' in kinds:
+        query = db.session.query(Post.id, Post.author_id, Post.timestamp, Post.body) \
+            .order_by(Post.id)
+        if author is not None:
+            query = query.filter(Post.author_id==author)
+        if since is not None:
+            query = query.filter(Post.timestamp>=since)
+        for row in _rows(query, batch_size):
+            row['type'] = 'post'
+            yield row
+    if 'comments' in kinds:
+        query = db.session.query(Comment.id, Comment.post_id, Comment.author_id,
+                                 Comment.timestamp, Comment.disabled, Comment.body) \
+            .order_by(Comment.id)
+        if author is not None:
+            query = query.filter(Comment.author_id==author)
+        if since is not None:
+            query = query.filter(Comment.timestamp>=since)
+        for row in _rows(query, batch_size):
+            row['type'] = 'comment'
+            yield row
+    if 'follows' in kinds:
+        query = db.session.query(Follow.follower_id, Follow.followed_id, Follow.timestamp) \
+            .order_by(Follow.follower_id, Follow.followed_id)
+        if author is not None:
+            query = query.filter(Follow.follower_id==author)
+        if since is not None:
+            query = query.filter(Follow.timestamp>=since)
+        for row in _rows(query, batch_size):
+            row['type'] = 'follow'
+            yield row
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+def ndjson(records):
+    '''Serialize records to lines of JSON.'''
+    for record in records:
+        yield json.dumps(record, default=_default, sort_keys=True) + '\n'
@@ -0,0 +1,114 @@
+'''Template caching.
+
+Compiled templates are stored as bytecode in `FLASKY_TEMPLATE_BYTECODE_DIR`, which
+every process of the host shares, so that gunicorn workers load `base.html`,
+`_macros.html` and `_posts.html` from there instead of compiling them again when
+they start. Jinja recompiles a template whenever its source changes.
+
+Parts of a template can also be cached with the `{% cache %}` tag:
+
+    {% cache post.id, post.version, viewer %}
+        ...
+    {% endcache %}
+
+The rendered block is kept in a LRU cache of `FLASKY_FRAGMENT_CACHE_SIZE` entries,
+private to the process, for at most `FLASKY_FRAGMENT_CACHE_TTL` seconds. It is keyed
+by the template, the line of the tag and the values given to it. Entries are never
+invalidated: the values must change whenever the block would render differently,
+typically by including the `version` of the rows it shows, which `RowVersion`
+increments on every change. Stale entries are then never read again and age out.
+
+Code that reuses ids with fresh versions, e.g. by recreating the tables, must call
+`fragment_cache.clear()`. It bumps a generation kept as the `fragments` tag of the
+response cache, which is part of every key and read once per request, so that with
+the `'sqlite'` response cache every process of the host stops using its entries,
+not only the one calling it, e.g. `manage.py seed`.
+'''
+import os
+import tempfile
+
+from flask import current_app, g
+from jinja2 import nodes
+from jinja2.bccache import FileSystemBytecodeCache
+from jinja2.ext import Extension
+
+from .cache import LRUCache
+from .engine import read_replica
+from .response_cache import response_cache
+
+GENERATION_TAG = 'fragments'
+
+class SharedBytecodeCache(FileSystemBytecodeCache):
+    '''A `FileSystemBytecodeCache` writing every file atomically, so that other
+    processes never load a half-written one.'''
+
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.rename(path, filename)
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+class FragmentCacheExtension(Extension):
+    '''The `{% cache key, ... %}...{% endcache %}` tag.'''
+
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [nodes.Const('%s:%d' % (parser.name, lineno))]
+        while parser.stream.current.type != 'block_end':
+            if len(key) > 1:
+                parser.stream.expect('comma')
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(key)]),
+                               [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        cache = current_app.extensions.get('fragment_cache')
+        if cache is None:
+            return caller()
+        if 'fragment_generation' not in g:
+            g.fragment_generation = response_cache.version(GENERATION_TAG)
+        key = (g.fragment_generation,) + tuple(key)
+        fragment = cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            if not read_replica():
+                cache.set(key, fragment, current_app.config['FLASKY_FRAGMENT_CACHE_TTL'])
+        return fragment
+
+class FragmentCache(object):
+    '''Flask extension installing the bytecode cache and the `{% cache %}` tag.'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        directory = app.config['FLASKY_TEMPLATE_BYTECODE_DIR']
+        if directory:
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Made meanwhile by another worker.
+                if not os.path.isdir(directory):
+                    raise
+            app.jinja_env.bytecode_cache = SharedBytecodeCache(directory)
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        size = app.config['FLASKY_FRAGMENT_CACHE_SIZE']
+        app.extensions['fragment_cache'] = LRUCache(size) if size else None
+
+    def clear(self, app=None):
+        cache = (app or current_app).extensions.get('fragment_cache')
+        if cache is not None:
+            cache.clear()
+        response_cache.invalidate([GENERATION_TAG], app)
+
+fragment_cache = FragmentCache()
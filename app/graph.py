@@ -0,0 +1,137 @@
+'''Maintenance of the follow graph.
+
+Every operation here is a handful of set-based statements, run over ranges of
+`batch_size` user ids when it touches every user so that no single transaction
+grows with the size of the users table. The chunked operations are generators
+yielding the number of rows changed and the last user id of every committed
+chunk, like `rerender_stale()`.
+
+They all write around the ORM, so the derived data they affect (timelines and the
+follower counters) is repaired by the same operation, the rows whose counters
+change get their version bumped and the response cache is cleared.
+'''
+from datetime import datetime
+
+from .models import db, User, Post, Follow, Timeline, RowVersion
+from .response_cache import response_cache
+
+def _id_ranges(batch_size):
+    first, last = db.session.query(db.func.min(User.id), db.func.max(User.id)).one()
+    if first is None:
+        return
+    for start in range(first, last + 1, batch_size):
+        yield start, min(start + batch_size - 1, last)
+
+def _recount_range(connection, first, last):
+    users = User.__table__
+    follows = Follow.__table__
+    repaired = 0
+    for column, key in ((users.c.follower_count, follows.c.followed_id),
+                        (users.c.followed_count, follows.c.follower_id)):
+        count = db.select([db.func.count()]).where(key==users.c.id).as_scalar()
+        values = RowVersion.bump(users)
+        values[column.name] = count
+        repaired += connection.execute(users.update()
+            .where(users.c.id.between(first, last))
+            .where(column!=count)
+            .values(values)).rowcount
+    return repaired
+
+def ensure_self_follows(batch_size=1000):
+    '''Make every user follow themselves, which is how their own posts end up in
+    their timeline, and backfill those timelines.'''
+    users = User.__table__
+    follows = Follow.__table__
+    posts = Post.__table__
+    timelines = Timeline.__table__
+    now = datetime.utcnow()
+    inserted_any = False
+    for first, last in _id_ranges(batch_size):
+        connection = db.session.connection()
+        missing = db.select([
+            users.c.id.label('follower_id'),
+            users.c.id.label('followed_id'),
+            db.literal(now, db.DateTime)
+        ]).where(users.c.id.between(first, last)).where(~db.exists().where(db.and_(
+            follows.c.follower_id==users.c.id, follows.c.followed_id==users.c.id)))
+        inserted = connection.execute(follows.insert().from_select(
+            ['follower_id', 'followed_id', 'timestamp'], missing)).rowcount
+        if inserted:
+            inserted_any = True
+            own_posts = db.select([
+                posts.c.author_id.label('user_id'),
+                posts.c.id,
+                posts.c.author_id,
+                posts.c.timestamp
+            ]).where(posts.c.author_id.between(first, last)).where(~db.exists().where(
+                db.and_(timelines.c.user_id==posts.c.author_id,
+                        timelines.c.post_id==posts.c.id)))
+            connection.execute(timelines.insert().from_select(
+                ['user_id', 'post_id', 'author_id', 'timestamp'], own_posts))
+            _recount_range(connection, first, last)
+        db.session.commit()
+        yield inserted, last
+    if inserted_any:
+        Timeline.trim_all()
+        response_cache.clear()
+
+def recount_follows(batch_size=1000):
+    '''Repair the follower and followed counters of every user.'''
+    repaired_any = False
+    for first, last in _id_ranges(batch_size):
+        repaired = _recount_range(db.session.connection(), first, last)
+        db.session.commit()
+        repaired_any = repaired_any or repaired > 0
+        yield repaired, last
+    if repaired_any:
+        response_cache.clear()
+
+def dedupe_follows():
+    '''Collapse repeated (follower, followed) pairs into the oldest of them.
+
+    The primary key of `follows` rules them out, but tables restored from dumps or
+    created by hand without it may have them. Returns the number of rows removed.
+    '''
+    follows = Follow.__table__
+    connection = db.session.connection()
+    duplicates = connection.execute(
+        db.select([follows.c.follower_id, follows.c.followed_id,
+                   db.func.min(follows.c.timestamp), db.func.count()])
+            .group_by(follows.c.follower_id, follows.c.followed_id)
+            .having(db.func.count() > 1)).fetchall()
+    removed = 0
+    for follower_id, followed_id, timestamp, count in duplicates:
+        connection.execute(follows.delete().where(db.and_(
+            follows.c.follower_id==follower_id, follows.c.followed_id==followed_id)))
+        connection.execute(follows.insert().values(
+            follower_id=follower_id, followed_id=followed_id, timestamp=timestamp))
+        removed += count - 1
+    db.session.commit()
+    if duplicates:
+        for repaired, last in recount_follows():
+            pass
+    return removed
+
+def purge_orphans():
+    '''Delete the follows and timeline entries that point at users or posts that no
+    longer exist. Returns the number of rows deleted per table.'''
+    users = User.__table__
+    follows = Follow.__table__
+    timelines = Timeline.__table__
+    user_ids = db.select([users.c.id])
+    post_ids = db.select([Post.__table__.c.id])
+    connection = db.session.connection()
+    deleted = {
+        'follows': connection.execute(follows.delete().where(db.or_(
+            ~follows.c.follower_id.in_(user_ids),
+            ~follows.c.followed_id.in_(user_ids)))).rowcount,
+        'timelines': connection.execute(timelines.delete().where(db.or_(
+            ~timelines.c.user_id.in_(user_ids),
+            ~timelines.c.author_id.in_(user_ids),
+            ~timelines.c.post_id.in_(post_ids)))).rowcount
+    }
+    db.session.commit()
+    if deleted['follows']:
+        for repaired, last in recount_follows():
+            pass
+    return deleted
@@ -0,0 +1,133 @@
+'''Write-behind recording of `User.last_seen`.
+
+`last_seen` is only shown to the minute, yet it used to be written with a commit of
+its own on every request. `recorder.record()` keeps the time a user was seen in
+memory instead, and a background thread per process writes everything it collected
+with a single bulk `UPDATE` every `FLASKY_LAST_SEEN_FLUSH_INTERVAL` seconds, or
+earlier once `FLASKY_LAST_SEEN_BATCH_SIZE` users are waiting. A user seen again
+within `FLASKY_LAST_SEEN_RESOLUTION` seconds of the last recorded time is not
+recorded at all.
+
+What is still buffered is written when the process exits.
+'''
+import atexit
+import logging
+import os
+import threading
+import weakref
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import bindparam
+
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+class _Buffer(object):
+    '''The pending updates and the flushing thread of one application in one process.'''
+
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self.pending = {}
+        # When each user was last recorded, to skip the ones seen a moment ago.
+        self.recent = LRUCache(maxsize=app.config['FLASKY_LAST_SEEN_CACHE_SIZE'])
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.flushed = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='flasky-last-seen')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.app.config['FLASKY_LAST_SEEN_FLUSH_INTERVAL'])
+            self.wakeup.clear()
+            self.flush()
+
+    def record(self, user_id, when):
+        resolution = timedelta(seconds=self.app.config['FLASKY_LAST_SEEN_RESOLUTION'])
+        previous = self.recent.get(user_id)
+        if previous is not None and when - previous < resolution:
+            return False
+        self.recent.set(user_id, when)
+        with self.lock:
+            self.pending[user_id] = when
+            full = len(self.pending) >= self.app.config['FLASKY_LAST_SEEN_BATCH_SIZE']
+        self.start()
+        if full:
+            self.wakeup.set()
+        return True
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return 0
+        from .models import db, User, RowVersion
+        table = User.__table__
+        values = RowVersion.bump(table)
+        values['last_seen'] = bindparam('seen')
+        statement = table.update() \
+            .where(table.c.id==bindparam('user_id')) \
+            .values(values)
+        try:
+            with self.app.app_context(), db.get_engine(self.app).begin() as connection:
+                connection.execute(statement, [{'user_id': user_id, 'seen': seen}
+                                               for user_id, seen in batch.items()])
+        except Exception:
+            logger.exception('Could not record last seen times of %d users', len(batch))
+            # Try again with the next batch, unless the user has been seen since.
+            with self.lock:
+                for user_id, seen in batch.items():
+                    self.pending.setdefault(user_id, seen)
+            return 0
+        self.flushed += len(batch)
+        return len(batch)
+
+class LastSeenRecorder(object):
+    '''Flask extension buffering `last_seen` updates of every application.'''
+
+    def __init__(self, app=None):
+        # One exit handler for the applications still alive, not one per application.
+        self.apps = weakref.WeakSet()
+        atexit.register(self.flush_all)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['last_seen'] = _Buffer(app)
+        self.apps.add(app)
+
+    def _buffer(self, app=None):
+        app = app or current_app._get_current_object()
+        buffer = app.extensions['last_seen']
+        if buffer.pid != os.getpid():
+            # Forked: the thread is gone, and the parent writes what it buffered.
+            buffer = app.extensions['last_seen'] = _Buffer(app)
+        return buffer
+
+    def record(self, user_id, when):
+        '''Buffer that `user_id` was seen at `when`. Returns False if the user was
+        already recorded less than `FLASKY_LAST_SEEN_RESOLUTION` seconds before.'''
+        return self._buffer().record(user_id, when)
+
+    def flush(self, app=None):
+        '''Write the buffered times now, returns how many users were updated.'''
+        return self._buffer(app).flush()
+
+    def flush_all(self):
+        '''Write the buffered times of every application.'''
+        for app in list(self.apps):
+            self.flush(app)
+
+    def pending(self, app=None):
+        return len(self._buffer(app).pending)
+
+recorder = LastSeenRecorder()
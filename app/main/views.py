@@ -1,22 +1,66 @@
-from flask import render_template, redirect, flash, url_for, request, current_app
+from flask import render_template, redirect, flash, url_for, request, current_app, \
+    jsonify, abort, send_file, g
 from flask_login import login_required, current_user
 from flask_sqlalchemy import get_debug_queries
 
 from . import main
-from ..models import User, db, Role, Permission, Post, Follow, Comment
+from ..models import User, db, Role, Permission, Post, Follow, Comment, Timeline
+from ..pagination import keyset_paginate
 from ..decorators import permission_required, admin_required
+from ..db_metrics import request_metrics, server_timing, endpoint_stats
+from ..engine import pool_metrics
+from ..avatars import avatar_file
+from ..email import dispatcher
+from ..response_cache import response_cache, add_tags
+from ..search import search as search_index
+from ..exceptions import ValidationError
 from .forms import EditProfileForm, EditProfileAdminForm, PostForm, CommentForm
 
+def show_server_timing():
+    '''Whether the database metrics of the request are sent back in a
+    `Server-Timing` header: to administrators, in debug mode and to the benchmark.'''
+    if current_app.debug or current_app.config['FLASKY_SERVER_TIMING']:
+        return True
+    # Pages authenticate through the session, API requests on their own.
+    users = [current_user, getattr(g, 'current_user', None)]
+    return any(user is not None and user.is_administrator() for user in users)
+
 @main.after_app_request
 def after_request(response):
-    '''Log queries that are slower than a configured threshold.'''
-    for query in get_debug_queries():
+    '''Log queries that are slower than a configured threshold, and record the
+    database metrics of the request.'''
+    queries = get_debug_queries()
+    for query in queries:
         if query.duration >= current_app.config['FLASKY_SLOW_DB_QUERY_TIME']:
             current_app.logger.warning(
                 'Slow query: %s\nParameters: %s\nDuration: %fs\nContext: %s\n' %
                     (query.statement, query.parameters, query.duration, query.context))
+    if current_app.config['FLASKY_DB_METRICS']:
+        metrics = request_metrics(
+            queries, top=current_app.config['FLASKY_DB_METRICS_TOP'],
+            duplicate_threshold=current_app.config['FLASKY_DB_DUPLICATE_THRESHOLD'])
+        endpoint_stats.record(request.endpoint or '<unmatched>', metrics)
+        if show_server_timing():
+            response.headers.add('Server-Timing', server_timing(metrics))
+        for duplicate in metrics['duplicates']:
+            current_app.logger.warning(
+                'Repeated query (possible N+1) in %s: %s\nExecutions: %d\nDuration: %fs\n' %
+                    (request.endpoint, duplicate['statement'], duplicate['count'],
+                     duplicate['duration']))
     return response
 
+@main.route('/metrics')
+@login_required
+@admin_required
+def metrics():
+    '''Database metrics aggregated per endpoint, the connection pool and the state
+    of the mail queue, for the requests served by this process.'''
+    return jsonify({
+        'db': endpoint_stats.snapshot(current_app.config['FLASKY_DB_METRICS_TOP']),
+        'pool': pool_metrics(db.engine),
+        'mail': dispatcher.metrics()
+    })
+
 @main.route('/', methods=['GET', 'POST'])
 @main.route('/index', methods=['GET', 'POST'])
 @login_required
@@ -33,18 +77,33 @@ def index():
         db.session.commit()
         return redirect(url_for('main.index'))
 
-    # The page number to render is obrained from the request's query string, which
-    # is available as `request.args`. When an explicit page isn't given, a default
-    # page of 1(the first page) is used. The `type=int` argument ensures that if the 
-    # argument cannot be converted to an integer, the default value is returned.
-    page = request.args.get('page', 1, type=int)
-    pagination = (current_user.followed_posts.order_by(Post.timestamp.desc()).
-        paginate(page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'], 
-                 error_out=False))
+    # The page to render is identified by an opaque cursor obtained from the request's
+    # query string, which is available as `request.args`. When no cursor is given the
+    # first page is rendered. The cursor remembers where the previous page ended, so
+    # the database can seek straight to the next rows instead of counting past them.
+    pagination = keyset_paginate(
+        current_user.followed_posts.load_profile('feed'),
+        (Timeline.timestamp, Timeline.post_id),
+        request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
+        key=lambda post: (post.timestamp, post.id))
     posts = pagination.items
     return render_template('main/index.html', form=form, 
                            posts=posts, pagination=pagination)
 
+@main.route('/avatars/<int:size>/<digest>.png')
+def avatar(size, digest):
+    '''Identicons, usually served by nginx once they have been rendered.'''
+    try:
+        path = avatar_file(digest, size)
+    except ValueError:
+        abort(404)
+    max_age = current_app.config['FLASKY_AVATAR_MAX_AGE']
+    response = send_file(path, mimetype='image/png', conditional=True,
+                         cache_timeout=max_age)
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % max_age
+    return response
+
 @main.route('/user/<username>')
 @login_required
 def user(username):
@@ -52,10 +111,10 @@ def user(username):
     if user is None:
         flash('User %s is not found.' % username)
         abort(404)
-    page = request.args.get('page', 1, type=int)
-    pagination = (Post.query.filter_by(author=user).order_by(Post.timestamp.desc()).
-        paginate(page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'], 
-                 error_out=False))
+    pagination = keyset_paginate(
+        Post.query.filter_by(author=user).load_profile('feed'), (Post.timestamp, Post.id),
+        request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
     posts = pagination.items
     return render_template('main/user.html', user=user, 
                             posts=posts, pagination=pagination)
@@ -121,8 +180,10 @@ def edit(id):
     return render_template('main/edit_post.html', form=form)
 
 @main.route('/post/<int:id>', methods=['GET', 'POST'])
+@response_cache.cached('post:{id}', 'post:{id}:comments', anonymous_only=True)
 def post(id):
-    post = Post.query.get_or_404(id)
+    post = Post.query.load_profile('post_detail').get_or_404(id)
+    form = None
     if current_user.can(Permission.COMMENT):
         form = CommentForm()
         if form.validate_on_submit():
@@ -131,16 +192,28 @@ def post(id):
                 db.session.add(comment)
                 db.session.commit()
                 return redirect(url_for('main.post', id=post.id))
-    page = request.args.get('page', 1, type=int)
-    '''if page == -1:
-        page = (post.comments.count() - 1) / current_app \
-            .config['FLASKY_COMMENTS_PER_PAGE']'''
-    pagination = post.comments.order_by(Comment.timestamp.desc()).paginate(page, 
-        per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'], error_out=False)
+    pagination = keyset_paginate(
+        post.comments.load_profile('post_detail'), (Comment.timestamp, Comment.id),
+        request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'])
     comments = pagination.items
     return render_template('main/post.html', posts=[post], 
         form=form, comments=comments, pagination=pagination)
 
+@main.route('/search')
+@response_cache.cached('posts', 'comments', anonymous_only=True)
+def search():
+    query = request.args.get('q', '')
+    try:
+        pagination = search_index(
+            query, request.args.get('cursor'),
+            per_page=current_app.config['FLASKY_SEARCH_RESULTS_PER_PAGE'])
+    except ValidationError:
+        # Nothing was searched for, or the cursor was tampered with.
+        pagination = None
+    return render_template('main/search.html', query=query, pagination=pagination,
+                           results=pagination.items if pagination else [])
+
 @main.route('/follow/<username>')
 @login_required
 @permission_required(Permission.FOLLOW)
@@ -172,14 +245,17 @@ def unfollow(username):
     return redirect(url_for('main.user', username=username))
 
 @main.route('/followers/<username>')
+@response_cache.cached(anonymous_only=True)
 def followers(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
         flash('Not found user %s' % username)
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followers.order_by(Follow.timestamp.desc()).paginate( \
-        page, per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'], error_out=False)
+    add_tags('user:%d:followers' % user.id)
+    pagination = keyset_paginate(
+        user.followers, (Follow.timestamp, Follow.follower_id),
+        request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'])
     follows = [{'user': item.follower, 'timestamp': item.timestamp}
                  for item in pagination.items]
     return render_template('main/followers.html', follows=follows, user=user,
@@ -187,14 +263,17 @@ def followers(username):
                            title='Followers of')
 
 @main.route('/followed_by/<username>')
+@response_cache.cached(anonymous_only=True)
 def followed_by(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
         flash('Not found user %s' % username)
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followed.order_by(Follow.timestamp.desc()).paginate(page, 
-        per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'], error_out=False)
+    add_tags('user:%d:followed' % user.id)
+    pagination = keyset_paginate(
+        user.followed, (Follow.timestamp, Follow.followed_id),
+        request.args.get('cursor'),
+        per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'])
     follows = [{'user': item.followed, 'timestamp': item.timestamp}
                  for item in pagination.items]
     return render_template('main/followers.html', follows=follows, user=user,
@@ -205,13 +284,13 @@ def followed_by(username):
 @login_required
 @permission_required(Permission.MODERATE_COMMENTS)
 def moderate():
-    page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-        error_out=False)
+    cursor = request.args.get('cursor')
+    pagination = keyset_paginate(
+        Comment.query.load_profile('moderation'), (Comment.timestamp, Comment.id), cursor,
+        per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'])
     comments = pagination.items
     return render_template('main/moderate.html', comments=comments,
-                           pagination=pagination, page=page)
+                           pagination=pagination, cursor=cursor)
 
 @main.route('/moderate/enable/<int:id>')
 @login_required
@@ -221,8 +300,7 @@ def moderate_enable(id):
     comment.disabled = False
     db.session.add(comment)
     db.session.commit()
-    return redirect(url_for('main.moderate', 
-                            page=request.args.get('get', 1, type=int)))
+    return redirect(url_for('main.moderate', cursor=request.args.get('cursor')))
 
 @main.route('/moderate/disable/<int:id>')
 @login_required
@@ -233,9 +311,8 @@ def moderate_disable(id):
     db.session.add(comment)
     db.session.commit()
     
-    # the `page` argument is necessary for returning to the page that the comment is on.
-    return redirect(url_for('main.moderate', 
-                            page=request.args.get('get', 1, type=int)))
+    # the `cursor` argument is necessary for returning to the page that the comment is on.
+    return redirect(url_for('main.moderate', cursor=request.args.get('cursor')))
 
 @main.route('/shutdown')
 def server_shutdown():
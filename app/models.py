@@ -2,17 +2,35 @@ from datetime import datetime
 import hashlib
 
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from flask_login import UserMixin, AnonymousUserMixin
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from flask import current_app, request, url_for
-from markdown import markdown
-import bleach
-
+from flask import current_app, request
 from . import login_manager
+from .engine import SQLAlchemy, primary
 from .exceptions import ValidationError
+from .render import render_into
+from .cache import LRUCache
+from .last_seen import recorder
+from .urls import url_template
+from .avatars import avatar_url
+
+class Query(BaseQuery):
+    '''Query class of every model and dynamic relationship.'''
 
-db = SQLAlchemy()
+    def load_profile(self, name):
+        '''Apply the eager-loading strategy registered as `name` in `LOADING_PROFILES`.
+
+        A page that shows a field of a related object for every row, like the author
+        of each post, would otherwise lazy-load that object once per row.
+        '''
+        entity = self.column_descriptions[0]['entity']
+        return self.options(*[db.joinedload(getattr(entity, attr))
+                              for attr in LOADING_PROFILES[name][entity]])
+
+db = SQLAlchemy(query_class=Query)
 
 class Permission:
     FOLLOW = 0x01
@@ -27,6 +45,144 @@ class Follow(db.Model):
     followed_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+class Timeline(db.Model):
+    '''Precomputed home timeline, one row per (reader, post).
+
+    Instead of joining `posts` to `follows` every time a feed is rendered, a new post
+    is fanned out to the timeline of every follower of its author when it is written.
+    Following a user backfills their latest posts, unfollowing removes them again, and
+    every timeline is trimmed to `FLASKY_TIMELINE_LENGTH` entries so reads stay bounded.
+
+    `author_id` and `timestamp` are copied from the post so that unfollowing and
+    sorting never need to touch the `posts` table.
+    '''
+    __tablename__ = 'timelines'
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    timestamp = db.Column(db.DateTime)
+
+    @staticmethod
+    def fan_out(connection, post):
+        '''Push a newly written post to the timeline of every follower of its author.'''
+        table = Timeline.__table__
+        followers = db.select([
+            Follow.follower_id,
+            db.literal(post.id, db.Integer),
+            db.literal(post.author_id, db.Integer),
+            db.literal(post.timestamp, db.DateTime)
+        ]).where(Follow.followed_id==post.author_id)
+        connection.execute(table.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'], followers))
+
+    @staticmethod
+    def backfill(connection, user_id, author_id):
+        '''Copy the latest posts of `author_id` into the timeline of `user_id`.'''
+        table = Timeline.__table__
+        posts = db.select([
+            db.literal(user_id, db.Integer),
+            Post.id,
+            Post.author_id,
+            Post.timestamp
+        ]).where(Post.author_id==author_id) \
+            .order_by(Post.timestamp.desc()) \
+            .limit(current_app.config['FLASKY_TIMELINE_LENGTH'])
+        connection.execute(table.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'], posts))
+        Timeline.trim(connection, user_id)
+
+    @staticmethod
+    def remove(connection, user_id, author_id):
+        '''Drop every post of `author_id` from the timeline of `user_id`.'''
+        table = Timeline.__table__
+        connection.execute(table.delete().where(db.and_(
+            table.c.user_id==user_id, table.c.author_id==author_id)))
+
+    @staticmethod
+    def trim(connection, user_id):
+        '''Keep only the newest `FLASKY_TIMELINE_LENGTH` entries of a timeline.'''
+        table = Timeline.__table__
+        cutoff = connection.execute(
+            db.select([table.c.timestamp])
+                .where(table.c.user_id==user_id)
+                .order_by(table.c.timestamp.desc())
+                .offset(current_app.config['FLASKY_TIMELINE_LENGTH'])
+                .limit(1)).scalar()
+        if cutoff is not None:
+            connection.execute(table.delete().where(db.and_(
+                table.c.user_id==user_id, table.c.timestamp<=cutoff)))
+
+    @staticmethod
+    def trim_all():
+        '''Trim every timeline that grew past the configured length.
+
+        Fan-out does not trim on write, because that would cost one extra
+        statement per follower, so this is meant to be run periodically.
+        '''
+        table = Timeline.__table__
+        connection = db.session.connection()
+        user_ids = [row[0] for row in connection.execute(
+            db.select([table.c.user_id])
+                .group_by(table.c.user_id)
+                .having(db.func.count() > current_app.config['FLASKY_TIMELINE_LENGTH']))]
+        for user_id in user_ids:
+            Timeline.trim(connection, user_id)
+        db.session.commit()
+        return len(user_ids)
+
+    @staticmethod
+    def rebuild(batch_size=500):
+        '''Recompute every timeline from `follows` and `posts`, one follower at a
+        time and committing every `batch_size` followers. Only the newest
+        `FLASKY_TIMELINE_LENGTH` posts of each timeline are inserted, so nothing has
+        to be trimmed afterwards. Returns the number of timelines rebuilt.
+        '''
+        table = Timeline.__table__
+        length = current_app.config['FLASKY_TIMELINE_LENGTH']
+        connection = db.session.connection()
+        connection.execute(table.delete().where(
+            ~table.c.user_id.in_(db.select([Follow.follower_id]))))
+        follower_ids = [row[0] for row in connection.execute(
+            db.select([Follow.follower_id]).distinct().order_by(Follow.follower_id))]
+        for count, user_id in enumerate(follower_ids, 1):
+            connection.execute(table.delete().where(table.c.user_id==user_id))
+            entries = db.select([
+                db.literal(user_id, db.Integer),
+                Post.id,
+                Post.author_id,
+                Post.timestamp
+            ]).select_from(db.join(Follow, Post, Follow.followed_id==Post.author_id)) \
+                .where(Follow.follower_id==user_id) \
+                .order_by(Post.timestamp.desc()) \
+                .limit(length)
+            connection.execute(table.insert().from_select(
+                ['user_id', 'post_id', 'author_id', 'timestamp'], entries))
+            if count % batch_size == 0:
+                db.session.commit()
+                connection = db.session.connection()
+        db.session.commit()
+        return len(follower_ids)
+
+    @staticmethod
+    def on_post_inserted(mapper, connection, target):
+        Timeline.fan_out(connection, target)
+
+    @staticmethod
+    def on_post_deleted(mapper, connection, target):
+        table = Timeline.__table__
+        connection.execute(table.delete().where(table.c.post_id==target.id))
+
+    @staticmethod
+    def on_follow_inserted(mapper, connection, target):
+        Timeline.backfill(connection, target.follower_id, target.followed_id)
+
+    @staticmethod
+    def on_follow_deleted(mapper, connection, target):
+        Timeline.remove(connection, target.follower_id, target.followed_id)
+
 class User(db.Model, UserMixin):
     '''The ``UserMixin`` implements four function(property) that Flask_Login needs.
     meth: is_authenticated(); is_active(); is_anonymous; get_id()
@@ -41,7 +197,17 @@ class User(db.Model, UserMixin):
     name = db.Column(db.String(64))
     location = db.Column(db.String(64))
     about_me = db.Column(db.Text())
-    avatar_hash = db.Column(db.String(32))
+    avatar_hash = db.Column(db.String(32), index=True)
+
+    # Denormalized counters, kept up to date by `CounterCache` so that showing them
+    # does not cost a `COUNT` query. Both follower counts include the self-follow.
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    follower_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    followed_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
+    # Bumped by `RowVersion` whenever the row changes, for the API's ETags.
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+    updated = db.Column(db.DateTime, default=datetime.utcnow)
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     comments = db.relationship('Comment', backref='author', lazy='dynamic')
 
@@ -83,9 +249,14 @@ class User(db.Model, UserMixin):
 
     @property
     def followed_posts(self):
-        '''Show your posts and the posts of whom you followed'''
-        return Post.query.join(Follow, Follow.followed_id==Post.author_id) \
-            .filter(Follow.follower_id==self.id)
+        '''Show your posts and the posts of whom you followed, newest first.
+
+        The posts are read from the precomputed `Timeline` of the user, so this
+        no longer joins against `follows` on every request.
+        '''
+        return Post.query.join(Timeline, Timeline.post_id==Post.id) \
+            .filter(Timeline.user_id==self.id) \
+            .order_by(Timeline.timestamp.desc(), Timeline.post_id.desc())
 
     @property
     def password(self):
@@ -133,16 +304,25 @@ class User(db.Model, UserMixin):
     def generate_auth_token(self, expiration):
         '''Returns a signed token that encodes the user's id field.'''
         s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
-        return s.dump({'auth': self.id})
+        return s.dumps({'auth': self.id}).decode('ascii')
 
     @staticmethod
-    def verify_auth_token(token):
+    def parse_auth_token(token):
+        '''Returns the user id encoded in a valid token and the time the token
+        expires at, or None if the token is invalid or expired.'''
         s = Serializer(current_app.config['SECRET_KEY'])
         try:
-            data = s.loads(token)
+            data, header = s.loads(token, return_header=True)
         except:
             return None
-        return User.query.get(data['id'])
+        return data.get('auth'), header['exp']
+
+    @staticmethod
+    def verify_auth_token(token):
+        parsed = User.parse_auth_token(token)
+        if parsed is None:
+            return None
+        return User.query.get(parsed[0])
 
     def can(self, permission):
         return (self.role is not None and 
@@ -152,9 +332,15 @@ class User(db.Model, UserMixin):
         return self.can(Permission.ADMINISTER)
 
     def ping(self):
-        self.last_seen = datetime.utcnow()
-        db.session.add(self)
-        db.session.commit()
+        '''Record that the user was seen just now. The time is written to the
+        database later, in bulk, by the `last_seen` recorder.'''
+        now = datetime.utcnow()
+        if recorder.record(self.id, now):
+            set_committed_value(self, 'last_seen', now)
+
+    def avatar_url(self, size=100):
+        '''The URL of the avatar of the user, see `app.avatars`.'''
+        return avatar_url(self, size)
 
     def gravatar(self, size=100, default='identicon', rating='g'):
         if request.is_secure:
@@ -175,31 +361,29 @@ class User(db.Model, UserMixin):
         f = self.followed.filter_by(followed_id=user.id).first()
         if f:
             db.session.delete(f)
-            db.sessino.commit()
+            db.session.commit()
 
     @staticmethod
     def add_self_follows():
-        for user in User.query.all():
-            if not user.is_following(user):
-                user.follow(user)
-                db.session.add(user)
-                db.session.commit()
+        '''Make every user follow themselves. Returns the number of follows added.'''
+        from .graph import ensure_self_follows
+        return sum(inserted for inserted, last_id in ensure_self_follows())
 
     def is_following(self, user):
         return self.followed.filter_by(followed_id=user.id).first() is not None
 
     def is_followed_by(self, user):
-        return self.followers.filter_by(follower_if=user.id).first() is not None
+        return self.followers.filter_by(follower_id=user.id).first() is not None
 
     def to_json(self):
         json_user = {
-            'url': url_for('api.get_post', id=self.id, _external=True),
+            'url': url_template('api.get_user')(self.id),
             'username': self.username,
             'member_since': self.member_since,
             'last_seen': self.last_seen,
-            'posts': url_for('api.get_user_posts', id=self.id, _external=True),
-            'followed_posts': url_for('api.get_user_followed_posts', id=self.id, _external=True),
-            'post_count': self.posts.count()
+            'posts': url_template('api.get_user_posts')(self.id),
+            'followed_posts': url_template('api.get_user_followed_posts')(self.id),
+            'post_count': self.post_count
         }
         return json_user
 
@@ -286,43 +470,32 @@ class Post(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     body_html = db.Column(db.Text)
+    body_hash = db.Column(db.String(40))
+    body_html_version = db.Column(db.Integer, index=True)
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+    updated = db.Column(db.DateTime, default=datetime.utcnow)
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
         '''The function renders the HTML version of the body and stores
         it in body_html, effectively making the conversion of the Mark-down
-        text to HTML fully automatic.
-
-        the actual conversion is donw in three steps in `meth: target_body_html`:
-
-            First, the `markdown()` function does an initial conversion to HTML.
-
-            Second, the resualt from the first step is passed to `clean()`, along
-        with the list of approved HTML tags. The `clean()` function removes any tags
-        not on the white list.
-
-            Finally, function `linkify()` provided by Bleach converts any URLs written
-        in plain text into proper <a> links. This last step is necessary because automatic
-        link generation is not officially in the Markdown specification. PageDown supports 
-        it as an extension. 
+        text to HTML fully automatic. The conversion itself is described in
+        `app/render.py`; a body that was already rendered by the current
+        renderer version is not rendered again.
         '''
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'en', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3', 'p']
-
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),tags=allowed_tags, strip=True))
+        render_into(target, value, 'post')
     
     def to_json(self):
         json_post = {
-            'url': url_for('api.get_post', id=self.id, _external=True),
+            'url': url_template('api.get_post')(self.id),
             'body': self.body,
             'body_html': self.body_html,
             'timestamp': self.timestamp,
-            'author': url_for('api.get_user', id=self.author_id, _external=True),
-            'comments': url_for('api.get_post_comments', id=self.id, _external=True),
-            'comment_count': self.comments.count()
+            'author': url_template('api.get_user')(self.author_id),
+            'comments': url_template('api.get_post_comments')(self.id),
+            'comment_count': self.comment_count
         }
         return json_post
 
@@ -354,26 +527,28 @@ class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
+    body_hash = db.Column(db.String(40))
+    body_html_version = db.Column(db.Integer, index=True)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     disabled = db.Column(db.Boolean)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
+    version = db.Column(db.Integer, default=1, server_default='1', nullable=False)
+    updated = db.Column(db.DateTime, default=datetime.utcnow)
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),tags=allowed_tags, strip=True))
+        render_into(target, value, 'comment')
 
     def to_json(self):
         json_comment = {
-            'url': url_for('api.get_comment', id=self.id, _external=True),
+            'url': url_template('api.get_comment')(self.id),
             'body': self.body,
             'body_html': self.body_html,
             'timestamp': self.timestamp,
             'disabled': self.disabled,
-            'author': url_for('api.get_user', id=self.author_id, _external=True),
-            'post': url_for('api.get_post', id=self.post_id, _external=True),
+            'author': url_template('api.get_user')(self.author_id),
+            'post': url_template('api.get_post')(self.post_id),
         }
         return json_comment
 
@@ -382,17 +557,275 @@ class Comment(db.Model):
         body = json_comment.get('body')
         if body is None or body == '':
             raise ValidationError('comment does not have a body')
-        return Post(body=body)
+        return Comment(body=body)
+
+class RowVersion:
+    '''Maintains the `version` and `updated` columns of users, posts and comments.
+
+    Every change to a row that can show in its API representation increments
+    `version` and sets `updated`, which is what the API's ETag and Last-Modified
+    headers are derived from. Changes made through the ORM are covered by
+    `on_update()`; code that updates these tables with plain `UPDATE` statements
+    must add `RowVersion.bump(table)` to the values it sets.
+    '''
+
+    @staticmethod
+    def bump(table):
+        return {'version': table.c.version + 1, 'updated': datetime.utcnow()}
+
+    @staticmethod
+    def on_update(mapper, connection, target):
+        session = db.object_session(target)
+        if session is not None and session.is_modified(target, include_collections=False):
+            # Incremented by the database, so concurrent updates don't lose a bump.
+            target.version = mapper.class_.version + 1
+            target.updated = datetime.utcnow()
+
+class CounterCache:
+    '''Maintains the denormalized counter columns of `User` and `Post`.
+
+    The counters are adjusted with `UPDATE ... SET n = n + 1` statements issued from
+    mapper events, on the connection of the flush that inserts or deletes the counted
+    row, so a counter always commits or rolls back together with the row it counts.
+    The in-memory value of an already loaded object is only refreshed once it expires,
+    which by default happens on commit.
+    '''
+
+    @staticmethod
+    def increment(connection, column, id, delta):
+        table = column.table
+        values = RowVersion.bump(table)
+        values[column.name] = column + delta
+        connection.execute(table.update()
+            .where(table.c.id==id)
+            .values(values))
+
+    @staticmethod
+    def on_post_inserted(mapper, connection, target):
+        CounterCache.increment(connection, User.post_count, target.author_id, 1)
+
+    @staticmethod
+    def on_post_deleted(mapper, connection, target):
+        CounterCache.increment(connection, User.post_count, target.author_id, -1)
+
+    @staticmethod
+    def on_comment_inserted(mapper, connection, target):
+        CounterCache.increment(connection, Post.comment_count, target.post_id, 1)
+
+    @staticmethod
+    def on_comment_deleted(mapper, connection, target):
+        CounterCache.increment(connection, Post.comment_count, target.post_id, -1)
+
+    @staticmethod
+    def on_follow_inserted(mapper, connection, target):
+        CounterCache.increment(connection, User.follower_count, target.followed_id, 1)
+        CounterCache.increment(connection, User.followed_count, target.follower_id, 1)
+
+    @staticmethod
+    def on_follow_deleted(mapper, connection, target):
+        CounterCache.increment(connection, User.follower_count, target.followed_id, -1)
+        CounterCache.increment(connection, User.followed_count, target.follower_id, -1)
+
+    @staticmethod
+    def recount():
+        '''Recompute every counter from the counted tables and repair the rows that
+        drifted, e.g. after rows were written around the ORM. Returns the number of
+        repaired rows per counter.
+        '''
+        counters = [
+            (User.post_count, db.select([db.func.count(Post.id)])
+                .where(Post.author_id==User.id)),
+            (User.follower_count, db.select([db.func.count()])
+                .where(Follow.followed_id==User.id)),
+            (User.followed_count, db.select([db.func.count()])
+                .where(Follow.follower_id==User.id)),
+            (Post.comment_count, db.select([db.func.count(Comment.id)])
+                .where(Comment.post_id==Post.id)),
+        ]
+        from .response_cache import response_cache
+
+        repaired = {}
+        connection = db.session.connection()
+        for column, count in counters:
+            count = count.as_scalar()
+            table = column.table
+            values = RowVersion.bump(table)
+            values[column.name] = count
+            result = connection.execute(table.update()
+                .where(column!=count)
+                .values(values))
+            repaired['%s.%s' % (table.name, column.name)] = result.rowcount
+        db.session.commit()
+        if any(repaired.values()):
+            response_cache.clear()
+        return repaired
+
+class UserCache:
+    '''Snapshots of logged in users, so that a page view does not have to load the
+    user and their role from the database just to know who is asking and what they
+    are allowed to do.
+
+    Only the columns the pages read on `current_user` are kept, together with the
+    role. A snapshot is turned back into instances attached to the session without a
+    query; any other attribute is loaded from the database when first accessed.
+
+    A snapshot is dropped when one of its columns changes or the user is deleted,
+    and every snapshot is dropped when a role changes. This covers changes made
+    through the ORM by this process; changes made by other processes, or with bulk
+    `UPDATE` statements, are picked up once the snapshot expires after
+    `FLASKY_USER_CACHE_TTL` seconds.
+    '''
+
+    columns = ('id', 'email', 'username', 'role_name', 'confirmed', 'name',
+               'location', 'avatar_hash')
+    role_columns = ('id', 'name', 'default', 'permissions')
+    snapshots = LRUCache()
+    ttl = None
+
+    @staticmethod
+    def init_app(app):
+        UserCache.snapshots.maxsize = app.config['FLASKY_USER_CACHE_SIZE']
+        UserCache.ttl = app.config['FLASKY_USER_CACHE_TTL']
+
+    @staticmethod
+    def load(id):
+        '''Returns the user with the given id, from its snapshot when there is one.'''
+        snapshot = UserCache.snapshots.get(id)
+        if snapshot is None:
+            # Not from a replica, which could hand out a role or confirmation status
+            # that was just changed.
+            with primary():
+                user = User.query.options(db.joinedload('role')).get(id)
+            if user is not None:
+                UserCache.snapshots.set(id, UserCache.take(user), ttl=UserCache.ttl)
+            return user
+        user_values, role_values = snapshot
+        role = None
+        if role_values is not None:
+            role = UserCache.restore(Role, role_values)
+        user = UserCache.restore(User, user_values)
+        set_committed_value(user, 'role', role)
+        # With `load=False` merging doesn't query, it adopts the instance or returns
+        # the one the session already holds for that identity.
+        user = db.session.merge(user, load=False)
+        UserCache.expire_unloaded(user)
+        if user.role is not None:
+            UserCache.expire_unloaded(user.role)
+        return user
+
+    @staticmethod
+    def take(user):
+        role = None
+        if user.role is not None:
+            role = dict((key, getattr(user.role, key)) for key in UserCache.role_columns)
+        return dict((key, getattr(user, key)) for key in UserCache.columns), role
+
+    @staticmethod
+    def restore(model, values):
+        instance = db.inspect(model).class_manager.new_instance()
+        for key, value in values.items():
+            set_committed_value(instance, key, value)
+        make_transient_to_detached(instance)
+        return instance
+
+    @staticmethod
+    def expire_unloaded(instance):
+        # Attributes that are neither loaded nor expired would read as None.
+        state = db.inspect(instance)
+        unloaded = [attr.key for attr in state.mapper.column_attrs
+                    if attr.key not in state.dict]
+        if unloaded:
+            db.session.expire(instance, unloaded)
+
+    @staticmethod
+    def discard(session, id):
+        UserCache.snapshots.delete(id)
+        # Drop it again once the change is committed, in case another request read
+        # the old row in the meantime.
+        if session is not None:
+            session.info.setdefault('stale_users', set()).add(id)
+
+    @staticmethod
+    def on_user_updated(mapper, connection, target):
+        state = db.inspect(target)
+        if any(state.attrs[key].history.has_changes() for key in UserCache.columns):
+            UserCache.discard(state.session, target.id)
+
+    @staticmethod
+    def on_user_deleted(mapper, connection, target):
+        UserCache.discard(db.inspect(target).session, target.id)
+
+    @staticmethod
+    def on_role_changed(mapper, connection, target):
+        UserCache.snapshots.clear()
+
+    @staticmethod
+    def on_commit(session):
+        for id in session.info.pop('stale_users', ()):
+            UserCache.snapshots.delete(id)
+
+# Named eager-loading strategies, applied with `query.load_profile(name)`. For every
+# model a page lists, they name the relationships its templates touch on each row,
+# which are then joined into the query that fetches the page. Comment counts come
+# from `Post.comment_count` and need no loading at all.
+LOADING_PROFILES = {
+    # `main/_posts.html`: author link and avatar of every post.
+    'feed': {
+        Post: ['author'],
+    },
+    # `main/post.html`: the post itself and the author of every comment.
+    'post_detail': {
+        Post: ['author'],
+        Comment: ['author'],
+    },
+    # `main/moderate.html`: every comment with its author.
+    'moderation': {
+        Comment: ['author'],
+    },
+    # `main/search.html`: the author of every post and comment found.
+    'search': {
+        Post: ['author'],
+        Comment: ['author'],
+    },
+}
+
+login_manager.anonymous_user = AnonymousUser
 
 @login_manager.user_loader
 def load_user(user_id):
     '''Flask_login requires the app to set up a callback function that loads a user,
     given the identifier. The return value of the function must be the user object if available.
     '''
-    return User.query.get(int(user_id))
+    return UserCache.load(int(user_id))
 
 # The `on_changed_body` function is registered as a listener of SQLAlchemy's
 # 'set' event for `body`, which means that it will be automatically invoked
 # whenever the `body` field on any instance of the class is set to a new value.
 db.event.listen(Post.body, 'set', Post.on_changed_body)
-db.event.listen(Comment.body, 'set', Comment.on_changed_body)
\ No newline at end of file
+db.event.listen(Comment.body, 'set', Comment.on_changed_body)
+
+# Keep the precomputed timelines in sync with posts and the follow graph. These run
+# inside the flush, on the same connection, so they commit or roll back together
+# with the row that triggered them.
+db.event.listen(Post, 'after_insert', Timeline.on_post_inserted)
+db.event.listen(Post, 'after_delete', Timeline.on_post_deleted)
+db.event.listen(Follow, 'after_insert', Timeline.on_follow_inserted)
+db.event.listen(Follow, 'after_delete', Timeline.on_follow_deleted)
+
+# Counter caches are maintained the same way.
+db.event.listen(Post, 'after_insert', CounterCache.on_post_inserted)
+db.event.listen(Post, 'after_delete', CounterCache.on_post_deleted)
+db.event.listen(Comment, 'after_insert', CounterCache.on_comment_inserted)
+db.event.listen(Comment, 'after_delete', CounterCache.on_comment_deleted)
+db.event.listen(Follow, 'after_insert', CounterCache.on_follow_inserted)
+db.event.listen(Follow, 'after_delete', CounterCache.on_follow_deleted)
+db.event.listen(User, 'before_update', RowVersion.on_update)
+db.event.listen(Post, 'before_update', RowVersion.on_update)
+db.event.listen(Comment, 'before_update', RowVersion.on_update)
+
+# Logged in users are served from snapshots, see `UserCache`.
+db.event.listen(User, 'after_update', UserCache.on_user_updated)
+db.event.listen(User, 'after_delete', UserCache.on_user_deleted)
+db.event.listen(Role, 'after_update', UserCache.on_role_changed)
+db.event.listen(Role, 'after_delete', UserCache.on_role_changed)
+db.event.listen(db.session, 'after_commit', UserCache.on_commit)
@@ -0,0 +1,128 @@
+'''Keyset (cursor) pagination.
+
+`paginate(page, per_page)` has to scan and throw away every row in front of the
+requested page, and it also runs a separate `COUNT(*)` to know how many pages there
+are. Keyset pagination remembers the sort key of the first and last rows shown
+instead, and asks the database for the rows that come right after (or before) them,
+which an index on the sort columns answers in the same time on page 1 and page 10000.
+
+The sort key is handed to clients as an opaque `cursor` string.
+'''
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import url_for
+from sqlalchemy import and_, or_
+
+from .exceptions import ValidationError
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return {'ts': value.strftime(TIMESTAMP_FORMAT)}
+    return value
+
+def _load_value(value):
+    if isinstance(value, dict):
+        return datetime.strptime(value['ts'], TIMESTAMP_FORMAT)
+    return value
+
+def encode_cursor(direction, key):
+    '''Pack a direction ('next' or 'prev') and a sort key into an url-safe string.'''
+    payload = json.dumps({'d': direction, 'k': [_dump_value(v) for v in key]},
+                         separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    '''Reverse `encode_cursor()`, raising `ValidationError` for anything malformed.'''
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        direction = payload['d']
+        key = tuple(_load_value(v) for v in payload['k'])
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        raise ValidationError('invalid cursor')
+    if direction not in ('next', 'prev'):
+        raise ValidationError('invalid cursor')
+    return direction, key
+
+def _after(columns, key, descending):
+    '''Build the WHERE clause selecting the rows sorted after `key`.
+
+    For columns (a, b) in descending order this is `a < :a OR (a = :a AND b < :b)`,
+    spelled out instead of using a row-value comparison so that it works on every
+    backend.
+    '''
+    column, value = columns[0], key[0]
+    beyond = column < value if descending else column > value
+    if len(columns) == 1:
+        return beyond
+    return or_(beyond, and_(column == value,
+                            _after(columns[1:], key[1:], descending)))
+
+class KeysetPagination(object):
+    '''One page of results, with the cursors pointing at its neighbours.'''
+
+    def __init__(self, items, has_prev, has_next, prev_cursor, next_cursor):
+        self.items = items
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    def prev_url(self, endpoint, **values):
+        if not self.has_prev:
+            return None
+        return url_for(endpoint, cursor=self.prev_cursor, _external=True, **values)
+
+    def next_url(self, endpoint, **values):
+        if not self.has_next:
+            return None
+        return url_for(endpoint, cursor=self.next_cursor, _external=True, **values)
+
+def keyset_paginate(query, columns, cursor=None, per_page=20, descending=True, key=None):
+    '''Return the page of `query` that follows `cursor`.
+
+    `columns` are the sort columns, normally `(Model.timestamp, Model.id)`; together
+    they must be unique so that no row is skipped or repeated between pages. `key`
+    extracts the sort key from a result item, by default the attributes named after
+    the columns.
+    '''
+    if key is None:
+        names = [column.key for column in columns]
+        key = lambda item: tuple(getattr(item, name) for name in names)
+
+    direction, cursor_key = 'next', None
+    if cursor:
+        direction, cursor_key = decode_cursor(cursor)
+        if len(cursor_key) != len(columns):
+            raise ValidationError('invalid cursor')
+
+    # Walking backwards is walking forwards in the opposite order, then reversing.
+    forwards = direction == 'next'
+    order_descending = descending if forwards else not descending
+    query = query.order_by(None).order_by(
+        *[column.desc() if order_descending else column.asc() for column in columns])
+    if cursor_key is not None:
+        query = query.filter(_after(columns, cursor_key, order_descending))
+
+    # Fetch one extra row to learn whether there is another page without a COUNT.
+    items = query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if forwards:
+        has_prev, has_next = cursor_key is not None, has_more
+    else:
+        items.reverse()
+        has_prev, has_next = has_more, True
+
+    prev_cursor = next_cursor = None
+    if items:
+        prev_cursor = encode_cursor('prev', key(items[0]))
+        next_cursor = encode_cursor('next', key(items[-1]))
+    else:
+        has_prev = has_next = False
+    return KeysetPagination(items, has_prev, has_next, prev_cursor, next_cursor)
@@ -0,0 +1,259 @@
+'''Sampling profiler for individual requests.
+
+A profiled request is sampled by a background thread that records the stack of
+the thread serving it every `FLASKY_PROFILE_INTERVAL` seconds, which costs nothing
+to the requests that aren't profiled and little to those that are, so it can run
+under gunicorn in production. A request is profiled when:
+
+* it carries an `X-Profile` header and comes from a logged in administrator, or
+  the header holds the `FLASKY_PROFILE_TOKEN` secret, for API clients;
+* or it is picked at random, for a `FLASKY_PROFILE_SAMPLE_RATE` fraction of the
+  traffic.
+
+Every profile gets an id, returned in the `X-Profile-Id` header, and is written to
+`FLASKY_PROFILE_DIR/<endpoint>/` as:
+
+* `<id>.collapsed`, the samples as collapsed stacks, one `frame;frame;... count`
+  line per distinct stack, as read by flamegraph.pl, speedscope and the like;
+* `<id>.svg`, a flame graph of those stacks;
+* `<id>.json`, the URL, status and duration of the request, and the SQL it ran
+  as recorded by Flask-SQLAlchemy (see `app.db_metrics`), with the memory
+  allocated by every line of code during the request when
+  `FLASKY_PROFILE_TRACEMALLOC` is on.
+
+`merge_profiles()` adds up the profiles of an endpoint into one flame graph.
+
+Samples are taken from `sys._current_frames()`, so greenlet based gunicorn workers
+only show the stack of the hub.
+'''
+import glob
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from xml.sax.saxutils import escape
+
+from flask import request, g, current_app
+from flask_login import current_user
+from flask_sqlalchemy import get_debug_queries
+
+from .db_metrics import fingerprint
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, allocations are not tracked.
+    tracemalloc = None
+
+class Sampler(object):
+    '''Samples the stack of one thread from a thread of its own.'''
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='flasky-profiler')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, code.co_filename,
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+def collapsed(stacks):
+    '''The collapsed stack lines of a `Counter` of stacks.'''
+    return ''.join('%s %d\n' % (stack, count) for stack, count in sorted(stacks.items()))
+
+def flamegraph(stacks, title='', width=1200, row_height=16):
+    '''A self-contained SVG flame graph of a `Counter` of collapsed stacks.'''
+    root = {'children': {}, 'count': 0}
+    for stack, count in stacks.items():
+        root['count'] += count
+        node = root
+        for frame in stack.split(';'):
+            node = node['children'].setdefault(frame, {'children': {}, 'count': 0})
+            node['count'] += count
+
+    boxes = []
+    def layout(node, x, depth):
+        for frame, child in sorted(node['children'].items()):
+            child_width = float(child['count']) / root['count'] * width
+            if child_width >= 0.5:
+                boxes.append((frame, child['count'], x, depth, child_width))
+                layout(child, x, depth + 1)
+            x += child_width
+    if root['count']:
+        layout(root, 0.0, 0)
+
+    depth = max([box[3] for box in boxes] or [0]) + 1
+    height = (depth + 2) * row_height
+    lines = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" '
+        'font-family="monospace" font-size="11">' % (width, height),
+        '<text x="4" y="%d">%s (%d samples)</text>' % (
+            row_height - 4, escape(title), root['count'])]
+    for frame, count, x, level, box_width in boxes:
+        y = height - (level + 1) * row_height
+        # Warm colours, shaded by the name so that the same frame looks the same.
+        shade = sum(ord(c) for c in frame) % 80
+        label = frame[:int(box_width / 7)] if box_width > 21 else ''
+        lines.append(
+            '<g><title>%s (%d samples, %.1f%%)</title>'
+            '<rect x="%.1f" y="%d" width="%.1f" height="%d" fill="rgb(%d,%d,%d)" '
+            'stroke="white" stroke-width="0.5"/>'
+            '<text x="%.1f" y="%d">%s</text></g>' % (
+                escape(frame), count, 100.0 * count / root['count'],
+                x, y, box_width, row_height - 1, 205 + shade // 2, 80 + shade, 40,
+                x + 3, y + row_height - 4, escape(label)))
+    lines.append('</svg>\n')
+    return '\n'.join(lines)
+
+def endpoint_dir(base, endpoint):
+    return os.path.join(base, (endpoint or 'unmatched').replace('/', '_'))
+
+def merge_profiles(base, endpoint):
+    '''Add up all the profiles of `endpoint` under the directory `base` and write
+    them as `all.collapsed` and `all.svg`. Returns the number of profiles merged.'''
+    directory = endpoint_dir(base, endpoint)
+    stacks = Counter()
+    paths = [path for path in glob.glob(os.path.join(directory, '*.collapsed'))
+             if os.path.basename(path) != 'all.collapsed']
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                stack, count = line.rstrip('\n').rsplit(' ', 1)
+                stacks[stack] += int(count)
+    if paths:
+        with open(os.path.join(directory, 'all.collapsed'), 'w') as f:
+            f.write(collapsed(stacks))
+        with open(os.path.join(directory, 'all.svg'), 'w') as f:
+            f.write(flamegraph(stacks, '%s, %d requests' % (endpoint, len(paths))))
+    return len(paths)
+
+class RequestProfiler(object):
+    '''Flask extension profiling the requests picked as described in the module
+    documentation.'''
+
+    header = 'X-Profile'
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        if app.config['FLASKY_PROFILE_TRACEMALLOC'] and tracemalloc is not None \
+                and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def wanted(self):
+        config = current_app.config
+        value = request.headers.get(self.header)
+        if value:
+            token = config['FLASKY_PROFILE_TOKEN']
+            if token and value == token:
+                return True
+            if current_user.is_authenticated and current_user.is_administrator():
+                return True
+        rate = config['FLASKY_PROFILE_SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    def before_request(self):
+        if not self.wanted():
+            return
+        config = current_app.config
+        g.profile = {
+            'id': uuid.uuid4().hex[:16],
+            'start': time.time(),
+            'status': None,
+            'memory': tracemalloc.take_snapshot()
+                if tracemalloc is not None and tracemalloc.is_tracing() else None,
+            'sampler': Sampler(threading.current_thread().ident,
+                               config['FLASKY_PROFILE_INTERVAL']).start()
+        }
+
+    def after_request(self, response):
+        profile = getattr(g, 'profile', None)
+        if profile is not None:
+            profile['status'] = response.status_code
+            response.headers['X-Profile-Id'] = profile['id']
+        return response
+
+    def teardown_request(self, exc):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        stacks = profile['sampler'].stop()
+        duration = time.time() - profile['start']
+        try:
+            self.write(profile, stacks, duration)
+        except (IOError, OSError):
+            current_app.logger.exception('Could not write profile %s' % profile['id'])
+
+    def write(self, profile, stacks, duration):
+        config = current_app.config
+        directory = endpoint_dir(config['FLASKY_PROFILE_DIR'], request.endpoint)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, profile['id'])
+
+        allocations = None
+        if profile['memory'] is not None:
+            # Leave out what the profiler itself allocated.
+            ignored = [tracemalloc.Filter(False, __file__),
+                       tracemalloc.Filter(False, tracemalloc.__file__)]
+            statistics = tracemalloc.take_snapshot().filter_traces(ignored).compare_to(
+                profile['memory'].filter_traces(ignored), 'lineno')
+            allocations = [{
+                'where': '%s:%d' % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                'size': stat.size_diff,
+                'count': stat.count_diff
+            } for stat in statistics[:config['FLASKY_PROFILE_TOP_ALLOCATIONS']]]
+
+        with open(path + '.collapsed', 'w') as f:
+            f.write(collapsed(stacks))
+        with open(path + '.svg', 'w') as f:
+            f.write(flamegraph(stacks, '%s %s' % (request.method, request.path)))
+        with open(path + '.json', 'w') as f:
+            json.dump({
+                'id': profile['id'],
+                'method': request.method,
+                'url': request.url,
+                'endpoint': request.endpoint,
+                'status': profile['status'],
+                'started': profile['start'],
+                'duration': duration,
+                'samples': sum(stacks.values()),
+                'interval': config['FLASKY_PROFILE_INTERVAL'],
+                'sql': [{
+                    'statement': query.statement,
+                    'fingerprint': fingerprint(query.statement),
+                    'duration': query.duration
+                } for query in get_debug_queries()],
+                'allocations': allocations
+            }, f, indent=2)
+
+profiler = RequestProfiler()
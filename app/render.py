@@ -0,0 +1,119 @@
+'''Markdown to HTML rendering for post and comment bodies.
+
+The actual conversion is done in three steps:
+
+    First, the `markdown()` function does an initial conversion to HTML.
+
+    Second, the result from the first step is passed to `clean()`, along with the
+list of approved HTML tags. The `clean()` function removes any tags not on the white
+list.
+
+    Finally, function `linkify()` provided by Bleach converts any URLs written in plain
+text into proper <a> links. This last step is necessary because automatic link
+generation is not officially in the Markdown specification. PageDown supports it as
+an extension.
+
+Every rendered row records the hash of the body it was rendered from and the
+`RENDERER_VERSION` that rendered it, so an unchanged body is never rendered twice
+and rows rendered by an older pipeline can be found and re-rendered in bulk with
+`manage.py rerender`. Bump `RENDERER_VERSION` whenever a change here would produce
+different HTML for the same body, e.g. when editing `ALLOWED_TAGS`.
+'''
+import hashlib
+
+from markdown import markdown
+import bleach
+
+from .cache import LRUCache
+
+RENDERER_VERSION = 1
+
+ALLOWED_TAGS = {
+    'post': ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+             'en', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+             'h1', 'h2', 'h3', 'p'],
+    'comment': ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong'],
+}
+
+# Rendered HTML keyed by (kind, version, body hash), shared by every row of a process.
+_rendered = LRUCache(maxsize=2048)
+
+def body_hash(body):
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+def _render(body, kind):
+    return bleach.linkify(bleach.clean(
+        markdown(body, output_format='html'), tags=ALLOWED_TAGS[kind], strip=True))
+
+def render(body, kind):
+    '''Return the sanitized HTML of a `kind` ('post' or 'comment') body.'''
+    key = (kind, RENDERER_VERSION, body_hash(body))
+    html = _rendered.get(key)
+    if html is None:
+        html = _render(body, kind)
+        _rendered.set(key, html)
+    return html
+
+def render_row(row):
+    '''Render an `(id, kind, body)` tuple into the values to store for that row.
+
+    This is the unit of work of the `manage.py rerender` process pool, so it has to
+    stay a picklable module-level function that needs no application context.
+    '''
+    id, kind, body = row
+    body = body or ''
+    return {
+        '_id': id,
+        'body_html': render(body, kind),
+        'body_hash': body_hash(body),
+        'body_html_version': RENDERER_VERSION
+    }
+
+def render_into(target, body, kind):
+    '''Store the rendered `body` on a `Post` or `Comment`, unless it already holds
+    the output of the current renderer for this very body.'''
+    digest = body_hash(body)
+    if (target.body_hash == digest and
+            target.body_html_version == RENDERER_VERSION and
+            target.body_html is not None):
+        return
+    target.body_html = render(body, kind)
+    target.body_hash = digest
+    target.body_html_version = RENDERER_VERSION
+
+def rerender_stale(model, kind, batch_size=500, pool=None):
+    '''Re-render every row of `model` whose HTML is missing or was rendered by an
+    older `RENDERER_VERSION`, `batch_size` rows at a time.
+
+    The bodies of a batch are rendered by `pool` when one is given, then written
+    back with a single executemany UPDATE and committed. Yields the number of rows
+    and the last id of every committed batch. Finished rows are no longer stale, so
+    an interrupted run simply picks up where it stopped when started again.
+    '''
+    from .models import db, RowVersion
+
+    table = model.__table__
+    stale = db.or_(table.c.body_html_version==None,
+                   table.c.body_html_version!=RENDERER_VERSION)
+    update = table.update() \
+        .where(table.c.id==db.bindparam('_id')) \
+        .values(RowVersion.bump(table))
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select([table.c.id, table.c.body])
+                .where(stale)
+                .where(table.c.id>last_id)
+                .order_by(table.c.id)
+                .limit(batch_size)).fetchall()
+        if not rows:
+            break
+        work = [(id, kind, body) for id, body in rows]
+        if pool is not None:
+            values = pool.map(render_row, work)
+        else:
+            values = [render_row(row) for row in work]
+        db.session.execute(update, values)
+        db.session.commit()
+        last_id = rows[-1][0]
+        yield len(rows), last_id
@@ -0,0 +1,139 @@
+'''Read replicas.
+
+With `FLASKY_DB_REPLICAS`, a list of database URLs, the queries of `GET` and `HEAD`
+requests are sent to one of those replicas, picked at random for every request,
+and everything else goes to `SQLALCHEMY_DATABASE_URI`, the primary. A request reads
+from the primary instead when:
+
+* it has written something, so that it reads its own writes;
+* the same browser session wrote something less than
+  `FLASKY_DB_READ_YOUR_WRITES` seconds before, e.g. the page a form redirects to
+  after a `POST`. This is remembered in the Flask session, so API clients that
+  authenticate with a token or Basic auth and keep no cookie don't get it: a `GET`
+  following their `POST` may not see it yet;
+* no replica is within `FLASKY_DB_REPLICA_MAX_LAG` seconds of the primary.
+
+Lag is measured the same way whatever the replication: every
+`FLASKY_DB_REPLICA_CHECK_INTERVAL` seconds, each process writes the current time
+to the `replica_heartbeat` table of the primary and reads it back from every
+replica. A replica that can't be read is treated as lagging until the next check.
+
+`app.engine.RoutingSession` does the routing. Only SELECT statements and ORM
+queries are sent to replicas; `connection()` and
+data-changing statements always use the primary. Outside of requests, e.g. in
+`manage.py` commands, everything uses the primary.
+
+What a request reads from a replica is never cached, as it may be the very data a
+commit just invalidated: responses and template fragments rendered from a replica
+are not stored, and `UserCache` loads its snapshots from the primary.
+
+Two SQLite files, the second one a copy of the first, are enough to try it:
+
+    FLASKY_DB_REPLICAS=sqlite:////tmp/replica.sqlite
+'''
+import random
+import threading
+import time
+from datetime import datetime
+
+from flask import has_request_context, request, session
+from sqlalchemy.exc import SQLAlchemyError
+
+from .engine import WROTE_KEY
+from .models import db
+
+heartbeat_table = db.Table(
+    'replica_heartbeat', db.metadata,
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('timestamp', db.DateTime, nullable=False))
+
+# Where the Flask session remembers until when reads go to the primary.
+PIN_KEY = '_primary_until'
+
+class ReplicaSet(object):
+    '''The replica binds of one application, and the last lag measured for each of
+    them in this process.'''
+
+    def __init__(self, app, binds):
+        self.app = app
+        self.binds = binds
+        self.lags = {}
+        self.checked = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        '''Measure the lag of every replica, unless it was done less than
+        `FLASKY_DB_REPLICA_CHECK_INTERVAL` seconds ago.'''
+        interval = self.app.config['FLASKY_DB_REPLICA_CHECK_INTERVAL']
+        with self.lock:
+            if self.checked is not None and time.time() - self.checked < interval:
+                return
+            self.checked = time.time()
+        now = datetime.utcnow()
+        with db.get_engine(self.app).begin() as connection:
+            if not connection.execute(heartbeat_table.update()
+                                      .where(heartbeat_table.c.id==1)
+                                      .values(timestamp=now)).rowcount:
+                connection.execute(heartbeat_table.insert().values(id=1, timestamp=now))
+        lags = {}
+        for bind in self.binds:
+            try:
+                timestamp = db.get_engine(self.app, bind).execute(
+                    db.select([heartbeat_table.c.timestamp])
+                        .where(heartbeat_table.c.id==1)).scalar()
+            except SQLAlchemyError:
+                self.app.logger.exception('Replica %s can not be read' % bind)
+                timestamp = None
+            lags[bind] = (now - timestamp).total_seconds() if timestamp else None
+        self.lags = lags
+
+    def healthy(self):
+        max_lag = self.app.config['FLASKY_DB_REPLICA_MAX_LAG']
+        self.check()
+        return [bind for bind in self.binds
+                if self.lags.get(bind) is not None and self.lags[bind] <= max_lag]
+
+    def pick(self):
+        '''The engine of a replica for the current request to read from, or None
+        for the primary.'''
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        if session.get(PIN_KEY, 0) > time.time():
+            return None
+        healthy = self.healthy()
+        if not healthy:
+            return None
+        return db.get_engine(self.app, random.choice(healthy))
+
+def on_flush(db_session, flush_context):
+    app = getattr(db_session, 'app', None)
+    if app is not None and app.extensions.get('replicas') and has_request_context():
+        request.environ[WROTE_KEY] = True
+        session[PIN_KEY] = time.time() + app.config['FLASKY_DB_READ_YOUR_WRITES']
+
+class Replicas(object):
+    '''Flask extension adding the replicas of `FLASKY_DB_REPLICAS` to the binds of
+    Flask-SQLAlchemy, as `replica:0`, `replica:1`, etc. Must be initialized before
+    the first use of the database.'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        urls = app.config['FLASKY_DB_REPLICAS']
+        if not urls:
+            app.extensions['replicas'] = None
+            return
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        keys = []
+        for i, url in enumerate(urls):
+            key = 'replica:%d' % i
+            binds[key] = url
+            keys.append(key)
+        app.config['SQLALCHEMY_BINDS'] = binds
+        app.extensions['replicas'] = ReplicaSet(app, keys)
+
+replicas = Replicas()
+
+db.event.listen(db.session, 'after_flush', on_flush)
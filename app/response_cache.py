@@ -0,0 +1,330 @@
+'''Response cache for public pages and read-only API endpoints.
+
+Views decorated with `response_cache.cached()` are rendered once and then served
+from a cache until one of the tags of the response is invalidated or the entry
+expires after `FLASKY_RESPONSE_CACHE_TTL` seconds. Entries are keyed by the URL,
+its arguments and the permissions of the viewer. Responses built from a read
+replica are not stored, see `app.replicas`.
+
+A response is tagged with:
+
+* the tags given to `cached()`, formatted with the arguments of the view, e.g.
+  `'post:{id}'`, and those added by the view with `add_tags()`;
+* `user:<id>`, `post:<id>` and `comment:<id>` for every such row loaded from the
+  database while the response was rendered.
+
+Committing a change to a row invalidates the tags of the row and of the lists it
+belongs to, e.g. a new comment on post 42 invalidates `comment:<id>`, `comments`,
+`post:42` and `post:42:comments`. Rows changed with plain `UPDATE` statements are
+not seen; code doing so must call `response_cache.clear()` or `invalidate()`.
+
+Tags are invalidated by bumping a version number per tag, and an entry is only
+valid while the versions of its tags are still those it was stored with. Two
+backends are available, chosen with `FLASKY_RESPONSE_CACHE`:
+
+* `'memory'`, a LRU cache private to every process;
+* `'sqlite'`, a SQLite database at `FLASKY_RESPONSE_CACHE_PATH` shared by every
+  process of the host, so that an invalidation in one gunicorn worker is seen by
+  all of them.
+'''
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, request, session, g, _app_ctx_stack
+from flask_login import current_user
+
+from .cache import LRUCache
+from .engine import read_replica
+from .models import db, User, Post, Comment, Follow
+
+# The key of the version every invalidation bumps, see `ResponseCache.cached()`.
+CLOCK = '*'
+
+TAG_PREFIXES = {User: 'user', Post: 'post', Comment: 'comment'}
+
+class MemoryBackend(object):
+    '''Entries and tag versions kept in the memory of the process.'''
+
+    def __init__(self, maxsize):
+        self.entries = LRUCache(maxsize)
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def clock(self):
+        return self.versions.get(CLOCK, 0)
+
+    def version(self, tag):
+        return self.versions.get(tag, 0)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, tags = entry
+        with self.lock:
+            if any(self.versions.get(tag, 0) != version for tag, version in tags):
+                return None
+        return value
+
+    def set(self, key, value, tags, ttl, clock):
+        with self.lock:
+            if self.versions.get(CLOCK, 0) != clock:
+                return False
+            tags = [(tag, self.versions.get(tag, 0)) for tag in tags]
+        self.entries.set(key, (value, tags), ttl=ttl)
+        return True
+
+    def invalidate(self, tags):
+        with self.lock:
+            for tag in list(tags) + [CLOCK]:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+
+    def clear(self):
+        self.entries.clear()
+        self.invalidate([])
+
+class SQLiteBackend(object):
+    '''Entries and tag versions kept in a SQLite database shared by the processes
+    of one host. Every thread of every process uses a connection of its own.'''
+
+    # Expired entries are purged and the size enforced once every that many writes.
+    purge_interval = 100
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.local = threading.local()
+        self.writes = 0
+        with self.connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, status INTEGER, headers TEXT, body BLOB, '
+                'tags TEXT, expires REAL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_entries_expires ON entries (expires)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS tags (tag TEXT PRIMARY KEY, version INTEGER)')
+
+    def connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def versions(self, connection, tags):
+        tags = list(tags)
+        rows = connection.execute(
+            'SELECT tag, version FROM tags WHERE tag IN (%s)' % ', '.join('?' * len(tags)),
+            tags).fetchall() if tags else []
+        versions = dict(rows)
+        return [(tag, versions.get(tag, 0)) for tag in tags]
+
+    def clock(self):
+        return self.versions(self.connect(), [CLOCK])[0][1]
+
+    def version(self, tag):
+        return self.versions(self.connect(), [tag])[0][1]
+
+    def get(self, key):
+        connection = self.connect()
+        row = connection.execute(
+            'SELECT status, headers, body, tags FROM entries WHERE key = ? AND expires > ?',
+            (key, time.time())).fetchone()
+        if row is None:
+            return None
+        status, headers, body, tags = row
+        tags = [tuple(tag) for tag in json.loads(tags)]
+        if self.versions(connection, [tag for tag, version in tags]) != tags:
+            return None
+        return status, [tuple(header) for header in json.loads(headers)], bytes(body)
+
+    def set(self, key, value, tags, ttl, clock):
+        status, headers, body = value
+        connection = self.connect()
+        with connection:
+            # Take the write lock first, so the versions can't change under us.
+            connection.execute('BEGIN IMMEDIATE')
+            if self.versions(connection, [CLOCK])[0][1] != clock:
+                return False
+            connection.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                (key, status, json.dumps(headers), sqlite3.Binary(body),
+                 json.dumps(self.versions(connection, tags)), time.time() + ttl))
+        self.writes += 1
+        if self.writes % self.purge_interval == 0:
+            self.purge()
+        return True
+
+    def invalidate(self, tags):
+        connection = self.connect()
+        with connection:
+            for tag in list(tags) + [CLOCK]:
+                connection.execute('INSERT OR IGNORE INTO tags VALUES (?, 0)', (tag,))
+                connection.execute('UPDATE tags SET version = version + 1 WHERE tag = ?',
+                                   (tag,))
+
+    def purge(self):
+        connection = self.connect()
+        with connection:
+            connection.execute('DELETE FROM entries WHERE expires <= ?', (time.time(),))
+            connection.execute(
+                'DELETE FROM entries WHERE key IN ('
+                'SELECT key FROM entries ORDER BY expires LIMIT max(0, '
+                '(SELECT COUNT(*) FROM entries) - ?))', (self.maxsize,))
+
+    def clear(self):
+        connection = self.connect()
+        with connection:
+            connection.execute('DELETE FROM entries')
+        self.invalidate([])
+
+def add_tags(*tags):
+    '''Tag the response being rendered, if it is going to be cached.'''
+    pending = getattr(g, 'response_cache_tags', None)
+    if pending is not None:
+        pending.update(tags)
+
+def loaded_tag(instance):
+    '''The tag of a row shown in a response.'''
+    return '%s:%d' % (TAG_PREFIXES[type(instance)], instance.id)
+
+def changed_tags(instance):
+    '''The tags invalidated by a change to a row.'''
+    if isinstance(instance, Post):
+        return [loaded_tag(instance), 'posts', 'user:%d' % instance.author_id,
+                'user:%d:posts' % instance.author_id]
+    if isinstance(instance, Comment):
+        return [loaded_tag(instance), 'comments', 'post:%d' % instance.post_id,
+                'post:%d:comments' % instance.post_id]
+    if isinstance(instance, Follow):
+        return ['user:%d' % instance.follower_id, 'user:%d' % instance.followed_id,
+                'user:%d:followed' % instance.follower_id,
+                'user:%d:followers' % instance.followed_id]
+    if isinstance(instance, User):
+        return [loaded_tag(instance)]
+    return []
+
+class ResponseCache(object):
+    '''Flask extension caching whole responses, see the module documentation.'''
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        kind = app.config['FLASKY_RESPONSE_CACHE']
+        if kind == 'sqlite':
+            backend = SQLiteBackend(app.config['FLASKY_RESPONSE_CACHE_PATH'],
+                                    app.config['FLASKY_RESPONSE_CACHE_SIZE'])
+        elif kind == 'memory':
+            backend = MemoryBackend(app.config['FLASKY_RESPONSE_CACHE_SIZE'])
+        elif kind is None:
+            backend = None
+        else:
+            raise ValueError('unknown response cache backend %r' % kind)
+        app.extensions['response_cache'] = backend
+
+    def _backend(self, app=None):
+        return (app or current_app).extensions.get('response_cache')
+
+    def invalidate(self, tags, app=None):
+        backend = self._backend(app)
+        if backend is not None and tags:
+            backend.invalidate(tags)
+
+    def clear(self, app=None):
+        backend = self._backend(app)
+        if backend is not None:
+            backend.clear()
+
+    def version(self, tag, app=None):
+        '''The number of times `tag` was invalidated, as seen by every process
+        sharing the cache.'''
+        backend = self._backend(app)
+        return backend.version(tag) if backend is not None else 0
+
+    def viewer_class(self):
+        '''The permissions of the viewer, responses are never shared between
+        viewers with different permissions.'''
+        user = getattr(g, 'current_user', None) or current_user._get_current_object()
+        if user.is_anonymous:
+            return 'anonymous'
+        return str(user.role.permissions if user.role is not None else 0)
+
+    def make_key(self):
+        args = sorted(request.args.items(multi=True))
+        return json.dumps([request.base_url, args, self.viewer_class()])
+
+    def cached(self, *tags, **options):
+        '''Cache the responses of the decorated view, tagged with `tags` formatted
+        with the view arguments. With `anonymous_only=True` only the responses to
+        anonymous viewers are cached, for pages that show who is logged in.'''
+        anonymous_only = options.get('anonymous_only', False)
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                backend = self._backend()
+                if backend is None or request.method not in ('GET', 'HEAD') or \
+                        '_flashes' in session or \
+                        (anonymous_only and not current_user.is_anonymous):
+                    return f(*args, **kwargs)
+
+                key = self.make_key()
+                value = backend.get(key)
+                if value is not None:
+                    status, headers, body = value
+                    response = current_app.response_class(body, status, headers)
+                    return response.make_conditional(request)
+
+                clock = backend.clock()
+                g.response_cache_tags = set(tag.format(**kwargs) for tag in tags)
+                try:
+                    response = current_app.make_response(f(*args, **kwargs))
+                    pending = g.response_cache_tags
+                finally:
+                    g.response_cache_tags = None
+                if response.status_code == 200 and not response.is_streamed \
+                        and not session.modified and not read_replica():
+                    backend.set(key, (200, list(response.headers.items()),
+                                      response.get_data()),
+                                pending, current_app.config['FLASKY_RESPONSE_CACHE_TTL'],
+                                clock)
+                return response
+            return decorated_function
+        return decorator
+
+response_cache = ResponseCache()
+
+def on_load(target, context):
+    add_tags(loaded_tag(target))
+
+def on_flush(session, flush_context):
+    # Still the state from before the flush here, but with the ids assigned.
+    tags = session.info.setdefault('response_cache_tags', set())
+    for instance in session.new | session.deleted:
+        tags.update(changed_tags(instance))
+    for instance in session.dirty:
+        if session.is_modified(instance, include_collections=False):
+            tags.update(changed_tags(instance))
+
+def on_commit(session):
+    tags = session.info.pop('response_cache_tags', None)
+    if tags and _app_ctx_stack.top is not None:
+        response_cache.invalidate(tags)
+
+def on_rollback(session):
+    session.info.pop('response_cache_tags', None)
+
+for model in TAG_PREFIXES:
+    db.event.listen(model, 'load', on_load)
+db.event.listen(db.session, 'after_flush', on_flush)
+db.event.listen(db.session, 'after_commit', on_commit)
+db.event.listen(db.session, 'after_rollback', on_rollback)
@@ -0,0 +1,248 @@
+'''Full-text search over the bodies of posts and comments.
+
+Posts and comments share one index, in which every row is a document keyed by
+`doc_key()`: its id times two, plus one for comments. The index is written inside
+the flush of the row, on the same connection, so it commits or rolls back together
+with the change, like the timelines. A body is reindexed when it is set, which is
+also what triggers its rendering, and a comment is dropped from the index while it
+is disabled.
+
+Two implementations of the index are available:
+
+* a SQLite FTS5 virtual table, `search_fts`, ranked with BM25. It is used whenever
+  the database has FTS5 and `FLASKY_SEARCH_FTS5` is set;
+* an inverted index in a plain table, `search_terms`, holding the number of
+  occurrences of every term in every document, ranked with TF-IDF, for other
+  databases.
+
+Results are ranked from the most to the least relevant, and paginated with
+`keyset_paginate()` over the (score, document) pair, lower scores first. Every term
+of the query must appear in a document for it to match.
+
+The number of documents, which TF-IDF weights terms with, is counted at most every
+`FLASKY_SEARCH_DOCUMENT_COUNT_TTL` seconds per process; a weight that is off by a
+few documents changes nothing to the ranking.
+
+Rows inserted around the ORM, e.g. by `manage.py seed`, are not indexed until
+`reindex()` runs. It replaces the documents chunk by chunk, so searches keep
+finding the previously indexed ones meanwhile.
+'''
+import math
+import re
+from collections import Counter
+
+from flask import current_app
+
+from .cache import LRUCache
+from .exceptions import ValidationError
+from .models import db, Post, Comment
+from .pagination import keyset_paginate, KeysetPagination
+
+KINDS = (Post, Comment)
+
+# Longer words are cut to this length, queries keep this many terms.
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 10
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+terms_table = db.Table(
+    'search_terms', db.metadata,
+    db.Column('term', db.String(MAX_TERM_LENGTH), primary_key=True),
+    db.Column('doc', db.Integer, primary_key=True, index=True),
+    db.Column('count', db.Integer, nullable=False))
+
+# Not part of `db.metadata`, which can't describe a virtual table; it is created and
+# dropped together with the other tables by `create_fts()` and `drop_fts()`.
+fts_table = db.Table(
+    'search_fts', db.MetaData(),
+    db.Column('rowid', db.Integer, primary_key=True),
+    db.Column('body', db.Text))
+
+_fts5_available = {}
+_document_counts = LRUCache(16)
+
+def fts5_available(connection):
+    url = str(connection.engine.url)
+    if url not in _fts5_available:
+        _fts5_available[url] = connection.dialect.name == 'sqlite' and bool(
+            connection.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar())
+    return _fts5_available[url]
+
+def use_fts5(connection):
+    return current_app.config['FLASKY_SEARCH_FTS5'] and fts5_available(connection)
+
+# Only with the other tables of the primary, not on the empty binds of replicas.
+def create_fts(target, connection, **kwargs):
+    if terms_table in kwargs.get('tables', ()) and fts5_available(connection):
+        connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(body)')
+
+def drop_fts(target, connection, **kwargs):
+    if terms_table in kwargs.get('tables', ()) and fts5_available(connection):
+        connection.execute('DROP TABLE IF EXISTS search_fts')
+
+def tokenize(text):
+    return [token[:MAX_TERM_LENGTH] for token in TOKEN.findall(text.lower())]
+
+def doc_key(instance):
+    return instance.id * 2 + KINDS.index(type(instance))
+
+def index_document(connection, key, body):
+    '''Replace the indexed text of document `key` with `body`, or remove the document
+    if `body` is None.'''
+    if use_fts5(connection):
+        connection.execute(fts_table.delete().where(fts_table.c.rowid==key))
+        if body:
+            connection.execute(fts_table.insert().values(rowid=key, body=body))
+        return
+    connection.execute(terms_table.delete().where(terms_table.c.doc==key))
+    counts = Counter(tokenize(body or ''))
+    if counts:
+        connection.execute(terms_table.insert(), [
+            {'term': term, 'doc': key, 'count': count} for term, count in counts.items()])
+
+def indexed_body(instance):
+    if isinstance(instance, Comment) and instance.disabled:
+        return None
+    return instance.body
+
+def _fts5_matches(terms):
+    match = ' '.join('"%s"' % term for term in terms)
+    fts = db.literal_column('search_fts')
+    return db.select([fts_table.c.rowid.label('doc'),
+                      db.func.bm25(fts).label('score')]) \
+        .where(fts.op('MATCH')(match))
+
+def document_count():
+    '''The number of posts and comments, counted again once it is older than
+    `FLASKY_SEARCH_DOCUMENT_COUNT_TTL` seconds.'''
+    url = str(db.session.connection().engine.url)
+    count = _document_counts.get(url)
+    if count is None:
+        count = sum(db.session.query(db.func.count(model.id)).scalar() for model in KINDS)
+        _document_counts.set(url, count,
+                             ttl=current_app.config['FLASKY_SEARCH_DOCUMENT_COUNT_TTL'])
+    return count
+
+def _index_matches(terms):
+    frequencies = dict(db.session.query(terms_table.c.term, db.func.count())
+                       .filter(terms_table.c.term.in_(terms))
+                       .group_by(terms_table.c.term))
+    if len(frequencies) < len(terms):
+        return None
+    documents = document_count()
+    weights = dict((term, math.log(1.0 + float(documents) / frequencies[term]))
+                   for term in terms)
+    weight = db.case(weights, value=terms_table.c.term, else_=0.0)
+    # A float, not the Decimal some databases return, for the pagination cursor.
+    score = db.cast(-db.func.sum(terms_table.c.count * weight), db.Float)
+    return db.select([terms_table.c.doc, score.label('score')]) \
+        .where(terms_table.c.term.in_(terms)) \
+        .group_by(terms_table.c.doc) \
+        .having(db.func.count() == len(terms))
+
+def search(query, cursor=None, per_page=20):
+    '''The page of posts and comments matching `query` that follows `cursor`, most
+    relevant first. The items of the page are `Post` and `Comment` instances.'''
+    terms = []
+    for term in tokenize(query or ''):
+        if term not in terms:
+            terms.append(term)
+    if not terms:
+        raise ValidationError('nothing to search for')
+    terms = terms[:MAX_QUERY_TERMS]
+
+    if use_fts5(db.session.connection()):
+        matches = _fts5_matches(terms)
+    else:
+        matches = _index_matches(terms)
+        if matches is None:
+            # Some term is in no document at all.
+            return KeysetPagination([], False, False, None, None)
+    matches = matches.alias('matches')
+    pagination = keyset_paginate(
+        db.session.query(matches.c.score, matches.c.doc),
+        (matches.c.score, matches.c.doc), cursor, per_page=per_page, descending=False)
+
+    keys = [row.doc for row in pagination.items]
+    loaded = {}
+    for kind, model in enumerate(KINDS):
+        ids = [key // 2 for key in keys if key % 2 == kind]
+        if ids:
+            for instance in model.query.filter(model.id.in_(ids)).load_profile('search'):
+                loaded[doc_key(instance)] = instance
+    pagination.items = [loaded[key] for key in keys if key in loaded]
+    return pagination
+
+def _drop_documents(connection, kind, low, high, keep):
+    '''Remove the documents of `KINDS[kind]` with an id above `low` and up to
+    `high`, or without upper bound if `high` is None, except those in `keep`.'''
+    if use_fts5(connection):
+        table, column = fts_table, fts_table.c.rowid
+    else:
+        table, column = terms_table, terms_table.c.doc
+    condition = db.and_(column > low * 2 + kind, column % 2 == kind)
+    if high is not None:
+        condition = db.and_(condition, column <= high * 2 + kind)
+    if keep:
+        condition = db.and_(condition, ~column.in_(keep))
+    connection.execute(table.delete().where(condition))
+
+def reindex(batch_size=1000):
+    '''Rebuild the whole index, committing every `batch_size` rows. A generator
+    yielding the kind, number of rows and last id of every committed chunk.
+
+    Every chunk replaces the documents of its range of ids, and drops those of
+    rows that no longer exist, so the index is never empty meanwhile.
+    '''
+    connection = db.session.connection()
+    # The implementation not in use is only emptied.
+    if use_fts5(connection):
+        connection.execute(terms_table.delete())
+    elif fts5_available(connection):
+        connection.execute(fts_table.delete())
+    db.session.commit()
+    _document_counts.clear()
+    for kind, model in enumerate(KINDS):
+        name = model.__tablename__
+        last_id = 0
+        while True:
+            columns = [model.id, model.body]
+            if model is Comment:
+                columns.append(model.disabled)
+            rows = db.session.query(*columns).filter(model.id > last_id) \
+                .order_by(model.id).limit(batch_size).all()
+            connection = db.session.connection()
+            if not rows:
+                _drop_documents(connection, kind, last_id, None, [])
+                db.session.commit()
+                break
+            keys = []
+            for row in rows:
+                key = row.id * 2 + kind
+                body = None if getattr(row, 'disabled', False) else row.body
+                index_document(connection, key, body)
+                keys.append(key)
+            _drop_documents(connection, kind, last_id, rows[-1].id, keys)
+            db.session.commit()
+            last_id = rows[-1].id
+            yield name, len(rows), last_id
+
+def on_changed(target, value, oldvalue, initiator):
+    target._search_stale = True
+
+def on_written(mapper, connection, target):
+    if target.__dict__.pop('_search_stale', False):
+        index_document(connection, doc_key(target), indexed_body(target))
+
+def on_deleted(mapper, connection, target):
+    index_document(connection, doc_key(target), None)
+
+db.event.listen(db.metadata, 'after_create', create_fts)
+db.event.listen(db.metadata, 'before_drop', drop_fts)
+for model in KINDS:
+    db.event.listen(model.body, 'set', on_changed)
+    db.event.listen(model, 'after_insert', on_written)
+    db.event.listen(model, 'after_update', on_written)
+    db.event.listen(model, 'after_delete', on_deleted)
+db.event.listen(Comment.disabled, 'set', on_changed)
@@ -0,0 +1,183 @@
+'''Bulk loading of users, posts, comments and follows.
+
+`import_records()` loads the newline-delimited JSON written by `app.export`, and
+`seed()` generates a synthetic dataset that is the same for the same `seed` value,
+for benchmarking. Both insert rows with multi-row `INSERT` statements committed in
+chunks of `batch_size`, and never load a model instance. Rows keep the ids they are
+given, and PostgreSQL sequences are moved past them with `reset_sequence()`.
+
+Bulk inserts skip the mapper events that keep derived data up to date, so rows are
+inserted without their HTML, counters, timelines and search index entries.
+`rebuild_derived()` computes those afterwards, mostly in a few set-based statements,
+and renders the Markdown in a pool of processes.
+'''
+import hashlib
+import json
+import random
+from datetime import datetime, timedelta
+from itertools import islice
+
+from werkzeug.security import generate_password_hash
+
+from .exceptions import ValidationError
+from .export import parse_timestamp
+from .models import db, User, Role, Post, Comment, Follow, Timeline, CounterCache
+from .render import rerender_stale
+
+# The columns taken from the records of every type in an export.
+IMPORT_COLUMNS = {
+    'post': (Post, ('id', 'author_id', 'timestamp', 'body')),
+    'comment': (Comment, ('id', 'post_id', 'author_id', 'timestamp', 'disabled', 'body')),
+    'follow': (Follow, ('follower_id', 'followed_id', 'timestamp')),
+}
+
+# Synthetic rows are dated within the year before this day, so that a seed always
+# produces the same dataset.
+SEED_EPOCH = datetime(2017, 1, 1)
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+         'tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam '
+         'quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo '
+         'consequat duis aute irure in reprehenderit voluptate velit esse cillum '
+         'eu fugiat nulla pariatur excepteur sint occaecat cupidatat non proident '
+         'sunt culpa qui officia deserunt mollit anim id est laborum').split()
+
+def reset_sequence(model):
+    '''Move the sequence behind the `id` of `model` past the largest id, after rows
+    were inserted with explicit ids, so that the database doesn't hand out those ids
+    again. Only PostgreSQL needs it.'''
+    if db.session.get_bind(model.__mapper__).dialect.name != 'postgresql':
+        return
+    table = model.__tablename__
+    db.session.execute(
+        "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+        "COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM %s" % table,
+        {'table': table})
+    db.session.commit()
+
+def insert_chunks(model, rows, batch_size=1000):
+    '''Insert the dictionaries of `rows` into the table of `model`, committing every
+    `batch_size` rows. Returns the number of rows inserted.'''
+    table = model.__table__
+    rows = iter(rows)
+    count = 0
+    explicit_ids = False
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            break
+        explicit_ids = explicit_ids or 'id' in chunk[0]
+        db.session.execute(table.insert(), chunk)
+        db.session.commit()
+        count += len(chunk)
+    if explicit_ids:
+        reset_sequence(model)
+    return count
+
+def import_records(lines, batch_size=1000):
+    '''Insert the posts, comments and follows of an export, keeping their ids.
+    Returns the number of rows inserted per type.
+
+    The authors must exist already, and the posts must come before their comments,
+    as they do in an export.
+    '''
+    counts = dict((kind, 0) for kind in IMPORT_COLUMNS)
+    pending, pending_kind = [], None
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            model, columns = IMPORT_COLUMNS[record['type']]
+            row = dict((column, record[column]) for column in columns)
+        except (ValueError, KeyError, TypeError):
+            raise ValidationError('invalid record on line %d' % number)
+        row['timestamp'] = parse_timestamp(row['timestamp'])
+        if pending and (record['type'] != pending_kind or len(pending) >= batch_size):
+            counts[pending_kind] += insert_chunks(IMPORT_COLUMNS[pending_kind][0],
+                                                  pending, batch_size)
+            pending = []
+        pending_kind = record['type']
+        pending.append(row)
+    if pending:
+        counts[pending_kind] += insert_chunks(IMPORT_COLUMNS[pending_kind][0],
+                                              pending, batch_size)
+    return counts
+
+def _next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for i in range(words)).capitalize() + '.'
+
+def _timestamp(rng):
+    return SEED_EPOCH - timedelta(seconds=rng.randrange(365 * 24 * 3600))
+
+def seed(users=100, posts=1000, comments=5000, follows=20, seed=0, batch_size=1000,
+         password='cat'):
+    '''Insert a reproducible synthetic dataset: `users` users, `follows` followed
+    users per user, and `posts` posts and `comments` comments by random authors.
+    Every user gets the password `password`. Returns the number of rows inserted
+    per type.'''
+    rng = random.Random(seed)
+    # Hashing is slow on purpose, do it once for everybody.
+    password_hash = generate_password_hash(password)
+    role = Role.query.filter_by(default=True).first()
+    role_name = role.name if role is not None else None
+    first_user, first_post = _next_id(User), _next_id(Post)
+    user_ids = range(first_user, first_user + users)
+    post_ids = range(first_post, first_post + posts)
+
+    def user_rows():
+        for id in user_ids:
+            email = 'user%d@example.com' % id
+            yield {'id': id, 'email': email,
+                   'avatar_hash': hashlib.md5(email.encode('utf-8')).hexdigest(),
+                   'username': 'user%d' % id, 'password_hash': password_hash,
+                   'confirmed': True, 'role_name': role_name,
+                   'member_since': _timestamp(rng), 'last_seen': SEED_EPOCH}
+
+    def follow_rows():
+        for id in user_ids:
+            yield {'follower_id': id, 'followed_id': id, 'timestamp': SEED_EPOCH}
+            followed = rng.sample(user_ids, min(follows + 1, users))
+            for followed_id in [f for f in followed if f != id][:follows]:
+                yield {'follower_id': id, 'followed_id': followed_id,
+                       'timestamp': _timestamp(rng)}
+
+    def post_rows():
+        for id in post_ids:
+            yield {'id': id, 'author_id': rng.choice(user_ids),
+                   'timestamp': _timestamp(rng), 'body': _text(rng, rng.randint(5, 60))}
+
+    def comment_rows():
+        for i in range(comments):
+            yield {'post_id': rng.choice(post_ids), 'author_id': rng.choice(user_ids),
+                   'timestamp': _timestamp(rng), 'disabled': False,
+                   'body': _text(rng, rng.randint(3, 20))}
+
+    counts = {'user': insert_chunks(User, user_rows(), batch_size),
+              'follow': insert_chunks(Follow, follow_rows(), batch_size)}
+    counts['post'] = insert_chunks(Post, post_rows(), batch_size) if users else 0
+    counts['comment'] = insert_chunks(Comment, comment_rows(), batch_size) \
+        if users and posts else 0
+    return counts
+
+def rebuild_derived(pool=None, batch_size=500):
+    '''Recompute what bulk inserts left out: counters, timelines, the search index
+    and the HTML of posts and comments, rendered by `pool` when one is given.'''
+    from .fragments import fragment_cache
+    from .response_cache import response_cache
+    from .search import reindex
+
+    CounterCache.recount()
+    Timeline.rebuild()
+    rendered = 0
+    for model, kind in ((Post, 'post'), (Comment, 'comment')):
+        for count, last_id in rerender_stale(model, kind, batch_size, pool):
+            rendered += count
+    for kind, count, last_id in reindex(batch_size):
+        pass
+    response_cache.clear()
+    fragment_cache.clear()
+    return rendered
@@ -0,0 +1,47 @@
+'''URL templates for serializers.
+
+`url_for()` walks the URL map every time it is called, and `to_json()` calls it
+several times per object. The URLs of one endpoint only differ in the id they
+contain, so `url_template()` builds the URL once with a marker in place of the id,
+and the returned template fills ids in with plain string formatting.
+
+Templates are remembered per worker for every root URL they were built for (the
+scheme and host of external URLs come from the request), and looked up once per
+request.
+'''
+from flask import g, request, url_for
+
+from .cache import LRUCache
+
+# An id that no real row has, so it only shows up where the id goes.
+_MARKER = 918273645546372819
+
+_templates = LRUCache(maxsize=1024)
+
+class UrlTemplate(object):
+    '''The external URL of an endpoint taking an `id`, for any id.'''
+
+    def __init__(self, prefix, suffix):
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def __call__(self, id):
+        return '%s%d%s' % (self.prefix, id, self.suffix)
+
+def url_template(endpoint):
+    '''Returns the `UrlTemplate` of `endpoint` for the current request, so that
+    `url_template(endpoint)(id) == url_for(endpoint, id=id, _external=True)`.'''
+    templates = getattr(g, 'url_templates', None)
+    if templates is None:
+        templates = g.url_templates = {}
+    template = templates.get(endpoint)
+    if template is None:
+        key = (request.url_root, endpoint)
+        template = _templates.get(key)
+        if template is None:
+            url = url_for(endpoint, id=_MARKER, _external=True)
+            prefix, suffix = url.rsplit(str(_MARKER), 1)
+            template = UrlTemplate(prefix, suffix)
+            _templates.set(key, template)
+        templates[endpoint] = template
+    return template
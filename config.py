@@ -15,13 +15,82 @@ class Config(object):
     FLASKY_MAIL_SUBJECT_PREFIX = '[Flasky]'
     ADMIN = os.environ.get('ADMIN')
     FLASKY_MAIL_SENDER = 'Flasky Admin <flasky@example.com>'
+    FLASKY_MAIL_QUEUE_SIZE = 1000
+    FLASKY_MAIL_QUEUE_TIMEOUT = 5
+    FLASKY_MAIL_BATCH_SIZE = 20
+    FLASKY_MAIL_MAX_RETRIES = 3
+    FLASKY_MAIL_RETRY_BACKOFF = 1.0
+    FLASKY_MAIL_IDLE_TIMEOUT = 30
+    # Where the links of emails queued outside of requests point.
+    FLASKY_MAIL_BASE_URL = os.environ.get('FLASKY_MAIL_BASE_URL') or 'http://localhost:5000/'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     SQLALCHEMY_RECORD_QUERIES = True
     FLASKY_POSTS_PER_PAGE = 10
     FLASKY_COMMENTS_PER_PAGE = 10
     FLASKY_FOLLOWERS_PER_PAGE = 20
+    FLASKY_TIMELINE_LENGTH = 1000
     FLASKY_SLOW_DB_QUERY_TIME = 0.5
+    FLASKY_DB_METRICS = True
+    FLASKY_DB_METRICS_TOP = 5
+    FLASKY_DB_DUPLICATE_THRESHOLD = 3
+    # Send the `Server-Timing` header to every client, not only to administrators
+    # and in debug mode.
+    FLASKY_SERVER_TIMING = False
+    FLASKY_AUTH_TOKEN_CACHE_SIZE = 10000
+    FLASKY_AUTH_TOKEN_CACHE_TTL = 300
+    FLASKY_AUTH_CREDENTIAL_CACHE_SIZE = 10000
+    FLASKY_AUTH_CREDENTIAL_CACHE_TTL = 60
+    FLASKY_USER_CACHE_SIZE = 10000
+    FLASKY_USER_CACHE_TTL = 60
+    FLASKY_LAST_SEEN_RESOLUTION = 60
+    FLASKY_LAST_SEEN_FLUSH_INTERVAL = 30
+    FLASKY_LAST_SEEN_BATCH_SIZE = 500
+    FLASKY_LAST_SEEN_CACHE_SIZE = 10000
+    # 'memory' (private to every process, for development and tests), 'sqlite'
+    # (shared by the workers of one host, see ProductionConfig) or None.
+    FLASKY_RESPONSE_CACHE = 'memory'
+    FLASKY_RESPONSE_CACHE_PATH = os.path.join(basedir, 'response-cache.sqlite')
+    FLASKY_RESPONSE_CACHE_SIZE = 1000
+    FLASKY_RESPONSE_CACHE_TTL = 300
+    FLASKY_API_BATCH_LIMIT = 100
+    FLASKY_SEARCH_FTS5 = True
+    FLASKY_SEARCH_DOCUMENT_COUNT_TTL = 300
+    FLASKY_SEARCH_RESULTS_PER_PAGE = 20
+    FLASKY_DB_PROFILE = 'auto'
+    FLASKY_DB_MAX_CONNECTIONS = 20
+    # Gunicorn processes sharing FLASKY_DB_MAX_CONNECTIONS, see nginx_gunicorn.conf.
+    FLASKY_DB_WORKERS = int(os.environ.get('WEB_CONCURRENCY') or 3)
+    FLASKY_DB_POOL_SIZE = None
+    FLASKY_DB_POOL_TIMEOUT = 10
+    FLASKY_DB_POOL_RECYCLE = 1800
+    FLASKY_DB_STATEMENT_TIMEOUT = 30000
+    FLASKY_SQLITE_POOL_SIZE = 5
+    FLASKY_SQLITE_MAX_OVERFLOW = 10
+    FLASKY_SQLITE_BUSY_TIMEOUT = 5000
+    FLASKY_SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+    # Comma separated URLs of read replicas, see app/replicas.py.
+    FLASKY_DB_REPLICAS = [url.strip() for url in
+                          (os.environ.get('DATABASE_REPLICA_URLS') or '').split(',')
+                          if url.strip()]
+    FLASKY_DB_REPLICA_MAX_LAG = 10
+    FLASKY_DB_REPLICA_CHECK_INTERVAL = 2
+    FLASKY_DB_READ_YOUR_WRITES = 5
+    FLASKY_TEMPLATE_BYTECODE_DIR = os.path.join(basedir, 'tmp', 'jinja-bytecode')
+    FLASKY_FRAGMENT_CACHE_SIZE = 5000
+    FLASKY_FRAGMENT_CACHE_TTL = 3600
+    # 'local' for identicons rendered by the application, or 'gravatar'.
+    FLASKY_AVATARS = 'local'
+    FLASKY_AVATAR_DIR = os.path.join(basedir, 'app', 'static', 'avatars')
+    FLASKY_AVATAR_SIZES = (32, 40, 64, 128, 256)
+    FLASKY_AVATAR_MAX_AGE = 365 * 24 * 3600
+    FLASKY_AVATAR_URL_CACHE_SIZE = 10000
+    FLASKY_PROFILE_DIR = os.path.join(basedir, 'tmp', 'profiles')
+    FLASKY_PROFILE_TOKEN = os.environ.get('FLASKY_PROFILE_TOKEN')
+    FLASKY_PROFILE_SAMPLE_RATE = float(os.environ.get('FLASKY_PROFILE_SAMPLE_RATE') or 0)
+    FLASKY_PROFILE_INTERVAL = 0.005
+    FLASKY_PROFILE_TRACEMALLOC = bool(os.environ.get('FLASKY_PROFILE_TRACEMALLOC'))
+    FLASKY_PROFILE_TOP_ALLOCATIONS = 20
     SSL_DISABLE = True
 
     @staticmethod
@@ -31,6 +100,8 @@ class Config(object):
 class ProductionConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'data.sqlite')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Shared by the gunicorn workers, so that an invalidation reaches all of them.
+    FLASKY_RESPONSE_CACHE = 'sqlite'
 
     @classmethod
     def init_app(cls, app):
@@ -70,6 +141,26 @@ class TestingConfig(Config):
     # response and extract the token so that it can then send the token with the form data.
     # It is better to disable CSRF protection in the testing configuration.
     WTF_CSRF_ENABLED = False
+    FLASKY_TEMPLATE_BYTECODE_DIR = None
+
+class BenchmarkConfig(Config):
+    '''Settings of `manage.py benchmark`, and of the gunicorn workers it starts.'''
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL') or \
+        'sqlite:///' + os.path.join(basedir, 'data-bench.sqlite')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Needed for the query counts of the `Server-Timing` header outside debug mode.
+    SQLALCHEMY_RECORD_QUERIES = True
+    FLASKY_SERVER_TIMING = True
+    # The login form is posted without first fetching its CSRF token.
+    WTF_CSRF_ENABLED = False
+
+    @classmethod
+    def init_app(cls, app):
+        Config.init_app(app)
+        # Read again, as `manage.py benchmark --database-url` sets it after this
+        # module was imported; the gunicorn workers it starts inherit it.
+        if os.environ.get('BENCH_DATABASE_URL'):
+            app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['BENCH_DATABASE_URL']
 
 class HerokuConfig(ProductionConfig):
 
@@ -98,6 +189,7 @@ config = {
     'development': DevelopmentConfig,
     'testing': TestingConfig,
     'production': ProductionConfig,
+    'benchmark': BenchmarkConfig,
     'default': DevelopmentConfig,
     'heroku': HerokuConfig
 }
\ No newline at end of file
@@ -1,9 +1,10 @@
 import os
 
-from flask_script import Manager, Shell
+from flask_script import Manager, Shell, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 
-from app.models import db, User, Role, Permission, Follow, Comment, Post
+from app.models import db, User, Role, Permission, Follow, Comment, Post, Timeline, \
+    CounterCache
 from app import create_app
 
 COV = None
@@ -16,13 +17,14 @@ if os.environ.get('FLASK_COVERAGE'):
     COV.start()
 
 
-app = create_app('default')
+app = create_app(os.getenv('FLASK_CONFIG') or 'default')
 manager = Manager(app)
 migrate = Migrate(app, db)
 
 def make_shell_context():
     return dict(app=app, db=db, User=User, Role=Role, Post=Post,
-                Permission=Permission, Follow=Follow, Comment=Comment)
+                Permission=Permission, Follow=Follow, Comment=Comment,
+                Timeline=Timeline)
 
 manager.add_command('shell', Shell(make_context=make_shell_context))
 manager.add_command('db', MigrateCommand)
@@ -52,13 +54,282 @@ def test(coverage=False):
         COV.erase()
 
 @manager.command
-def profile(length=25, profile_dir=None):
-    '''Start the application under the code profiler.'''
+def profile(length=25, profile_dir=None, sampling=False, tracemalloc=False):
+    '''Start the application under the code profiler.
+
+    With --sampling every request is profiled by the sampling profiler instead,
+    which writes a flame graph, the SQL and, with --tracemalloc, the allocations of
+    every request under profile_dir, see `app/profiling.py`.'''
+    if sampling:
+        app.config['FLASKY_PROFILE_SAMPLE_RATE'] = 1.0
+        if profile_dir:
+            app.config['FLASKY_PROFILE_DIR'] = profile_dir
+        if tracemalloc:
+            import tracemalloc as tracemalloc_module
+            tracemalloc_module.start()
+        print('Writing profiles to %s' % app.config['FLASKY_PROFILE_DIR'])
+        app.run()
+        return
     from werkzeug.contrib.profiler import ProfilerMiddleware
     app.wsgi_app = ProfilerMiddleware(app.wsgi_app, restrictions=[length],
                                       profile_dir=profile_dir)
     app.run()
 
+@manager.command
+def flamegraph(endpoint, profile_dir=None):
+    '''Merge the sampled profiles of an endpoint into one flame graph.'''
+    from app.profiling import merge_profiles, endpoint_dir
+    base = profile_dir or app.config['FLASKY_PROFILE_DIR']
+    count = merge_profiles(base, endpoint)
+    print('Merged %d profiles into %s' % (
+        count, os.path.join(endpoint_dir(base, endpoint), 'all.svg')))
+
+@manager.command
+def timelines(rebuild=False):
+    '''Trim the precomputed home timelines, or rebuild them from scratch.'''
+    if rebuild:
+        print('Rebuilt %d timelines.' % Timeline.rebuild())
+    else:
+        print('Trimmed %d timelines.' % Timeline.trim_all())
+
+@manager.command
+def recount():
+    '''Rebuild the denormalized post, comment and follower counters.'''
+    for counter, repaired in sorted(CounterCache.recount().items()):
+        print('%s: repaired %d rows' % (counter, repaired))
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500,
+                help='Rows rendered and committed per batch')
+@manager.option('-p', '--processes', dest='processes', type=int, default=0,
+                help='Renderer processes, defaults to one per CPU')
+def rerender(batch_size, processes):
+    '''Re-render post and comment HTML left behind by an older renderer version.'''
+    from multiprocessing import Pool
+    from app.render import rerender_stale
+    from app.fragments import fragment_cache
+    from app.response_cache import response_cache
+
+    # `processes=0` lets the pool start one worker per CPU.
+    pool = Pool(processes or None)
+    try:
+        for model, kind in ((Post, 'post'), (Comment, 'comment')):
+            done = 0
+            for count, last_id in rerender_stale(model, kind, batch_size, pool):
+                done += count
+                print('%s: re-rendered %d rows, up to id %d' % (kind, done, last_id))
+    finally:
+        pool.close()
+        pool.join()
+        # The rows were updated behind the ORM's back, cached pages can't tell.
+        response_cache.clear()
+        fragment_cache.clear()
+
+@manager.option('-d', '--driver', dest='driver', default='client',
+                help='client to go through the Flask test client, gunicorn for HTTP')
+@manager.option('-n', '--requests', dest='requests', type=int, default=200,
+                help='Timed requests per scenario')
+@manager.option('-c', '--concurrency', dest='concurrency', type=int, default=1,
+                help='Simulated viewers sending requests at the same time')
+@manager.option('-w', '--workers', dest='workers', type=int, default=2,
+                help='gunicorn worker processes')
+@manager.option('--scenarios', dest='scenarios', default=None,
+                help='Comma separated scenarios to run, defaults to all of them')
+@manager.option('--users', dest='users', type=int, default=100)
+@manager.option('--posts', dest='posts', type=int, default=1000)
+@manager.option('--comments', dest='comments', type=int, default=5000)
+@manager.option('--follows', dest='follows', type=int, default=20)
+@manager.option('--reuse', dest='reuse', action='store_true', default=False,
+                help='Benchmark the existing database instead of seeding a new one')
+@manager.option('--database-url', dest='database_url', default=None,
+                help='Database to seed and benchmark, e.g. a local PostgreSQL')
+@manager.option('--save', dest='save', default=None,
+                help='Write the results to this JSON file')
+@manager.option('--baseline', dest='baseline', default=None,
+                help='Compare the results with those saved in this JSON file')
+@manager.option('--tolerance', dest='tolerance', type=float, default=0.1,
+                help='Relative slowdown tolerated before failing against the baseline')
+def benchmark(driver, requests, concurrency, workers, scenarios, users, posts,
+              comments, follows, reuse, database_url, save, baseline, tolerance):
+    '''Measure the throughput and latency of the web and API hot paths.'''
+    import json
+    from app import benchmark as bench
+
+    if database_url:
+        os.environ['BENCH_DATABASE_URL'] = database_url
+    bench_app = create_app('benchmark')
+    with bench_app.app_context():
+        if not reuse:
+            print('Seeding %d users, %d posts and %d comments...' % (users, posts, comments))
+            bench.prepare(users, posts, comments, follows)
+        dataset = bench.Dataset.load()
+    # Outside of the application context, so that every request pushes its own and
+    # the queries recorded for one request don't add up with those of the others.
+    options = dict(scenarios=scenarios.split(',') if scenarios else None,
+                   requests=requests, concurrency=concurrency)
+    if driver == 'gunicorn':
+        with bench.GunicornServer(workers) as server:
+            results = bench.run(lambda: bench.HTTPSession(server.base_url),
+                                dataset, **options)
+    else:
+        results = bench.run(lambda: bench.ClientSession(bench_app), dataset, **options)
+
+    print('%-16s %8s %9s %9s %9s %9s %8s' % (
+        'scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'errors'))
+    for name, stats in sorted(results.items()):
+        print('%-16s %8.1f %9.2f %9.2f %9.2f %9s %8d' % (
+            name, stats['rps'], stats['p50'], stats['p95'], stats['p99'],
+            '-' if stats['queries'] is None else '%.1f' % stats['queries'],
+            stats['errors']))
+    if save:
+        with open(save, 'w') as f:
+            json.dump({'driver': driver, 'concurrency': concurrency,
+                       'results': results}, f, indent=2, sort_keys=True)
+    if baseline:
+        with open(baseline) as f:
+            saved = json.load(f)
+        regressions = 0
+        for name, metric, old, new, change, regressed in bench.compare(
+                results, saved['results'], tolerance):
+            regressions += regressed
+            print('%-16s %-8s %10.2f -> %10.2f %+7.1f%%%s' % (
+                name, metric, old, new, change * 100, '  REGRESSION' if regressed else ''))
+        if regressions:
+            print('%d regressions against %s.' % (regressions, baseline))
+            return 1
+
+@manager.option('-o', '--output', dest='output', default=None,
+                help='File to write to, defaults to standard output')
+@manager.option('-t', '--types', dest='types', default='posts,comments,follows',
+                help='Comma separated list of posts, comments and follows')
+@manager.option('-a', '--author', dest='author', type=int, default=None,
+                help='Only rows created by this user id')
+@manager.option('-s', '--since', dest='since', default=None,
+                help='Only rows created at or after this ISO 8601 UTC timestamp')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+                help='Rows fetched from the database at a time')
+def export(output, types, author, since, batch_size):
+    '''Export posts, comments and follows as newline-delimited JSON.'''
+    import sys
+    from app.export import export_records, ndjson, parse_kinds, parse_timestamp
+
+    if since is not None:
+        since = parse_timestamp(since)
+    records = export_records(parse_kinds(types), author=author, since=since,
+                             batch_size=batch_size)
+    out = open(output, 'w') if output else sys.stdout
+    try:
+        for line in ndjson(records):
+            out.write(line)
+    finally:
+        if output:
+            out.close()
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+                help='Rows indexed and committed per batch')
+def reindex(batch_size):
+    '''Rebuild the full-text search index of posts and comments.'''
+    from app.search import reindex as reindex_all
+    done = {}
+    for kind, count, last_id in reindex_all(batch_size):
+        done[kind] = done.get(kind, 0) + count
+        print('%s: indexed %d rows, up to id %d' % (kind, done[kind], last_id))
+
+def rebuild_after_bulk_load(processes):
+    from multiprocessing import Pool
+    from app.seed import rebuild_derived
+
+    print('Rebuilding counters and timelines, rendering posts and comments...')
+    pool = Pool(processes or None)
+    try:
+        print('Rendered %d posts and comments.' % rebuild_derived(pool))
+    finally:
+        pool.close()
+        pool.join()
+
+@manager.option('-u', '--users', dest='users', type=int, default=100)
+@manager.option('-p', '--posts', dest='posts', type=int, default=1000)
+@manager.option('-c', '--comments', dest='comments', type=int, default=5000)
+@manager.option('-f', '--follows', dest='follows', type=int, default=20,
+                help='Users followed by every user')
+@manager.option('-s', '--seed', dest='seed', type=int, default=0,
+                help='The same seed always generates the same dataset')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+                help='Rows inserted and committed at a time')
+@manager.option('--processes', dest='processes', type=int, default=0,
+                help='Renderer processes, defaults to one per CPU')
+def seed(users, posts, comments, follows, seed, batch_size, processes):
+    '''Bulk insert a reproducible synthetic dataset, e.g. for benchmarks.'''
+    from app.seed import seed as seed_dataset
+
+    counts = seed_dataset(users, posts, comments, follows, seed, batch_size)
+    for kind, count in sorted(counts.items()):
+        print('Inserted %d %ss.' % (count, kind))
+    rebuild_after_bulk_load(processes)
+
+class Import(Command):
+    '''Bulk insert the posts, comments and follows of an export.'''
+
+    option_list = (
+        Option('input', help='File written by the export command, - for standard input'),
+        Option('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+               help='Rows inserted and committed at a time'),
+        Option('--processes', dest='processes', type=int, default=0,
+               help='Renderer processes, defaults to one per CPU'),
+    )
+
+    def run(self, input, batch_size, processes):
+        import sys
+        from app.seed import import_records
+
+        lines = sys.stdin if input == '-' else open(input)
+        try:
+            counts = import_records(lines, batch_size)
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        for kind, count in sorted(counts.items()):
+            print('Imported %d %ss.' % (count, kind))
+        rebuild_after_bulk_load(processes)
+
+manager.add_command('import', Import())
+
+graph = Manager(usage='Maintain the follow graph')
+manager.add_command('graph', graph)
+
+def report(operation, chunks):
+    total = 0
+    for count, last_id in chunks:
+        total += count
+        print('%s: %d rows, up to user id %d' % (operation, total, last_id))
+    return total
+
+@graph.option('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+              help='Users per transaction')
+def self_follows(batch_size):
+    '''Make every user follow themselves.'''
+    from app.graph import ensure_self_follows
+    print('Added %d self-follows.' % report('self-follows', ensure_self_follows(batch_size)))
+
+@graph.option('-b', '--batch-size', dest='batch_size', type=int, default=1000,
+              help='Users per transaction')
+def recount(batch_size):
+    '''Repair the follower and followed counters.'''
+    from app.graph import recount_follows
+    print('Repaired %d counters.' % report('recount', recount_follows(batch_size)))
+
+@graph.command
+def dedupe():
+    '''Collapse repeated follows into one.'''
+    from app.graph import dedupe_follows
+    print('Removed %d duplicate follows.' % dedupe_follows())
+
+@graph.command
+def purge():
+    '''Delete follows and timeline entries of users or posts that no longer exist.'''
+    from app.graph import purge_orphans
+    for table, count in sorted(purge_orphans().items()):
+        print('Deleted %d orphaned %s.' % (count, table))
+
 @manager.command
 def deploy():
     '''Run deployment tasks.'''
@@ -5,8 +5,10 @@ https://docs.pytest.org/en/latest/fixture.html?highlight=fixture
 import pytest
 import os
 
-from app import create_app
-from app.models import db, User, Post, Comment, Role
+from app import create_app, mail
+from app.last_seen import recorder
+from app.models import db, User, Post, Comment, Role, UserCache
+from .smtp_sink import SMTPSink
 
 @pytest.fixture()
 def app(request):
@@ -17,6 +19,7 @@ def app(request):
     Role.insert_roles()
 
     def teardown():
+        recorder.flush(app)
         db.session.remove()
         db.drop_all()
         app_context.pop()
@@ -35,10 +38,53 @@ def client(request):
     client = app.test_client(use_cookies=True)
 
     def teardown():
+        recorder.flush(app)
         db.session.remove()
         db.drop_all()
         test_request_context.pop()
 
     request.addfinalizer(teardown)
 
-    return client
\ No newline at end of file
+    return client
+
+@pytest.fixture()
+def assert_constant_queries():
+    '''Returns a helper asserting that `render(n)` issues the same number of SQL
+    statements for every `n` in `sizes`, i.e. that a page costs a fixed number of
+    queries however many rows it shows instead of one more query per row.
+    '''
+    def count_queries(f, *args):
+        # The test client shares the session of the test, start from an empty
+        # identity map and user cache so that every run has to load what it shows.
+        db.session.expunge_all()
+        UserCache.snapshots.clear()
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            f(*args)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return statements
+
+    def assert_constant(render, sizes=(2, 5, 10)):
+        counts = dict((size, len(count_queries(render, size))) for size in sizes)
+        assert len(set(counts.values())) == 1, \
+            'query count grows with page size: %r' % counts
+
+    return assert_constant
+
+
+@pytest.fixture()
+def smtp_sink(request, app):
+    '''Points the mail settings of `app` at a local `SMTPSink`.'''
+    sink = SMTPSink().start()
+    app.config.update(MAIL_SERVER=sink.host, MAIL_PORT=sink.port,
+                      MAIL_USE_TLS=False, MAIL_USE_SSL=False,
+                      MAIL_USERNAME=None, MAIL_SUPPRESS_SEND=False,
+                      FLASKY_MAIL_RETRY_BACKOFF=0.01)
+    # Flask-Mail copies its settings when it is initialized.
+    mail.init_app(app)
+    request.addfinalizer(sink.stop)
+    return sink
@@ -0,0 +1,80 @@
+'''A local stand-in for an SMTP server.
+
+It speaks just enough SMTP for `smtplib` to deliver to it, keeps every message it
+receives in memory, and can be told to reject the next few messages to exercise
+retries. It does not offer STARTTLS or AUTH, so point `MAIL_SERVER`/`MAIL_PORT` at
+it with `MAIL_USE_TLS` off and without credentials.
+'''
+import socketserver
+import threading
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        sink = self.server.sink
+        with sink.lock:
+            sink.connections += 1
+        self.reply('220 localhost Flasky SMTP sink')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:].strip('<>'), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command[8:].strip('<>'))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    line = self.rfile.readline().decode('utf-8')
+                    if line.rstrip('\r\n') == '.':
+                        break
+                    # Undo the dot-stuffing of the client.
+                    lines.append(line[1:] if line.startswith('..') else line)
+                with sink.lock:
+                    reject = sink.reject > 0
+                    if reject:
+                        sink.reject -= 1
+                    else:
+                        sink.messages.append((sender, recipients, ''.join(lines)))
+                self.reply('451 Try again later' if reject else '250 OK')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+class SMTPSink(object):
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.messages = []
+        self.connections = 0
+        self.reject = 0
+        self.lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer((host, port), _SMTPHandler)
+        self.server.daemon_threads = True
+        self.server.sink = self
+        self.host, self.port = self.server.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,97 @@
+import json
+from base64 import b64encode
+
+import pytest
+from flask import url_for
+
+from app.api_1_0 import authentication
+from app.models import db, User, Role, RowVersion
+
+def api_headers(username, password=''):
+    return {
+        'Authorization': 'Basic ' + b64encode(
+            (username + ':' + password).encode('utf-8')).decode('utf-8'),
+        'Accept': 'application/json',
+        'Content-Type': 'application/json'
+    }
+
+@pytest.mark.usefixtures('client')
+class TestAuthCache(object):
+
+    def add_user(self):
+        user = User(email='john@example.com', username='john', password='cat',
+                    confirmed=True, role=Role.query.filter_by(name='User').first())
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def test_credentials_are_cached(self, client, monkeypatch):
+        self.add_user()
+        headers = api_headers('john@example.com', 'cat')
+        assert client.get(url_for('api.get_posts'), headers=headers).status_code == 200
+
+        def verify_password(self, password):
+            raise AssertionError('password hashed again')
+        monkeypatch.setattr(User, 'verify_password', verify_password)
+        assert client.get(url_for('api.get_posts'), headers=headers).status_code == 200
+
+    def test_wrong_password_is_not_cached(self, client):
+        self.add_user()
+        headers = api_headers('john@example.com', 'dog')
+        assert client.get(url_for('api.get_posts'), headers=headers).status_code == 401
+        assert client.get(url_for('api.get_posts'), headers=headers).status_code == 401
+
+    def test_password_change_invalidates(self, client):
+        user = self.add_user()
+        headers = api_headers('john@example.com', 'cat')
+        assert client.get(url_for('api.get_posts'), headers=headers).status_code == 200
+        user.password = 'dog'
+        db.session.commit()
+        assert client.get(url_for('api.get_posts'), headers=headers).status_code == 401
+        response = client.get(url_for('api.get_posts'),
+                              headers=api_headers('john@example.com', 'dog'))
+        assert response.status_code == 200
+
+    def test_email_change_invalidates(self, client):
+        user = self.add_user()
+        headers = api_headers('john@example.com', 'cat')
+        assert client.get(url_for('api.get_posts'), headers=headers).status_code == 200
+        user.email = 'johnny@example.com'
+        db.session.commit()
+        assert client.get(url_for('api.get_posts'), headers=headers).status_code == 401
+        response = client.get(url_for('api.get_posts'),
+                              headers=api_headers('johnny@example.com', 'cat'))
+        assert response.status_code == 200
+
+    def test_token(self, client):
+        user = self.add_user()
+        response = client.get(url_for('api.get_token'),
+                              headers=api_headers('john@example.com', 'cat'))
+        token = json.loads(response.get_data(as_text=True))['token']
+        headers = api_headers(token)
+        assert client.get(url_for('api.get_posts'), headers=headers).status_code == 200
+        assert authentication.token_cache.get(token) is not None
+        assert client.get(url_for('api.get_posts'), headers=headers).status_code == 200
+
+        # Tokens of a user who lost their role are no longer honoured from the cache.
+        user.role = Role.query.filter_by(name='Moderator').first()
+        db.session.commit()
+        assert authentication.cached_user_id(authentication.token_cache, token) is None
+        # Tokens can't be used to get a new token.
+        assert client.get(url_for('api.get_token'), headers=headers).status_code == 401
+
+    def test_change_by_another_process_invalidates(self, client):
+        user = self.add_user()
+        headers = api_headers('john@example.com', 'cat')
+        assert client.get(url_for('api.get_posts'), headers=headers).status_code == 200
+        digest = authentication.credential_digest('john@example.com', 'cat')
+        assert authentication.cached_user_id(authentication.credential_cache, digest) == user.id
+
+        # Written without the ORM, as another process would, and never seen here.
+        users = User.__table__
+        values = RowVersion.bump(users)
+        values['password_hash'] = 'x'
+        db.session.execute(users.update().where(users.c.id==user.id).values(values))
+        db.session.commit()
+        assert authentication.cached_user_id(authentication.credential_cache, digest) is None
+        assert client.get(url_for('api.get_posts'), headers=headers).status_code == 401
@@ -0,0 +1,68 @@
+import hashlib
+import os
+import struct
+import zlib
+
+from flask import url_for
+
+from app.avatars import identicon, avatar_size
+from app.models import db, User, Role
+
+def decode(data):
+    '''Width, height and rows of pixels of an 8-bit RGB PNG made by `identicon`.'''
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    width, height = struct.unpack('>II', data[16:24])
+    length, = struct.unpack('>I', data[33:37])
+    raw = zlib.decompress(data[41:41 + length])
+    stride = width * 3 + 1
+    return width, height, [raw[i * stride + 1:(i + 1) * stride] for i in range(height)]
+
+class TestAvatars(object):
+
+    def test_identicon(self):
+        digest = hashlib.md5(b'john@example.com').hexdigest()
+        data = identicon(digest, 40)
+        assert identicon(digest, 40) == data
+        assert identicon(hashlib.md5(b'susan@example.com').hexdigest(), 40) != data
+        width, height, rows = decode(data)
+        assert (width, height) == (40, 40)
+        for row in rows:
+            assert len(row) == 120
+            pixels = [row[i:i + 3] for i in range(0, 120, 3)]
+            assert pixels == pixels[::-1]
+
+    def test_url(self, client):
+        user = User(email='john@example.com', username='john', password='cat',
+                    role=Role.query.filter_by(name='User').first())
+        db.session.add(user)
+        db.session.commit()
+        url = user.avatar_url(36)
+        assert url == url_for('main.avatar', size=40, digest=user.avatar_hash)
+        assert avatar_size(1000) == 256
+        cache = client.application.extensions['avatar_urls']
+        assert len(cache) == 1
+        user.avatar_url(36)
+        assert len(cache) == 1
+
+        client.application.config['FLASKY_AVATARS'] = 'gravatar'
+        assert 'gravatar.com' in user.avatar_url(36)
+
+    def test_route(self, client, tmpdir):
+        client.application.config['FLASKY_AVATAR_DIR'] = str(tmpdir)
+        db.session.add(User(email='john@example.com', username='john', password='cat'))
+        db.session.commit()
+        digest = hashlib.md5(b'john@example.com').hexdigest()
+        response = client.get('/avatars/40/%s.png' % digest)
+        assert response.status_code == 200
+        assert response.mimetype == 'image/png'
+        assert 'immutable' in response.headers['Cache-Control']
+        assert response.get_data() == identicon(digest, 40)
+        assert os.listdir(str(tmpdir.join('40'))) == [digest + '.png']
+
+        assert client.get('/avatars/41/%s.png' % digest).status_code == 404
+        assert client.get('/avatars/40/..%2fetc.png').status_code == 404
+
+        # Hashes of nobody are neither drawn nor written.
+        unknown = hashlib.md5(b'nobody@example.com').hexdigest()
+        assert client.get('/avatars/40/%s.png' % unknown).status_code == 404
+        assert os.listdir(str(tmpdir.join('40'))) == [digest + '.png']
@@ -0,0 +1,63 @@
+import json
+from base64 import b64encode
+
+import pytest
+
+from app.models import db, User, Role, Post
+
+def api_headers(**headers):
+    headers.update({
+        'Authorization': 'Basic ' + b64encode(
+            'john@example.com:cat'.encode('utf-8')).decode('utf-8'),
+        'Accept': 'application/json'
+    })
+    return headers
+
+@pytest.mark.usefixtures('client')
+class TestBatchEndpoints(object):
+
+    def add_posts(self):
+        role = Role.query.filter_by(name='User').first()
+        john = User(email='john@example.com', username='john', password='cat',
+                    confirmed=True, role=role)
+        susan = User(email='susan@example.com', username='susan', password='dog',
+                     confirmed=True, role=role)
+        posts = [Post(body='post %d' % i, author=john if i % 2 else susan)
+                 for i in range(3)]
+        db.session.add_all(posts)
+        db.session.commit()
+        return john.id, susan.id, [post.id for post in posts]
+
+    def test_posts(self, client):
+        john, susan, posts = self.add_posts()
+        ids = [posts[2], 999, posts[0], posts[2]]
+        response = client.get('/api/v1.0/posts/?ids=%s' % ','.join(map(str, ids)),
+                              headers=api_headers())
+        assert response.status_code == 200
+        payload = json.loads(response.get_data(as_text=True))
+        assert [post['body'] for post in payload['posts']] == ['post 2', 'post 0']
+        assert payload['missing'] == [999]
+
+        etag = response.headers['ETag']
+        response = client.get('/api/v1.0/posts/?ids=%s' % ','.join(map(str, ids)),
+                              headers=api_headers(**{'If-None-Match': etag}))
+        assert response.status_code == 304
+
+    def test_users(self, client):
+        john, susan, posts = self.add_posts()
+        response = client.get('/api/v1.0/users/?ids=%d,%d' % (susan, john),
+                              headers=api_headers())
+        assert response.status_code == 200
+        payload = json.loads(response.get_data(as_text=True))
+        assert [user['username'] for user in payload['users']] == ['susan', 'john']
+        assert payload['missing'] == []
+
+    def test_invalid_ids(self, client, app):
+        self.add_posts()
+        for ids in ('', '1,x', ','.join(str(i) for i in range(
+                app.config['FLASKY_API_BATCH_LIMIT'] + 1))):
+            response = client.get('/api/v1.0/users/?ids=' + ids,
+                                  headers=api_headers())
+            assert response.status_code == 400
+        response = client.get('/api/v1.0/users/', headers=api_headers())
+        assert response.status_code == 400
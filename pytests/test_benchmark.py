@@ -0,0 +1,41 @@
+from app import benchmark
+from app.models import Post
+
+class TestBenchmark(object):
+
+    def test_statistics(self):
+        latencies = [i / 1000.0 for i in range(100, 0, -1)]
+        stats = benchmark.summarize(latencies, [2, 4], 1, 2.0)
+        assert stats['requests'] == 100
+        assert stats['rps'] == 50
+        assert (stats['p50'], stats['p95'], stats['p99']) == (50, 95, 99)
+        assert stats['queries'] == 3
+        assert benchmark.percentile([], 0.5) is None
+
+    def test_compare(self):
+        baseline = {'post': {'rps': 100.0, 'p95': 10.0, 'queries': 2.0}}
+        results = {'post': {'rps': 95.0, 'p95': 12.0, 'queries': 3.0},
+                   'index': {'rps': 1.0}}
+        rows = dict(((name, metric), regressed) for name, metric, old, new, change,
+                    regressed in benchmark.compare(results, baseline, tolerance=0.1))
+        assert rows == {('post', 'rps'): False, ('post', 'p95'): True,
+                        ('post', 'queries'): True}
+
+    def test_run(self, app):
+        benchmark.prepare(users=5, posts=10, comments=10, follows=2)
+        dataset = benchmark.Dataset.load()
+        results = benchmark.run(lambda: benchmark.ClientSession(app), dataset,
+                                requests=4, concurrency=2, warmup=1)
+        assert sorted(results) == sorted(name for name, auth, build, status
+                                         in benchmark.SCENARIOS)
+        for stats in results.values():
+            assert stats['requests'] == 4
+            assert stats['errors'] == 0
+        assert Post.query.count() == 10
+
+    def test_database_url(self, monkeypatch, tmpdir):
+        from app import create_app
+        url = 'sqlite:///' + str(tmpdir.join('bench.sqlite'))
+        # Set after the configuration was imported, like `--database-url` does.
+        monkeypatch.setenv('BENCH_DATABASE_URL', url)
+        assert create_app('benchmark').config['SQLALCHEMY_DATABASE_URI'] == url
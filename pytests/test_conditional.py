@@ -0,0 +1,99 @@
+import json
+from base64 import b64encode
+
+import pytest
+from flask import url_for
+
+from app.models import db, User, Role, Post, Comment
+
+def api_headers(**headers):
+    headers.update({
+        'Authorization': 'Basic ' + b64encode(
+            'john@example.com:cat'.encode('utf-8')).decode('utf-8'),
+        'Accept': 'application/json'
+    })
+    return headers
+
+@pytest.mark.usefixtures('client')
+class TestConditionalRequests(object):
+
+    def add_post(self):
+        user = User(email='john@example.com', username='john', password='cat',
+                    confirmed=True, role=Role.query.filter_by(name='User').first())
+        post = Post(body='body', author=user)
+        db.session.add(post)
+        db.session.commit()
+        return user, post
+
+    def count_queries(self, f):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            result = f()
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return result, statements
+
+    def test_resource(self, client):
+        user, post = self.add_post()
+        post_id = post.id
+        url = url_for('api.get_post', id=post_id)
+        response = client.get(url, headers=api_headers())
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        db.session.expunge_all()
+        response, statements = self.count_queries(lambda: client.get(
+            url, headers=api_headers(**{'If-None-Match': etag})))
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        assert not any(s.startswith('SELECT posts.id') for s in statements)
+
+        response = client.get(url, headers=api_headers(**{
+            'If-Modified-Since': last_modified}))
+        assert response.status_code == 304
+
+        # As weakened by a proxy that compressed the response.
+        response = client.get(url, headers=api_headers(**{'If-None-Match': 'W/' + etag}))
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+
+        # A new comment changes the comment count and thus the representation.
+        post = Post.query.get(post_id)
+        db.session.add(Comment(body='comment', post=post, author=post.author))
+        db.session.commit()
+        response = client.get(url, headers=api_headers(**{'If-None-Match': etag}))
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert json.loads(response.get_data(as_text=True))['comment_count'] == 1
+
+    def test_edit_changes_etag(self, client):
+        user, post = self.add_post()
+        url = url_for('api.get_post', id=post.id)
+        etag = client.get(url, headers=api_headers()).headers['ETag']
+        post.body = 'edited'
+        db.session.commit()
+        response = client.get(url, headers=api_headers(**{'If-None-Match': etag}))
+        assert response.status_code == 200
+
+    def test_missing_resource(self, client):
+        self.add_post()
+        response = client.get(url_for('api.get_post', id=1000),
+                              headers=api_headers(**{'If-None-Match': '"x"'}))
+        assert response.status_code == 404
+
+    def test_page(self, client):
+        user, post = self.add_post()
+        url = url_for('api.get_posts')
+        etag = client.get(url, headers=api_headers()).headers['ETag']
+        response = client.get(url, headers=api_headers(**{'If-None-Match': etag}))
+        assert response.status_code == 304
+
+        db.session.add(Post(body='another', author=user))
+        db.session.commit()
+        response = client.get(url, headers=api_headers(**{'If-None-Match': etag}))
+        assert response.status_code == 200
+        assert len(json.loads(response.get_data(as_text=True))['posts']) == 2
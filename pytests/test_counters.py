@@ -0,0 +1,55 @@
+import pytest
+
+from app.models import db, User, Post, Comment, CounterCache
+
+@pytest.mark.usefixtures('app')
+class TestCounterCache(object):
+
+    def add_users(self):
+        u1 = User(email='john@example.com', username='john', password='cat')
+        u2 = User(email='susan@example.com', username='susan', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        return u1, u2
+
+    def test_self_follow_counted(self):
+        u1, u2 = self.add_users()
+        assert (u1.post_count, u1.follower_count, u1.followed_count) == (0, 1, 1)
+
+    def test_posts_and_comments(self):
+        u1, u2 = self.add_users()
+        p = Post(body='post by john', author=u1)
+        db.session.add(p)
+        db.session.commit()
+        db.session.add_all([Comment(body='comment %d' % i, post=p, author=u2)
+                            for i in range(3)])
+        db.session.commit()
+        assert u1.post_count == 1
+        assert p.comment_count == 3
+        db.session.delete(Comment.query.first())
+        db.session.commit()
+        assert p.comment_count == 2
+
+    def test_follows(self):
+        u1, u2 = self.add_users()
+        u1.follow(u2)
+        assert u1.followed_count == 2
+        assert u2.follower_count == 2
+        u1.unfollow(u2)
+        assert u1.followed_count == 1
+        assert u2.follower_count == 1
+
+    def test_recount(self):
+        u1, u2 = self.add_users()
+        db.session.add(Post(body='post by john', author=u1))
+        db.session.commit()
+        User.query.update({'post_count': 5, 'follower_count': 0})
+        db.session.commit()
+        version = u2.version
+        repaired = CounterCache.recount()
+        assert repaired['users.post_count'] == 2
+        assert repaired['users.follower_count'] == 2
+        assert repaired['users.followed_count'] == 0
+        assert (u1.post_count, u1.follower_count) == (1, 1)
+        assert (u2.post_count, u2.follower_count) == (0, 1)
+        assert u2.version > version
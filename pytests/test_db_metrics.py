@@ -0,0 +1,61 @@
+import json
+from collections import namedtuple
+
+import pytest
+from flask import url_for
+
+from app.db_metrics import fingerprint, request_metrics, endpoint_stats
+from app.models import db, User, Role
+
+Query = namedtuple('Query', 'statement parameters duration')
+
+class TestRequestMetrics(object):
+
+    def test_fingerprint(self):
+        assert fingerprint('SELECT * FROM users\n WHERE id = 7') == \
+            'SELECT * FROM users WHERE id = ?'
+        assert fingerprint("SELECT * FROM users WHERE name IN (?, ?, ?)") == \
+            'SELECT * FROM users WHERE name IN (?)'
+        assert fingerprint('SELECT * FROM users WHERE id = %(id_1)s') == \
+            'SELECT * FROM users WHERE id = ?'
+
+    def test_duplicates_and_top(self):
+        queries = [Query('SELECT * FROM users WHERE id = ?', (i,), 0.01)
+                   for i in range(4)]
+        queries.append(Query('SELECT * FROM posts', (), 0.1))
+        metrics = request_metrics(queries, top=1, duplicate_threshold=3)
+        assert metrics['count'] == 5
+        assert abs(metrics['duration'] - 0.14) < 1e-9
+        assert [d['statement'] for d in metrics['duplicates']] == \
+            ['SELECT * FROM users WHERE id = ?']
+        assert [t['statement'] for t in metrics['top']] == ['SELECT * FROM posts']
+
+@pytest.mark.usefixtures('client')
+class TestMetricsEndpoint(object):
+
+    def test_server_timing_and_metrics(self, client):
+        endpoint_stats.reset()
+        admin = User(email='admin@example.com', username='admin', password='cat',
+                     confirmed=True,
+                     role=Role.query.filter_by(name='Administrator').first())
+        db.session.add(admin)
+        db.session.commit()
+        response = client.get(url_for('api.get_posts'))
+        assert 'Server-Timing' not in response.headers
+
+        assert client.get(url_for('main.metrics')).status_code == 302
+        client.post(url_for('auth.login'), data={
+            'email': 'admin@example.com',
+            'password': 'cat'
+        })
+        response = client.get(url_for('main.index'))
+        assert response.headers['Server-Timing'].startswith('db;dur=')
+        response = client.get(url_for('main.metrics'))
+        data = json.loads(response.get_data(as_text=True))
+        assert data['db']['api.get_posts']['requests'] == 1
+        assert 'queue_depth' in data['mail']
+
+    def test_server_timing_for_everybody(self, client):
+        client.application.config['FLASKY_SERVER_TIMING'] = True
+        response = client.get(url_for('api.get_posts'))
+        assert response.headers['Server-Timing'].startswith('db;dur=')
@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+
+from flask_mail import Message
+
+from app.email import dispatcher, send_email, send_bulk_email, EmailJob
+from app.models import db, User
+
+@pytest.mark.usefixtures('app')
+class TestMailDispatcher(object):
+
+    def message(self, i):
+        return Message('message %d' % i, sender='flasky@example.com',
+                       recipients=['user%d@example.com' % i], body='body %d' % i)
+
+    def test_connection_reused(self, app, smtp_sink):
+        for i in range(5):
+            dispatcher.send(self.message(i))
+        dispatcher.flush()
+        assert [m[1] for m in smtp_sink.messages] == \
+            [['user%d@example.com' % i] for i in range(5)]
+        assert smtp_sink.connections == 1
+        metrics = dispatcher.metrics()
+        assert metrics['sent'] == 5
+        assert metrics['queue_depth'] == 0
+        assert metrics['latency_max'] is not None
+
+    def test_retry(self, app, smtp_sink):
+        smtp_sink.reject = 2
+        dispatcher.send(self.message(0))
+        dispatcher.flush()
+        assert len(smtp_sink.messages) == 1
+        assert dispatcher.metrics()['retried'] == 2
+
+    def test_give_up(self, app, smtp_sink):
+        app.config['FLASKY_MAIL_MAX_RETRIES'] = 1
+        smtp_sink.reject = 2
+        dispatcher.send(self.message(0))
+        dispatcher.send(self.message(1))
+        dispatcher.flush()
+        assert [m[1] for m in smtp_sink.messages] == [['user1@example.com']]
+        assert dispatcher.metrics()['failed'] == 1
+
+    def test_send_email(self, app, smtp_sink):
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        with app.test_request_context():
+            send_email(u.email, 'Confirm Your Account', 'auth/email/confirm',
+                       user=u, token='token')
+        dispatcher.flush()
+        assert 'Dear john' in smtp_sink.messages[0][2]
+        assert 'http://localhost/auth/confirm/token' in smtp_sink.messages[0][2]
+        assert dispatcher.metrics()['rendered'] == 1
+
+    def test_send_bulk_email(self, app, smtp_sink):
+        users = [User(email='user%d@example.com' % i, username='user%d' % i,
+                      password='cat') for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        recipients = users[:2] + [('other@example.com', {'user': users[2]})]
+        # From a thread of its own, truly outside of any request, even when a
+        # plugin pushed a request context for the test.
+        def send():
+            with app.app_context():
+                send_bulk_email(recipients, 'Reset Your Password',
+                                'auth/email/reset_password', token='token')
+        thread = threading.Thread(target=send)
+        thread.start()
+        thread.join()
+        dispatcher.flush()
+        assert [m[1] for m in smtp_sink.messages] == [
+            ['user0@example.com'], ['user1@example.com'], ['other@example.com']]
+        bodies = [m[2] for m in smtp_sink.messages]
+        assert 'Dear user0' in bodies[0]
+        assert 'Dear user2' in bodies[2]
+        # Outside of requests, links point at FLASKY_MAIL_BASE_URL.
+        assert app.config['FLASKY_MAIL_BASE_URL'] + 'auth/reset-password/token' in bodies[1]
+        assert len(dispatcher._worker().templates) == 2
+
+    def test_missing_row_fails_the_job(self, app, smtp_sink):
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        job = EmailJob([(u.email, {})], 'Confirm Your Account', 'auth/email/confirm',
+                       {'user': u, 'token': 'token'}, 'http://localhost/')
+        db.session.delete(u)
+        db.session.commit()
+        dispatcher._worker().send_job(job, time.time())
+        assert smtp_sink.messages == []
+        assert dispatcher.metrics()['failed'] == 1
+
+    def test_one_exit_handler(self, app, monkeypatch):
+        import atexit
+        from app import create_app
+        registered = []
+        monkeypatch.setattr(atexit, 'register', registered.append)
+        other = create_app('testing')
+        assert registered == []
+        assert app in dispatcher.apps and other in dispatcher.apps
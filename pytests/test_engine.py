@@ -0,0 +1,108 @@
+import re
+import sqlite3
+
+from sqlalchemy.engine.url import make_url
+
+from app.engine import MeteredQueuePool, backend_profile, postgres_options, pool_metrics
+from app.models import db
+
+class FakePostgresConnection(object):
+    '''Just enough of a psycopg2 connection: `SET` in a transaction is undone by
+    its rollback.'''
+
+    def __init__(self):
+        self.autocommit = False
+        self.settings = {'statement_timeout': '0'}
+        self.pending = None
+
+    def cursor(self):
+        return FakePostgresCursor(self)
+
+    def commit(self):
+        if self.pending is not None:
+            self.settings = self.pending
+        self.pending = None
+
+    def rollback(self):
+        self.pending = None
+
+    def close(self):
+        pass
+
+class FakePostgresCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.result = None
+
+    def execute(self, statement):
+        connection = self.connection
+        settings = connection.settings
+        if not connection.autocommit:
+            if connection.pending is None:
+                connection.pending = dict(connection.settings)
+            settings = connection.pending
+        match = re.match(r'SET (\w+) = (\w+)', statement)
+        if match:
+            settings[match.group(1)] = match.group(2)
+        elif statement.startswith('SHOW '):
+            self.result = settings[statement[5:]]
+
+    def fetchone(self):
+        return (self.result,)
+
+    def close(self):
+        pass
+
+class TestEngineProfiles(object):
+
+    def test_sqlite_profile(self, app):
+        assert isinstance(db.engine.pool, MeteredQueuePool)
+        assert db.session.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert db.session.execute('PRAGMA synchronous').scalar() == 1
+        assert db.session.execute('PRAGMA busy_timeout').scalar() == \
+            app.config['FLASKY_SQLITE_BUSY_TIMEOUT']
+        metrics = pool_metrics(db.engine)
+        assert metrics['checkouts'] > 0
+        assert metrics['timeouts'] == 0
+        assert metrics['checked_out'] >= 1
+
+    def test_postgres_profile(self, app):
+        assert backend_profile(app, make_url('postgres://u@localhost/flasky')) == 'postgres'
+        assert backend_profile(app, make_url('mysql://u@localhost/flasky')) is None
+        app.config.update(FLASKY_DB_MAX_CONNECTIONS=20, FLASKY_DB_WORKERS=3)
+        options = {'pool_timeout': 3}
+        postgres_options(app, options)
+        assert options['pool_size'] == 6
+        assert options['max_overflow'] == 0
+        assert options['pool_timeout'] == 3
+        assert options['poolclass'].pre_ping
+        assert options['poolclass'].session_statements == (
+            'SET statement_timeout = %d' % app.config['FLASKY_DB_STATEMENT_TIMEOUT'],)
+
+    def test_pre_ping_replaces_dead_connections(self):
+        pool = MeteredQueuePool.configured(pre_ping=True)(
+            lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=0)
+        connection = pool.connect()
+        dead = connection.connection
+        connection.close()
+        dead.close()
+        connection = pool.connect()
+        assert connection.connection is not dead
+        connection.cursor().execute('SELECT 1')
+        connection.close()
+        assert pool.metrics.snapshot()['checkouts'] == 2
+
+    def test_session_statements_survive_rollback(self):
+        pool = MeteredQueuePool.configured(['SET statement_timeout = 30000'])(
+            FakePostgresConnection, pool_size=1, max_overflow=0)
+        connection = pool.connect()
+        connection.rollback()
+        # Returning the connection to the pool rolls back too.
+        connection.close()
+        connection = pool.connect()
+        cursor = connection.cursor()
+        cursor.execute('SHOW statement_timeout')
+        assert cursor.fetchone()[0] == '30000'
+        assert connection.connection.autocommit is False
+        connection.close()
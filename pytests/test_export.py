@@ -0,0 +1,53 @@
+import json
+from base64 import b64encode
+from datetime import datetime
+
+import pytest
+from flask import url_for
+
+from app.export import export_records, ndjson
+from app.models import db, User, Role, Post, Comment
+
+@pytest.mark.usefixtures('client')
+class TestExport(object):
+
+    def add_data(self):
+        admin = User(email='admin@example.com', username='admin', password='cat',
+                     confirmed=True,
+                     role=Role.query.filter_by(name='Administrator').first())
+        john = User(email='john@example.com', username='john', password='cat',
+                    confirmed=True)
+        old = Post(body='old', author=john, timestamp=datetime(2016, 1, 1))
+        new = Post(body='new', author=john, timestamp=datetime(2017, 1, 1))
+        db.session.add_all([admin, john, old, new,
+                            Comment(body='comment', post=new, author=admin)])
+        db.session.commit()
+        return admin, john
+
+    def test_records(self):
+        admin, john = self.add_data()
+        records = list(export_records(batch_size=1))
+        assert [r['type'] for r in records] == \
+            ['post', 'post', 'comment', 'follow', 'follow']
+        posts = list(export_records(['posts'], author=john.id,
+                                    since=datetime(2016, 6, 1)))
+        assert [p['body'] for p in posts] == ['new']
+        line = next(ndjson(posts))
+        assert line.endswith('\n')
+        assert json.loads(line)['timestamp'] == '2017-01-01T00:00:00'
+
+    def test_endpoint(self, client):
+        admin, john = self.add_data()
+        def get(email, **args):
+            return client.get(url_for('api.export', **args), headers={
+                'Authorization': 'Basic ' + b64encode(
+                    (email + ':cat').encode('utf-8')).decode('utf-8')})
+        assert get('john@example.com').status_code == 403
+
+        response = get('admin@example.com', types='posts,comments', since='2016-06-01')
+        assert response.mimetype == 'application/x-ndjson'
+        lines = response.get_data(as_text=True).splitlines()
+        assert [json.loads(line)['type'] for line in lines] == ['post', 'comment']
+
+        assert get('admin@example.com', since='yesterday').status_code == 400
+        assert get('admin@example.com', types='users').status_code == 400
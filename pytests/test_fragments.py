@@ -0,0 +1,90 @@
+import os
+
+from flask import url_for, render_template_string
+from jinja2 import Markup
+
+from app import create_app
+from app.models import db, User, Role, Post
+
+def login(client, email):
+    client.post(url_for('auth.login'), data={'email': email, 'password': 'cat'})
+
+class TestFragmentCache(object):
+
+    def add_post(self):
+        role = Role.query.filter_by(name='User').first()
+        john = User(email='john@example.com', username='john', password='cat',
+                    confirmed=True, role=role)
+        susan = User(email='susan@example.com', username='susan', password='cat',
+                     confirmed=True, role=role)
+        post = Post(body='the post', author=susan)
+        db.session.add_all([john, post])
+        db.session.commit()
+        return susan.id, post.id
+
+    def test_post_fragment(self, client):
+        susan_id, post_id = self.add_post()
+        cache = client.application.extensions['fragment_cache']
+        login(client, 'john@example.com')
+        url = url_for('main.post', id=post_id)
+        assert 'the post' in client.get(url).get_data(as_text=True)
+        assert len(cache) == 1
+
+        # The next page is built from the cached fragment.
+        key = list(cache._data)[0]
+        assert key[1].startswith('main/_posts.html:')
+        cache.set(key, Markup('<li>cached</li>'))
+        assert '<li>cached</li>' in client.get(url).get_data(as_text=True)
+
+        # A change to the post or to its author leads to another fragment.
+        Post.query.get(post_id).body = 'the edited post'
+        db.session.commit()
+        assert 'the edited post' in client.get(url).get_data(as_text=True)
+        User.query.get(susan_id).username = 'susanne'
+        db.session.commit()
+        assert 'susanne' in client.get(url).get_data(as_text=True)
+        assert len(cache) == 3
+
+    def test_viewers(self, client):
+        susan_id, post_id = self.add_post()
+        url = url_for('main.post', id=post_id)
+        login(client, 'john@example.com')
+        assert 'Edit' not in client.get(url).get_data(as_text=True)
+        client.get(url_for('auth.logout'))
+        login(client, 'susan@example.com')
+        assert '>Edit<' in client.get(url).get_data(as_text=True)
+
+    def test_clear_reaches_other_processes(self, tmpdir, monkeypatch):
+        from app.fragments import fragment_cache
+        from config import config
+        monkeypatch.setattr(config['testing'], 'FLASKY_RESPONSE_CACHE', 'sqlite')
+        monkeypatch.setattr(config['testing'], 'FLASKY_RESPONSE_CACHE_PATH',
+                            str(tmpdir.join('cache.sqlite')))
+        # A gunicorn worker, and `manage.py` clearing the cache.
+        worker, command = create_app('testing'), create_app('testing')
+        template = '{% cache "x" %}{{ value }}{% endcache %}'
+        with worker.test_request_context():
+            assert render_template_string(template, value=1) == '1'
+        with worker.test_request_context():
+            assert render_template_string(template, value=2) == '1'
+        fragment_cache.clear(command)
+        with worker.test_request_context():
+            assert render_template_string(template, value=3) == '3'
+
+class TestBytecodeCache(object):
+
+    def test_shared_directory(self, tmpdir, monkeypatch):
+        from config import config
+        directory = str(tmpdir.join('bytecode'))
+        monkeypatch.setattr(config['testing'], 'FLASKY_TEMPLATE_BYTECODE_DIR', directory)
+        app = create_app('testing')
+        with app.test_request_context():
+            app.jinja_env.get_template('main/_macros.html')
+        assert [name for name in os.listdir(directory) if name.endswith('.cache')]
+        assert not [name for name in os.listdir(directory) if name.startswith('.tmp-')]
+
+    def test_without_cache(self, app):
+        app.extensions['fragment_cache'] = None
+        template = '{% for i in [1, 2] %}{% cache "x" %}{{ i }}{% endcache %}{% endfor %}'
+        with app.test_request_context():
+            assert render_template_string(template) == '12'
@@ -0,0 +1,47 @@
+import pytest
+
+from app.graph import ensure_self_follows, recount_follows, dedupe_follows, purge_orphans
+from app.models import db, User, Post, Follow, Timeline
+
+@pytest.mark.usefixtures('app')
+class TestGraph(object):
+
+    def add_users(self, n):
+        # Inserted around the ORM, like a restored dump: no self-follows, no counters.
+        db.session.execute(User.__table__.insert(), [
+            {'id': i, 'email': 'user%d@example.com' % i, 'username': 'user%d' % i}
+            for i in range(1, n + 1)])
+        db.session.execute(Post.__table__.insert(), [
+            {'id': i, 'author_id': i, 'body': 'post'} for i in range(1, n + 1)])
+        db.session.commit()
+
+    def test_self_follows(self):
+        self.add_users(5)
+        chunks = list(ensure_self_follows(batch_size=2))
+        assert chunks == [(2, 2), (2, 4), (1, 5)]
+        assert Follow.query.filter(Follow.follower_id==Follow.followed_id).count() == 5
+        assert Timeline.query.filter_by(user_id=3, post_id=3).count() == 1
+        user = User.query.get(3)
+        assert (user.follower_count, user.followed_count) == (1, 1)
+
+        # Running it again changes nothing.
+        assert User.add_self_follows() == 0
+
+    def test_recount_and_purge(self):
+        self.add_users(3)
+        list(ensure_self_follows())
+        db.session.add(Follow(follower_id=1, followed_id=2))
+        db.session.commit()
+        db.session.execute(User.__table__.update().values(follower_count=7))
+        db.session.commit()
+        version = User.query.get(2).version
+        assert sum(count for count, last in recount_follows()) == 3
+        assert User.query.get(2).follower_count == 2
+        assert User.query.get(2).version == version + 1
+
+        db.session.execute(User.__table__.delete().where(User.__table__.c.id==1))
+        db.session.commit()
+        assert purge_orphans() == {'follows': 2, 'timelines': 2}
+        db.session.expire_all()
+        assert User.query.get(2).follower_count == 1
+        assert dedupe_follows() == 0
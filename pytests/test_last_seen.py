@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.last_seen import recorder
+from app.models import db, User
+
+@pytest.mark.usefixtures('app')
+class TestLastSeenRecorder(object):
+
+    def add_users(self, n):
+        users = [User(email='user%d@example.com' % i, username='user%d' % i,
+                      password='cat') for i in range(n)]
+        db.session.add_all(users)
+        db.session.commit()
+        return [user.id for user in users]
+
+    def test_ping_is_buffered(self, app):
+        id = self.add_users(1)[0]
+        before = User.query.get(id).last_seen
+        user = User.query.get(id)
+        user.ping()
+        assert user not in db.session.dirty
+        assert recorder.pending() == 1
+
+        # A second ping within the resolution is not recorded again.
+        seen = user.last_seen
+        user.ping()
+        assert user.last_seen == seen
+
+        assert recorder.flush(app) == 1
+        assert recorder.pending() == 0
+        db.session.expire_all()
+        assert User.query.get(id).last_seen == seen
+        assert seen >= before
+
+    def test_one_update_for_many_users(self, app):
+        ids = self.add_users(5)
+        now = datetime.utcnow() + timedelta(minutes=5)
+        for id in ids:
+            recorder.record(id, now)
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context,
+                                  executemany):
+            statements.append((statement, executemany))
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            assert recorder.flush(app) == 5
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        assert len(statements) == 1
+        assert statements[0][0].startswith('UPDATE users')
+        assert statements[0][1]
+        db.session.expire_all()
+        assert all(User.query.get(id).last_seen == now for id in ids)
+
+    def test_flush_all(self, app):
+        id = self.add_users(1)[0]
+        now = datetime.utcnow() + timedelta(minutes=5)
+        recorder.record(id, now)
+        assert app in recorder.apps
+        recorder.flush_all()
+        assert recorder.pending() == 0
+        db.session.expire_all()
+        assert User.query.get(id).last_seen == now
@@ -0,0 +1,50 @@
+import pytest
+
+from flask import url_for
+
+from app.models import db, User, Role, Post, Comment
+
+@pytest.mark.usefixtures('client')
+class TestLoadingProfiles(object):
+
+    def login(self, client):
+        users = [User(email='user%d@example.com' % i, username='user%d' % i,
+                      password='cat', confirmed=True) for i in range(10)]
+        db.session.add_all(users)
+        db.session.commit()
+        for i, author in enumerate(users):
+            users[0].follow(author)
+            post = Post(body='post %d' % i, author=author)
+            db.session.add(post)
+            db.session.add_all([Comment(body='comment %d' % j, post=post, author=users[j])
+                                for j in range(10)])
+        db.session.commit()
+        client.post(url_for('auth.login'), data={
+            'email': 'user0@example.com',
+            'password': 'cat'
+        })
+        return users
+
+    def test_feed(self, client, assert_constant_queries):
+        self.login(client)
+        def render(per_page):
+            client.application.config['FLASKY_POSTS_PER_PAGE'] = per_page
+            assert client.get(url_for('main.index')).status_code == 200
+        assert_constant_queries(render)
+
+    def test_post_detail(self, client, assert_constant_queries):
+        self.login(client)
+        post = Post.query.first()
+        def render(per_page):
+            client.application.config['FLASKY_COMMENTS_PER_PAGE'] = per_page
+            assert client.get(url_for('main.post', id=post.id)).status_code == 200
+        assert_constant_queries(render)
+
+    def test_moderation(self, client, assert_constant_queries):
+        users = self.login(client)
+        users[0].role = Role.query.filter_by(name='Moderator').first()
+        db.session.commit()
+        def render(per_page):
+            client.application.config['FLASKY_COMMENTS_PER_PAGE'] = per_page
+            assert client.get(url_for('main.moderate')).status_code == 200
+        assert_constant_queries(render)
@@ -0,0 +1,71 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from flask import url_for
+
+from app.exceptions import ValidationError
+from app.models import db, User, Post
+from app.pagination import keyset_paginate, encode_cursor, decode_cursor
+
+def add_posts(count):
+    u = User(email='john@example.com', username='john', password='cat')
+    now = datetime.utcnow()
+    # Posts sharing a timestamp must still be paged through exactly once.
+    posts = [Post(body='post %d' % i, author=u,
+                  timestamp=now - timedelta(minutes=i // 2)) for i in range(count)]
+    db.session.add_all(posts)
+    db.session.commit()
+    return sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+
+@pytest.mark.usefixtures('app')
+class TestKeysetPagination(object):
+
+    def test_cursor_round_trip(self):
+        key = (datetime(2017, 7, 20, 16, 20, 23, 90146), 42)
+        assert decode_cursor(encode_cursor('next', key)) == ('next', key)
+
+    def test_invalid_cursor(self):
+        with pytest.raises(ValidationError):
+            decode_cursor('not-a-cursor')
+        with pytest.raises(ValidationError):
+            keyset_paginate(Post.query, (Post.timestamp, Post.id),
+                            encode_cursor('next', (1,)))
+
+    def test_walk_forwards_and_backwards(self):
+        posts = add_posts(25)
+        columns = (Post.timestamp, Post.id)
+        pages = [keyset_paginate(Post.query, columns, per_page=10)]
+        while pages[-1].has_next:
+            pages.append(keyset_paginate(Post.query, columns,
+                                         pages[-1].next_cursor, per_page=10))
+        assert [len(p.items) for p in pages] == [10, 10, 5]
+        assert [item for p in pages for item in p.items] == posts
+        assert pages[0].has_prev is False
+
+        back = keyset_paginate(Post.query, columns, pages[1].prev_cursor, per_page=10)
+        assert back.items == pages[0].items
+        assert back.has_prev is False
+        assert back.has_next is True
+
+@pytest.mark.usefixtures('client')
+class TestKeysetPaginationAPI(object):
+
+    def test_posts_envelope(self, client):
+        posts = add_posts(15)
+        response = client.get(url_for('api.get_posts'))
+        json_response = json.loads(response.get_data(as_text=True))
+        assert response.status_code == 200
+        assert len(json_response['posts']) == 10
+        assert json_response['prev'] is None
+        assert 'count' not in json_response
+
+        response = client.get(json_response['next'])
+        json_response = json.loads(response.get_data(as_text=True))
+        assert [p['body'] for p in json_response['posts']] == \
+            [p.body for p in posts[10:]]
+        assert json_response['next'] is None
+
+    def test_bad_cursor(self, client):
+        response = client.get(url_for('api.get_posts', cursor='garbage'))
+        assert response.status_code == 400
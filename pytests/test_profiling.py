@@ -0,0 +1,68 @@
+import json
+import time
+from collections import Counter
+
+import pytest
+
+from app.models import db, User, Role, Post
+from app.profiling import Sampler, collapsed, flamegraph, merge_profiles
+
+class TestSampler(object):
+
+    def test_samples_the_target_thread(self):
+        import threading
+        sampler = Sampler(threading.current_thread().ident, 0.001).start()
+        deadline = time.time() + 0.05
+        while time.time() < deadline:
+            sum(range(1000))
+        stacks = sampler.stop()
+        assert sum(stacks.values()) > 0
+        assert all('test_samples_the_target_thread' in stack for stack in stacks)
+
+    def test_output(self):
+        stacks = Counter({'main (a.py:1);view (b.py:2)': 3, 'main (a.py:1)': 1})
+        assert collapsed(stacks) == 'main (a.py:1) 1\nmain (a.py:1);view (b.py:2) 3\n'
+        svg = flamegraph(stacks, 'GET /')
+        assert svg.startswith('<svg') and '4 samples' in svg
+        assert 'view (b.py:2) (3 samples, 75.0%)' in svg
+
+@pytest.mark.usefixtures('client')
+class TestRequestProfiler(object):
+
+    def test_profiled_requests(self, client, tmpdir):
+        app = client.application
+        app.config.update(FLASKY_PROFILE_DIR=str(tmpdir), FLASKY_PROFILE_TOKEN='secret',
+                          FLASKY_PROFILE_INTERVAL=0.001)
+        user = User(email='john@example.com', username='john', password='cat',
+                    confirmed=True, role=Role.query.filter_by(name='User').first())
+        post = Post(body='profiled', author=user)
+        db.session.add(post)
+        db.session.commit()
+
+        response = client.get('/post/%d' % post.id)
+        assert 'X-Profile-Id' not in response.headers
+        response = client.get('/post/%d' % post.id, headers={'X-Profile': 'wrong'})
+        assert 'X-Profile-Id' not in response.headers
+
+        response = client.get('/api/v1.0/posts/%d' % post.id,
+                              headers={'X-Profile': 'secret'})
+        assert response.status_code == 200
+        id = response.headers['X-Profile-Id']
+        directory = tmpdir.join('api.get_post')
+        assert directory.join(id + '.collapsed').check()
+        assert directory.join(id + '.svg').read().startswith('<svg')
+        profile = json.loads(directory.join(id + '.json').read())
+        assert profile['status'] == 200
+        assert profile['endpoint'] == 'api.get_post'
+        assert any('FROM posts' in query['statement'] for query in profile['sql'])
+
+        client.get('/api/v1.0/posts/%d' % post.id, headers={'X-Profile': 'secret'})
+        assert merge_profiles(str(tmpdir), 'api.get_post') == 2
+        assert directory.join('all.svg').check()
+
+    def test_sample_rate(self, client, tmpdir):
+        client.application.config.update(FLASKY_PROFILE_DIR=str(tmpdir),
+                                         FLASKY_PROFILE_SAMPLE_RATE=1.0)
+        response = client.get('/auth/login')
+        assert 'X-Profile-Id' in response.headers
+        assert tmpdir.join('auth.login', response.headers['X-Profile-Id'] + '.json').check()
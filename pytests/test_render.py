@@ -0,0 +1,45 @@
+import pytest
+
+from app import render
+from app.models import db, User, Post, Comment
+
+@pytest.mark.usefixtures('app')
+class TestRender(object):
+
+    def add_post(self, body):
+        u = User(email='john@example.com', username='john', password='cat')
+        p = Post(body=body, author=u)
+        db.session.add(p)
+        db.session.commit()
+        return p
+
+    def test_render_post(self):
+        p = self.add_post('**hello** http://example.com')
+        assert p.body_html == ('<p><strong>hello</strong> <a href="http://example.com" '
+                               'rel="nofollow">http://example.com</a></p>')
+        assert p.body_hash == render.body_hash(p.body)
+        assert p.body_html_version == render.RENDERER_VERSION
+
+    def test_unchanged_body_not_rendered(self, monkeypatch):
+        p = self.add_post('hello')
+        monkeypatch.setattr(render, 'render', lambda body, kind: 1 / 0)
+        p.body = 'hello'
+        db.session.commit()
+        assert p.body_html == '<p>hello</p>'
+
+    def test_rerender_stale(self, monkeypatch):
+        p = self.add_post('hello')
+        c = Comment(body='*hi*', post=p, author=p.author)
+        db.session.add(c)
+        db.session.commit()
+        Comment.query.update({'body_html': None, 'body_html_version': None})
+        db.session.commit()
+
+        monkeypatch.setattr(render, 'RENDERER_VERSION', render.RENDERER_VERSION + 1)
+        batches = list(render.rerender_stale(Post, 'post', batch_size=1))
+        assert batches == [(1, p.id)]
+        assert p.body_html_version == render.RENDERER_VERSION
+        assert list(render.rerender_stale(Post, 'post')) == []
+
+        assert list(render.rerender_stale(Comment, 'comment')) == [(1, c.id)]
+        assert c.body_html == '<em>hi</em>'
@@ -0,0 +1,147 @@
+import json
+import sqlite3
+from base64 import b64encode
+
+import pytest
+
+from app import create_app
+from app.last_seen import recorder
+from app.models import db, User, Role, Post, UserCache
+from config import config
+
+def api_headers():
+    return {
+        'Authorization': 'Basic ' + b64encode(
+            'john@example.com:cat'.encode('utf-8')).decode('utf-8'),
+        'Accept': 'application/json',
+        'Content-Type': 'application/json'
+    }
+
+@pytest.fixture()
+def replicated(request, tmpdir, monkeypatch):
+    '''An application whose replica is a copy of the primary made by `copy()`.'''
+    path = str(tmpdir.join('replica.sqlite'))
+    monkeypatch.setattr(config['testing'], 'FLASKY_DB_REPLICAS', ['sqlite:///' + path])
+    app = create_app('testing')
+    app_context = app.app_context()
+    app_context.push()
+    db.create_all()
+    Role.insert_roles()
+    # Out of the way, as they write to the database.
+    app.try_trigger_before_first_request_functions()
+
+    def teardown():
+        recorder.flush(app)
+        db.session.remove()
+        db.drop_all()
+        app_context.pop()
+    request.addfinalizer(teardown)
+
+    def copy():
+        db.session.commit()
+        replica_set = app.extensions['replicas']
+        replica_set.checked = None
+        replica_set.check()
+        db.get_engine(app, 'replica:0').dispose()
+        source = sqlite3.connect(app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):])
+        target = sqlite3.connect(path)
+        source.backup(target)
+        source.close()
+        return target
+    app.copy_to_replica = copy
+    return app
+
+class TestReplicas(object):
+
+    def add_post(self):
+        user = User(email='john@example.com', username='john', password='cat',
+                    confirmed=True, role=Role.query.filter_by(name='User').first())
+        post = Post(body='on the primary', author=user)
+        db.session.add(post)
+        db.session.commit()
+        return post.id
+
+    def test_routing(self, replicated):
+        id = self.add_post()
+        replica = replicated.copy_to_replica()
+        replica.execute("UPDATE posts SET body = 'on the replica'")
+        replica.commit()
+        replicated.extensions['replicas'].checked = None
+        client = replicated.test_client(use_cookies=True)
+        url = '/api/v1.0/posts/%d' % id
+
+        response = client.get(url, headers=api_headers())
+        assert json.loads(response.get_data(as_text=True))['body'] == 'on the replica'
+
+        # A write pins the session to the primary for a while.
+        response = client.post(url + '/comments/', headers=api_headers(),
+                               data=json.dumps({'body': 'Good post'}))
+        assert response.status_code == 201
+        response = client.get(url, headers=api_headers())
+        assert json.loads(response.get_data(as_text=True))['body'] == 'on the primary'
+
+        with client.session_transaction() as session:
+            session.pop('_primary_until')
+        response = client.get(url, headers=api_headers())
+        assert json.loads(response.get_data(as_text=True))['body'] == 'on the replica'
+
+        # Too far behind, the replica is left out.
+        replica.execute("UPDATE replica_heartbeat SET timestamp = '2000-01-01 00:00:00'")
+        replica.commit()
+        replica.close()
+        replicated.extensions['replicas'].checked = None
+        response = client.get(url, headers=api_headers())
+        assert json.loads(response.get_data(as_text=True))['body'] == 'on the primary'
+
+    def test_replica_reads_are_not_cached(self, replicated):
+        id = self.add_post()
+        replica = replicated.copy_to_replica()
+        replica.execute("UPDATE posts SET body_html = '<p>on the replica</p>'")
+        replica.commit()
+        replicated.extensions['replicas'].checked = None
+        client = replicated.test_client()
+        responses = replicated.extensions['response_cache']
+        fragments = replicated.extensions['fragment_cache']
+
+        assert 'on the replica' in client.get('/post/%d' % id).get_data(as_text=True)
+        assert len(responses.entries) == 0
+        assert len(fragments) == 0
+
+        replica.execute("UPDATE replica_heartbeat SET timestamp = '2000-01-01 00:00:00'")
+        replica.commit()
+        replica.close()
+        replicated.extensions['replicas'].checked = None
+        assert 'on the primary' in client.get('/post/%d' % id).get_data(as_text=True)
+        assert len(responses.entries) == 1
+        assert len(fragments) == 1
+
+    def test_reads_own_writes(self, replicated):
+        id = self.add_post()
+        replicated.copy_to_replica().close()
+        db.session.remove()
+        with replicated.test_request_context('/'):
+            replicas = replicated.extensions['replicas']
+            replicas.checked = None
+            assert db.session.get_bind(clause=db.select([Post.body])) is \
+                db.get_engine(replicated, 'replica:0')
+            Post.query.get(id).body = 'changed'
+            db.session.flush()
+            assert db.session.query(Post.body).filter_by(id=id).scalar() == 'changed'
+            assert db.session.get_bind(clause=db.select([Post.body])) is db.engine
+            db.session.rollback()
+        db.session.remove()
+        with replicated.test_request_context('/', method='POST'):
+            assert db.session.get_bind(clause=db.select([Post.body])) is db.engine
+
+    def test_user_cache_reads_the_primary(self, replicated):
+        replicated.copy_to_replica().close()
+        id = self.add_post()
+        user_id = Post.query.get(id).author_id
+        db.session.remove()
+        UserCache.snapshots.clear()
+        with replicated.test_request_context('/'):
+            replicated.extensions['replicas'].checked = None
+            assert User.query.get(user_id) is None
+            db.session.expunge_all()
+            assert UserCache.load(user_id).username == 'john'
+        assert UserCache.snapshots.get(user_id) is not None
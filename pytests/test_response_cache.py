@@ -0,0 +1,108 @@
+import json
+from base64 import b64encode
+
+import pytest
+from flask import url_for
+
+from app.models import db, User, Role, Post, Comment
+from app.response_cache import SQLiteBackend, MemoryBackend
+
+def count_queries(f):
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        result = f()
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    return result, statements
+
+@pytest.mark.usefixtures('client')
+class TestResponseCache(object):
+
+    def add_post(self):
+        user = User(email='john@example.com', username='john', password='cat',
+                    confirmed=True, role=Role.query.filter_by(name='User').first())
+        post = Post(body='the post', author=user)
+        db.session.add(post)
+        db.session.commit()
+        return user.id, post.id
+
+    def test_anonymous_post_page(self, client):
+        user_id, post_id = self.add_post()
+        url = url_for('main.post', id=post_id)
+        assert 'the post' in client.get(url).get_data(as_text=True)
+
+        db.session.expunge_all()
+        response, statements = count_queries(lambda: client.get(url))
+        assert response.status_code == 200
+        assert statements == []
+
+        # Committing a comment invalidates the page.
+        db.session.add(Comment(body='a comment', post_id=post_id, author_id=user_id))
+        db.session.commit()
+        assert 'a comment' in client.get(url).get_data(as_text=True)
+
+        # So does a change to a row shown on the page, here the author.
+        user = User.query.get(user_id)
+        user.username = 'johnny'
+        db.session.commit()
+        assert 'johnny' in client.get(url).get_data(as_text=True)
+
+    def test_logged_in_viewers_bypass_the_cache(self, client):
+        user_id, post_id = self.add_post()
+        client.post(url_for('auth.login'), data={
+            'email': 'john@example.com',
+            'password': 'cat'
+        })
+        url = url_for('main.post', id=post_id)
+        client.get(url)
+        response, statements = count_queries(lambda: client.get(url))
+        assert 'comment-form' in response.get_data(as_text=True)
+        assert statements
+
+    def test_api_posts(self, client):
+        user_id, post_id = self.add_post()
+        headers = {
+            'Authorization': 'Basic ' + b64encode(
+                'john@example.com:cat'.encode('utf-8')).decode('utf-8'),
+            'Accept': 'application/json'
+        }
+        url = url_for('api.get_posts')
+        first = client.get(url, headers=headers)
+        second = client.get(url, headers=headers)
+        assert second.get_data() == first.get_data()
+        assert second.headers['ETag'] == first.headers['ETag']
+        response = client.get(url, headers=dict(headers, **{
+            'If-None-Match': first.headers['ETag']}))
+        assert response.status_code == 304
+
+        db.session.add(Post(body='another', author_id=user_id))
+        db.session.commit()
+        data = json.loads(client.get(url, headers=headers).get_data(as_text=True))
+        assert len(data['posts']) == 2
+
+class TestBackends(object):
+
+    def check(self, backend, other=None):
+        other = other or backend
+        value = (200, [('Content-Type', 'text/plain')], b'body')
+        assert backend.get('key') is None
+        assert backend.set('key', value, ['post:1'], 60, backend.clock())
+        assert other.get('key') == value
+
+        # An invalidation while rendering prevents storing a stale response.
+        clock = backend.clock()
+        other.invalidate(['user:2'])
+        assert not backend.set('stale', value, ['post:1'], 60, clock)
+
+        other.invalidate(['post:1'])
+        assert backend.get('key') is None
+
+    def test_memory(self):
+        self.check(MemoryBackend(10))
+
+    def test_sqlite_shared(self, tmpdir):
+        path = str(tmpdir.join('cache.sqlite'))
+        self.check(SQLiteBackend(path, 10), SQLiteBackend(path, 10))
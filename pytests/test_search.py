@@ -0,0 +1,137 @@
+import json
+
+import pytest
+
+from app import search as search_module
+from app.models import db, User, Role, Post, Comment
+from app.exceptions import ValidationError
+from app.search import search, reindex, fts5_available, _index_matches, \
+    terms_table, fts_table
+
+@pytest.fixture(params=['fts5', 'index'])
+def backend(request, app):
+    if request.param == 'fts5' and not fts5_available(db.session.connection()):
+        pytest.skip('SQLite was built without FTS5')
+    app.config['FLASKY_SEARCH_FTS5'] = request.param == 'fts5'
+    return request.param
+
+class TestSearch(object):
+
+    def add_rows(self):
+        user = User(email='john@example.com', username='john', password='cat',
+                    confirmed=True, role=Role.query.filter_by(name='User').first())
+        posts = [Post(body='The quick brown fox', author=user),
+                 Post(body='A lazy dog, a lazy cat and a lazy fox', author=user),
+                 Post(body='Nothing to see here', author=user)]
+        comment = Comment(body='What does the fox say?', post=posts[2], author=user)
+        db.session.add_all(posts + [comment])
+        db.session.commit()
+        return posts, comment
+
+    def test_ranking(self, backend):
+        posts, comment = self.add_rows()
+        assert search('LAZY').items == [posts[1]]
+        found = search('fox').items
+        assert set(found) == set([posts[0], posts[1], comment])
+        assert search('lazy fox').items == [posts[1]]
+        assert search('fox unicorn').items == []
+        with pytest.raises(ValidationError):
+            search('  ?! ')
+
+    def test_updates(self, backend):
+        posts, comment = self.add_rows()
+        posts[0].body = 'The quick brown unicorn'
+        comment.disabled = True
+        db.session.commit()
+        assert search('unicorn').items == [posts[0]]
+        assert search('fox').items == [posts[1]]
+
+        comment.disabled = False
+        db.session.delete(posts[1])
+        db.session.commit()
+        assert search('fox').items == [comment]
+
+    def test_pagination(self, backend):
+        user = User(email='john@example.com', username='john', password='cat')
+        db.session.add_all([Post(body='fox ' * (i + 1), author=user) for i in range(5)])
+        db.session.commit()
+        seen = []
+        cursor = None
+        while True:
+            pagination = search('fox', cursor, per_page=2)
+            seen.extend(post.id for post in pagination.items)
+            if not pagination.has_next:
+                break
+            cursor = pagination.next_cursor
+        assert sorted(seen) == sorted(post.id for post in Post.query)
+        assert len(seen) == 5
+
+    def test_index_score_is_float(self, app):
+        # Databases such as PostgreSQL return a Decimal for the sum, which the
+        # pagination cursor can't encode.
+        app.config['FLASKY_SEARCH_FTS5'] = False
+        db.session.add(Post(body='fox', author=User(email='john@example.com',
+                                                     username='john', password='cat')))
+        db.session.commit()
+        matches = _index_matches(['fox'])
+        assert isinstance(matches.c.score.type, db.Float)
+        assert isinstance(db.session.execute(matches).first().score, float)
+
+    def test_document_count_is_cached(self, app):
+        posts, comment = self.add_rows()
+        search_module._document_counts.clear()
+        assert search_module.document_count() == 4
+        db.session.add(Post(body='one more', author=comment.author))
+        db.session.commit()
+        assert search_module.document_count() == 4
+        app.config['FLASKY_SEARCH_DOCUMENT_COUNT_TTL'] = 0
+        search_module._document_counts.clear()
+        assert search_module.document_count() == 5
+
+    def test_reindex(self, backend):
+        posts, comment = self.add_rows()
+        db.session.execute(Post.__table__.update().where(Post.id==posts[2].id)
+                           .values(body='A fox after all'))
+        db.session.commit()
+        assert posts[2] not in search('fox').items
+        list(reindex(batch_size=2))
+        assert posts[2] in search('fox').items
+
+    def test_reindex_keeps_searching(self, backend):
+        posts, comment = self.add_rows()
+        deleted = posts[0].id
+        db.session.execute(Post.__table__.delete().where(Post.id==deleted))
+        db.session.commit()
+        chunks = reindex(batch_size=1)
+        next(chunks)
+        # The rows of the chunks still to come are found meanwhile.
+        assert set(search('fox').items) == set([posts[1], comment])
+        list(chunks)
+        assert set(search('fox').items) == set([posts[1], comment])
+        # The document of the deleted row is gone too.
+        table, column = (fts_table, fts_table.c.rowid) if backend == 'fts5' else \
+            (terms_table, terms_table.c.doc)
+        assert db.session.execute(db.select([db.func.count()]).select_from(table)
+                                  .where(column==deleted * 2)).scalar() == 0
+
+@pytest.mark.usefixtures('client')
+class TestSearchViews(object):
+
+    def test_api_and_page(self, client):
+        user = User(email='john@example.com', username='john', password='cat',
+                    confirmed=True, role=Role.query.filter_by(name='User').first())
+        post = Post(body='Searching for *needles*', author=user)
+        db.session.add(post)
+        db.session.commit()
+
+        response = client.get('/api/v1.0/search?q=needles')
+        assert response.status_code == 200
+        payload = json.loads(response.get_data(as_text=True))
+        assert [result['type'] for result in payload['results']] == ['post']
+        assert payload['results'][0]['post']['body'] == post.body
+        assert client.get('/api/v1.0/search?q=').status_code == 400
+
+        response = client.get('/search?q=needles')
+        assert response.status_code == 200
+        assert '/post/%d' % post.id in response.get_data(as_text=True)
+        assert client.get('/search').status_code == 200
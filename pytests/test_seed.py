@@ -0,0 +1,55 @@
+import pytest
+
+from app.export import export_records, ndjson
+from app.models import db, User, Post, Comment, Follow, Timeline
+from app.seed import seed, import_records, rebuild_derived
+
+@pytest.mark.usefixtures('app')
+class TestSeed(object):
+
+    def dataset(self):
+        return [(p.author_id, p.timestamp, p.body) for p in Post.query.order_by(Post.id)]
+
+    def test_seed(self):
+        counts = seed(users=10, posts=30, comments=50, follows=3, seed=7, batch_size=8)
+        assert counts == {'user': 10, 'follow': 40, 'post': 30, 'comment': 50}
+        assert rebuild_derived() == 80
+
+        user = User.query.get(1)
+        assert user.verify_password('cat')
+        assert user.followed_count == 4
+        assert user.post_count == Post.query.filter_by(author_id=1).count()
+        assert Post.query.filter(Post.body_html==None).count() == 0
+        assert Timeline.query.filter_by(user_id=1).count() == \
+            Post.query.join(Follow, Follow.followed_id==Post.author_id) \
+                .filter(Follow.follower_id==1).count()
+
+    def test_sequences_reset(self, monkeypatch):
+        import app.seed
+        reset = []
+        monkeypatch.setattr(app.seed, 'reset_sequence', reset.append)
+        seed(users=3, posts=3, comments=3, follows=1)
+        # Comments and follows get their ids from the database.
+        assert reset == [User, Post]
+        monkeypatch.undo()
+        db.session.add(Post(body='after the seed', author=User.query.get(1)))
+        db.session.commit()
+
+    def test_reproducible(self):
+        seed(users=5, posts=10, comments=0, seed=3)
+        first = self.dataset()
+        Post.query.delete()
+        db.session.commit()
+        seed(users=5, posts=10, comments=0, seed=3)
+        assert [(a - 5, t, b) for a, t, b in self.dataset()] == first
+
+    def test_import_export(self):
+        seed(users=5, posts=10, comments=20, follows=2)
+        lines = list(ndjson(export_records()))
+        Comment.query.delete()
+        Post.query.delete()
+        Follow.query.delete()
+        db.session.commit()
+        assert import_records(lines, batch_size=3) == \
+            {'post': 10, 'comment': 20, 'follow': 15}
+        assert list(ndjson(export_records())) == lines
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.models import db, User, Post, Timeline
+
+@pytest.mark.usefixtures('app')
+class TestTimeline(object):
+
+    def add_users(self):
+        u1 = User(email='john@example.com', username='john', password='cat')
+        u2 = User(email='susan@example.com', username='susan', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        return u1, u2
+
+    def test_own_posts_on_timeline(self):
+        u1, u2 = self.add_users()
+        p = Post(body='post by john', author=u1)
+        db.session.add(p)
+        db.session.commit()
+        assert u1.followed_posts.all() == [p]
+        assert u2.followed_posts.all() == []
+
+    def test_fan_out_on_write(self):
+        u1, u2 = self.add_users()
+        u1.follow(u2)
+        p = Post(body='post by susan', author=u2)
+        db.session.add(p)
+        db.session.commit()
+        assert u1.followed_posts.all() == [p]
+        assert u2.followed_posts.all() == [p]
+
+    def test_backfill_and_remove(self, app):
+        u1, u2 = self.add_users()
+        now = datetime.utcnow()
+        posts = [Post(body='post %d' % i, author=u2,
+                      timestamp=now - timedelta(minutes=i)) for i in range(3)]
+        db.session.add_all(posts)
+        db.session.commit()
+        u1.follow(u2)
+        assert u1.followed_posts.all() == posts
+        u1.unfollow(u2)
+        assert u1.followed_posts.all() == []
+
+    def test_trim(self, app):
+        app.config['FLASKY_TIMELINE_LENGTH'] = 2
+        u1, u2 = self.add_users()
+        now = datetime.utcnow()
+        posts = [Post(body='post %d' % i, author=u2,
+                      timestamp=now - timedelta(minutes=i)) for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        assert u2.followed_posts.count() == 4
+        assert Timeline.trim_all() == 1
+        assert u2.followed_posts.all() == posts[:2]
+        u1.follow(u2)
+        assert u1.followed_posts.all() == posts[:2]
+
+    def test_rebuild(self):
+        u1, u2 = self.add_users()
+        u1.follow(u2)
+        p = Post(body='post by susan', author=u2)
+        db.session.add(p)
+        db.session.commit()
+        Timeline.query.delete()
+        db.session.commit()
+        assert u1.followed_posts.all() == []
+        Timeline.rebuild()
+        assert u1.followed_posts.all() == [p]
+
+    def test_rebuild_keeps_the_newest(self, app):
+        app.config['FLASKY_TIMELINE_LENGTH'] = 2
+        u1, u2 = self.add_users()
+        u1.follow(u2)
+        now = datetime.utcnow()
+        posts = [Post(body='post %d' % i, author=u2,
+                      timestamp=now - timedelta(minutes=i)) for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        Timeline.query.delete()
+        db.session.commit()
+        assert Timeline.rebuild(batch_size=1) == 2
+        assert u1.followed_posts.all() == posts[:2]
+        assert u2.followed_posts.all() == posts[:2]
+        assert Timeline.query.count() == 4
@@ -0,0 +1,31 @@
+import pytest
+from flask import url_for
+
+from app.models import db, User, Post, Comment
+from app.urls import url_template
+
+@pytest.mark.usefixtures('app')
+class TestUrlTemplates(object):
+
+    @pytest.mark.parametrize('base_url', ['http://localhost/', 'https://example.com:8443/'])
+    def test_matches_url_for(self, app, base_url):
+        with app.test_request_context(base_url=base_url):
+            for endpoint in ('api.get_user', 'api.get_user_posts', 'api.get_post',
+                             'api.get_post_comments', 'api.get_comment'):
+                for id in (1, 42, 918273645):
+                    assert url_template(endpoint)(id) == \
+                        url_for(endpoint, id=id, _external=True)
+
+    def test_to_json(self, app):
+        user = User(email='john@example.com', username='john', password='cat')
+        post = Post(body='body', author=user)
+        comment = Comment(body='comment', post=post, author=user)
+        db.session.add(comment)
+        db.session.commit()
+        with app.test_request_context(base_url='https://example.com/'):
+            assert post.to_json()['author'] == \
+                url_for('api.get_user', id=user.id, _external=True)
+            assert comment.to_json()['post'] == \
+                url_for('api.get_post', id=post.id, _external=True)
+            assert user.to_json()['followed_posts'] == \
+                url_for('api.get_user_followed_posts', id=user.id, _external=True)
@@ -0,0 +1,67 @@
+import pytest
+
+from app.models import db, User, Role, Permission, UserCache, load_user
+
+@pytest.mark.usefixtures('app')
+class TestUserCache(object):
+
+    def add_user(self):
+        user = User(email='john@example.com', username='john', password='cat',
+                    confirmed=True, role=Role.query.filter_by(name='User').first())
+        db.session.add(user)
+        db.session.commit()
+        UserCache.snapshots.clear()
+        return user.id
+
+    def count_queries(self, f, *args):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            result = f(*args)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return result, statements
+
+    def test_snapshot_skips_queries(self):
+        id = self.add_user()
+        db.session.expunge_all()
+        user, statements = self.count_queries(load_user, str(id))
+        assert len(statements) == 1
+
+        db.session.expunge_all()
+        def identify():
+            user = load_user(str(id))
+            return user.username, user.can(Permission.COMMENT), user.is_administrator()
+        result, statements = self.count_queries(identify)
+        assert result == ('john', True, False)
+        assert statements == []
+
+        # Columns outside of the snapshot are still loaded on demand.
+        user = load_user(str(id))
+        assert user.password_hash is not None
+        assert user in db.session
+
+    def test_user_change_invalidates(self):
+        id = self.add_user()
+        load_user(str(id))
+        user = User.query.get(id)
+        user.role = Role.query.filter_by(name='Moderator').first()
+        db.session.commit()
+        db.session.expunge_all()
+        assert load_user(str(id)).can(Permission.MODERATE_COMMENTS)
+
+    def test_role_change_invalidates(self):
+        id = self.add_user()
+        load_user(str(id))
+        role = Role.query.filter_by(name='User').first()
+        role.permissions = Permission.FOLLOW
+        db.session.commit()
+        db.session.expunge_all()
+        assert not load_user(str(id)).can(Permission.COMMENT)
+
+    def test_last_seen_keeps_snapshot(self):
+        id = self.add_user()
+        load_user(str(id)).ping()
+        assert UserCache.snapshots.get(id) is not None